@@ -0,0 +1,182 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable, Dict, List
+
+from adapters.pool import (
+    PoolKey, pool_key, pooled_connection, describe_key,
+    POOL_MIN_SIZE, POOL_MAX_SIZE, POOL_MAX_IDLE, POOL_ACQUIRE_TIMEOUT, POOL_CONNECT_TIMEOUT,
+    POOL_MAX_POOLS, POOL_TARGET_IDLE,
+)
+from instrumentation import timed_stage
+
+try:
+    from psycopg_pool import AsyncConnectionPool
+except ImportError:
+    AsyncConnectionPool = None
+
+# Сколько операций с одной целью может выполняться одновременно
+ASYNC_TARGET_CONCURRENCY = int(os.getenv('ASYNC_TARGET_CONCURRENCY', 8))
+
+_apools: 'OrderedDict[PoolKey, Any]' = OrderedDict()
+_apools_lock = asyncio.Lock()
+_slots: Dict[PoolKey, asyncio.Semaphore] = {}
+# Сколько соединений выдано из пула цели и когда пул использовали последний раз
+_active: Dict[PoolKey, int] = {}
+_last_used: Dict[PoolKey, float] = {}
+
+
+def aio_available() -> bool:
+    """
+    Доступен ли асинхронный драйвер (psycopg 3 + psycopg_pool).
+    """
+    return AsyncConnectionPool is not None
+
+
+def target_slot(params) -> asyncio.Semaphore:
+    """
+    Семафор, ограничивающий число одновременных операций с целью.
+    """
+    key = pool_key(params)
+    slot = _slots.get(key)
+    if slot is None:
+        slot = _slots[key] = asyncio.Semaphore(ASYNC_TARGET_CONCURRENCY)
+    return slot
+
+
+async def _reset_session(aconn):
+    await aconn.execute("RESET ALL")
+
+
+async def open_async_pool(key: PoolKey, max_size: int = POOL_MAX_SIZE):
+    """
+    Новый открытый асинхронный пул psycopg 3 для цели, вне общего реестра.
+    """
+    host, port, user, password, dbname = key
+    pool = AsyncConnectionPool(
+        kwargs=dict(host=host, port=port, user=user, password=password, dbname=dbname,
+                    connect_timeout=POOL_CONNECT_TIMEOUT),
+        min_size=min(POOL_MIN_SIZE, max_size),
+        max_size=max_size,
+        max_idle=POOL_MAX_IDLE,
+        timeout=POOL_ACQUIRE_TIMEOUT,
+        check=AsyncConnectionPool.check_connection,
+        reset=_reset_session,
+        open=False,
+    )
+    await pool.open()
+    return pool
+
+
+def _prune_async_pools(now: float) -> List[Any]:
+    """
+    То же, что pool._prune_pools_locked, для асинхронных пулов: простаивающие
+    дольше POOL_TARGET_IDLE и самые давние сверх POOL_MAX_POOLS, если из
+    них ничего не выдано.
+    """
+    def idle(key):
+        return not _active.get(key) and now - _last_used.get(key, 0) >= 1.0
+
+    stale = [key for key in _apools if idle(key) and now - _last_used.get(key, 0) > POOL_TARGET_IDLE]
+    for key in _apools:
+        if len(_apools) - len(stale) < POOL_MAX_POOLS:
+            break
+        if key not in stale and idle(key):
+            stale.append(key)
+    removed = []
+    for key in stale:
+        removed.append(_apools.pop(key))
+        _slots.pop(key, None)
+        _last_used.pop(key, None)
+    return removed
+
+
+async def get_async_pool(params):
+    """
+    Асинхронный пул psycopg 3 для цели (создаётся и открывается при первом
+    обращении). Реестр ограничен POOL_MAX_POOLS целями (LRU).
+    """
+    key = pool_key(params)
+    _last_used[key] = time.monotonic()
+    pool = _apools.get(key)
+    if pool is not None:
+        _apools.move_to_end(key)
+        return pool
+    async with _apools_lock:
+        pool = _apools.get(key)
+        if pool is None:
+            for old in _prune_async_pools(time.monotonic()):
+                await old.close()
+            pool = _apools[key] = await open_async_pool(key)
+            _last_used[key] = time.monotonic()
+    return pool
+
+
+@asynccontextmanager
+async def aconnection(params):
+    """
+    Асинхронное соединение из пула с учётом лимита параллелизма по цели.
+    """
+    key = pool_key(params)
+    async with target_slot(params):
+        # ожидание соединения из пула (и его открытие) — этап connect текущего анализа
+        with timed_stage('connect'):
+            pool = await get_async_pool(params)
+            _active[key] = _active.get(key, 0) + 1
+            try:
+                aconn = await pool.getconn()
+            except BaseException:
+                _active[key] -= 1
+                raise
+        # без async with aconn: выход из него закрыл бы соединение, а оно
+        # должно вернуться в пул; транзакция завершается явно, как в pool.connection()
+        try:
+            yield aconn
+        except BaseException:
+            try:
+                await aconn.rollback()
+            except Exception:
+                pass  # сломанное соединение пул отбросит сам
+            raise
+        else:
+            await aconn.commit()
+        finally:
+            _active[key] -= 1
+            _last_used[key] = time.monotonic()
+            await pool.putconn(aconn)
+
+
+def _run_sync(params, sync_fn: Callable, args, kwargs):
+    with pooled_connection(params) as conn:
+        return sync_fn(conn, *args, **kwargs)
+
+
+async def run_collector(
+    params,
+    async_fn: Callable[..., Awaitable[Any]],
+    sync_fn: Callable[..., Any],
+    *args,
+    **kwargs,
+) -> Any:
+    """
+    Выполнить сборщик асинхронно: через psycopg 3, если он установлен, иначе —
+    синхронную версию на соединении из пула psycopg2 в отдельном потоке.
+    """
+    if aio_available():
+        async with aconnection(params) as aconn:
+            return await async_fn(aconn, *args, **kwargs)
+    async with target_slot(params):
+        return await asyncio.to_thread(_run_sync, params, sync_fn, args, kwargs)
+
+
+def async_pool_stats():
+    return [{'target': describe_key(key), **pool.get_stats()} for key, pool in list(_apools.items())]
+
+
+async def close_all_async_pools():
+    pools = list(_apools.values())
+    _apools.clear()
+    for pool in pools:
+        await pool.close()
@@ -0,0 +1,112 @@
+from typing import Any, Dict, Iterable, List, Tuple
+
+from adapters.stats import get_server_capabilities
+
+# Отношения ищутся по имени среди видимых в search_path (в плане EXPLAIN без
+# VERBOSE схемы нет)
+RELATION_STATS_SQL = """
+    SELECT
+        c.relname,
+        n.nspname,
+        s.n_live_tup,
+        s.n_mod_since_analyze,
+        GREATEST(s.last_analyze, s.last_autoanalyze),
+        current_setting('default_statistics_target')::int
+    FROM pg_class c
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    LEFT JOIN pg_stat_user_tables s ON s.relid = c.oid
+    WHERE c.relname = ANY(%s) AND c.relkind IN ('r', 'p', 'm') AND pg_table_is_visible(c.oid)
+"""
+
+# attstattarget: -1 (до PostgreSQL 17) или NULL — цель по умолчанию
+COLUMN_STATS_SQL = """
+    SELECT
+        c.relname,
+        a.attname,
+        NULLIF(a.attstattarget, -1),
+        st.null_frac,
+        st.n_distinct,
+        st.correlation,
+        cardinality(st.most_common_freqs),
+        array_length(st.histogram_bounds::text::text[], 1),
+        st.attname IS NOT NULL
+    FROM pg_class c
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    JOIN pg_attribute a ON a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped
+    LEFT JOIN pg_stats st ON st.schemaname = n.nspname AND st.tablename = c.relname
+        AND st.attname = a.attname AND NOT st.inherited
+    WHERE c.relname = ANY(%s) AND a.attname = ANY(%s) AND pg_table_is_visible(c.oid)
+"""
+
+EXTENDED_STATS_SQL = """
+    SELECT
+        c.relname,
+        s.stxname,
+        ARRAY(
+            SELECT a.attname FROM pg_attribute a
+            WHERE a.attrelid = s.stxrelid AND a.attnum = ANY(s.stxkeys)
+            ORDER BY a.attnum
+        )
+    FROM pg_statistic_ext s
+    JOIN pg_class c ON c.oid = s.stxrelid
+    WHERE c.relname = ANY(%s) AND pg_table_is_visible(c.oid)
+"""
+
+
+def collect_cardinality_stats(conn, relations: Iterable[str], columns: Iterable[Tuple[str, str]]) -> Dict[str, Any]:
+    """
+    Статистика планировщика для отношений и колонок из плана: свежесть
+    ANALYZE (pg_stat_user_tables), статистика колонок (pg_stats, цель
+    статистики) и уже созданная расширенная статистика. Три запроса.
+    columns — пары (отношение, колонка).
+    """
+    relations = sorted(set(relations))
+    columns = sorted(set(columns))
+    result: Dict[str, Any] = {
+        'server_version': get_server_capabilities(conn)['server_version'],
+        'default_statistics_target': None,
+        'relations': {},
+        'columns': {},
+        'extended': {},
+    }
+    if not relations:
+        return result
+    with conn.cursor() as cur:
+        cur.execute(RELATION_STATS_SQL, (relations,))
+        for relname, schema, live, modified, analyzed, default_target in cur.fetchall():
+            result['default_statistics_target'] = default_target
+            result['relations'][relname] = {
+                'schema': schema,
+                'n_live_tup': live,
+                'n_mod_since_analyze': modified,
+                'last_analyze': analyzed,
+            }
+
+        if columns:
+            cur.execute(COLUMN_STATS_SQL, (relations, sorted({c for _, c in columns})))
+            wanted = set(columns)
+            for relname, attname, target, null_frac, n_distinct, correlation, mcv, histogram, has_stats in cur.fetchall():
+                if (relname, attname) not in wanted:
+                    continue
+                result['columns'][(relname, attname)] = {
+                    'statistics_target': target,
+                    'has_stats': has_stats,
+                    'null_frac': null_frac,
+                    'n_distinct': n_distinct,
+                    'correlation': correlation,
+                    'mcv_entries': mcv,
+                    'histogram_buckets': histogram,
+                }
+
+        cur.execute(EXTENDED_STATS_SQL, (relations,))
+        for relname, name, keys in cur.fetchall():
+            result['extended'].setdefault(relname, []).append({'name': name, 'columns': list(keys)})
+    return result
+
+
+def extended_stats_covering(stats: Dict[str, Any], relation: str, columns: List[str]) -> List[str]:
+    """
+    Имена объектов расширенной статистики отношения, покрывающих все columns.
+    """
+    wanted = set(columns)
+    return [s['name'] for s in stats['extended'].get(relation, ()) if wanted <= set(s['columns'])]
@@ -0,0 +1,185 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Any, Optional, Tuple
+
+from adapters.pool import POOL_MAX_POOLS, pooled_connection, pool_key, PoolKey
+
+DBINFO_TTL = float(os.getenv('DBINFO_TTL', 60))
+DBINFO_MAX_STALE = float(os.getenv('DBINFO_MAX_STALE', 600))
+# Снимков в кэше не больше, чем пулов в реестре (LRU)
+DBINFO_MAX_TARGETS = int(os.getenv('DBINFO_MAX_TARGETS', POOL_MAX_POOLS))
+
+# Схемы, которые не показываем
+_SYSTEM_SCHEMAS_FILTER = """
+    n.nspname NOT IN ('pg_catalog', 'information_schema')
+    AND n.nspname NOT LIKE 'pg_toast%'
+    AND n.nspname NOT LIKE 'pg_temp_%'
+"""
+
+def collect_db_info(conn) -> Dict[str, Any]:
+    """
+    Снимок каталога БД тремя запросами: общие сведения, таблицы всех схем
+    (размер и статистика обслуживания), индексы всех таблиц.
+    """
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT current_database(),
+                   pg_database_size(current_database()),
+                   (SELECT count(*) FROM pg_user)
+        """)
+        dbname, dbsize, users_count = cur.fetchone()
+
+        cur.execute(f"""
+            SELECT
+                c.oid,
+                n.nspname,
+                c.relname,
+                pg_total_relation_size(c.oid),
+                GREATEST(s.last_vacuum, s.last_autovacuum, s.last_analyze, s.last_autoanalyze),
+                s.n_live_tup
+            FROM pg_class c
+            JOIN pg_namespace n ON n.oid = c.relnamespace
+            LEFT JOIN pg_stat_user_tables s ON s.relid = c.oid
+            WHERE c.relkind IN ('r', 'p') AND {_SYSTEM_SCHEMAS_FILTER}
+        """)
+        tables = {}
+        for oid, schema, name, size, last_update, live_tuples in cur.fetchall():
+            tables[oid] = {
+                "schema": schema,
+                "name": name,
+                "size": size,
+                "indexes": [],
+                "last_update": last_update,
+                "live_tuples": live_tuples,
+            }
+
+        cur.execute(f"""
+            SELECT i.indrelid, ic.relname, pg_get_indexdef(i.indexrelid)
+            FROM pg_index i
+            JOIN pg_class ic ON ic.oid = i.indexrelid
+            JOIN pg_class c ON c.oid = i.indrelid
+            JOIN pg_namespace n ON n.oid = c.relnamespace
+            WHERE {_SYSTEM_SCHEMAS_FILTER}
+            ORDER BY ic.relname
+        """)
+        for indrelid, index_name, index_def in cur.fetchall():
+            table = tables.get(indrelid)
+            if table is not None:
+                table["indexes"].append({"name": index_name, "def": index_def})
+
+    return {
+        "dbname": dbname,
+        "dbsize": dbsize,
+        "users_count": users_count,
+        "tables": list(tables.values()),
+    }
+
+def page_db_info(
+    snapshot: Dict[str, Any],
+    schema: Optional[str] = None,
+    sort: str = 'size',
+    descending: bool = True,
+    offset: int = 0,
+    limit: Optional[int] = None,
+) -> Dict[str, Any]:
+    """
+    Отфильтровать по схеме, отсортировать и вырезать страницу из снимка каталога.
+    """
+    tables = snapshot["tables"]
+    if schema:
+        tables = [t for t in tables if t["schema"] == schema]
+    if sort == 'name':
+        key = lambda t: (t["schema"], t["name"])
+    else:
+        key = lambda t: (t["size"] or 0, t["schema"], t["name"])
+    tables = sorted(tables, key=key, reverse=descending)
+    end = None if limit is None else offset + limit
+    return {
+        "dbname": snapshot["dbname"],
+        "dbsize": snapshot["dbsize"],
+        "tables_count": len(tables),
+        "users_count": snapshot["users_count"],
+        "schemas": sorted({t["schema"] for t in snapshot["tables"]}),
+        "offset": offset,
+        "limit": limit,
+        "tables": tables[offset:end],
+    }
+
+class DbInfoCache:
+    """
+    Кэш снимков каталога по целям. Свежий снимок (моложе ttl) отдаётся сразу,
+    устаревший (моложе max_stale) — тоже, но параллельно запускается фоновое
+    обновление; более старый или отсутствующий снимок собирается синхронно.
+    Хранится не больше max_targets снимков (вытесняются давно не
+    запрошенные), снимки старше max_stale удаляются.
+    """
+
+    def __init__(self, ttl: float = DBINFO_TTL, max_stale: float = DBINFO_MAX_STALE,
+                 max_targets: int = DBINFO_MAX_TARGETS):
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.max_targets = max_targets
+        self._snapshots: 'OrderedDict[PoolKey, Tuple[float, Dict[str, Any]]]' = OrderedDict()
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def _load(self, params, key: PoolKey) -> Dict[str, Any]:
+        with pooled_connection(params) as conn:
+            snapshot = collect_db_info(conn)
+        snapshot["collected_at"] = time.time()
+        now = time.monotonic()
+        with self._lock:
+            self._snapshots[key] = (now, snapshot)
+            self._snapshots.move_to_end(key)
+            self._prune_locked(now)
+        return snapshot
+
+    def _prune_locked(self, now: float):
+        for key, (loaded_at, _) in list(self._snapshots.items()):
+            if now - loaded_at >= self.max_stale:
+                del self._snapshots[key]
+        while len(self._snapshots) > self.max_targets:
+            self._snapshots.popitem(last=False)
+
+    def _refresh_in_background(self, params, key: PoolKey):
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def run():
+            try:
+                self._load(params, key)
+            except Exception:
+                pass  # останется старый снимок, следующая попытка — при следующем запросе
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def get(self, params, force_refresh: bool = False) -> Dict[str, Any]:
+        key = pool_key(params)
+        with self._lock:
+            cached = self._snapshots.get(key)
+            if cached is not None:
+                self._snapshots.move_to_end(key)
+        if cached is not None and not force_refresh:
+            age = time.monotonic() - cached[0]
+            if age < self.ttl:
+                return cached[1]
+            if age < self.max_stale:
+                self._refresh_in_background(params, key)
+                return cached[1]
+        return self._load(params, key)
+
+    def invalidate(self, params=None):
+        with self._lock:
+            if params is None:
+                self._snapshots.clear()
+            else:
+                self._snapshots.pop(pool_key(params), None)
+
+dbinfo_cache = DbInfoCache()
@@ -0,0 +1,57 @@
+from typing import Any, Dict, Iterable, List
+
+from adapters.stats import get_server_capabilities
+
+# INCLUDE-колонки (indnkeyatts) появились в PostgreSQL 11
+COVERING_INDEX_MIN_VERSION = 110000
+
+# Колонки индексов по порядку; у выражений attname — NULL. Отношения ищутся
+# по имени среди видимых в search_path, как в adapters.colstats.
+INDEX_COLUMNS_SQL = """
+    SELECT
+        c.relname,
+        ic.relname,
+        am.amname,
+        i.indisunique,
+        i.indpred IS NOT NULL,
+        {key_count},
+        ARRAY(
+            SELECT a.attname
+            FROM unnest(i.indkey::int2[]) WITH ORDINALITY AS k(attnum, ord)
+            LEFT JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = k.attnum
+            ORDER BY k.ord
+        )
+    FROM pg_index i
+    JOIN pg_class c ON c.oid = i.indrelid
+    JOIN pg_class ic ON ic.oid = i.indexrelid
+    JOIN pg_am am ON am.oid = ic.relam
+    WHERE c.relname = ANY(%s) AND i.indisvalid AND pg_table_is_visible(c.oid)
+    ORDER BY c.relname, ic.relname
+"""
+
+
+def collect_existing_indexes(conn, relations: Iterable[str]) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    Существующие индексы отношений из pg_index: отношение -> список
+    {name, method, unique, partial, columns, include}. Колонка-выражение
+    записывается как None.
+    """
+    relations = sorted(set(relations))
+    if not relations:
+        return {}
+    server_version = get_server_capabilities(conn)['server_version']
+    key_count = 'i.indnkeyatts' if server_version >= COVERING_INDEX_MIN_VERSION else 'i.indnatts'
+    indexes: Dict[str, List[Dict[str, Any]]] = {}
+    with conn.cursor() as cur:
+        cur.execute(INDEX_COLUMNS_SQL.format(key_count=key_count), (relations,))
+        for relname, name, method, unique, partial, keys, columns in cur.fetchall():
+            columns = list(columns)
+            indexes.setdefault(relname, []).append({
+                'name': name,
+                'method': method,
+                'unique': unique,
+                'partial': partial,
+                'columns': columns[:keys],
+                'include': columns[keys:],
+            })
+    return indexes
@@ -1,51 +1,254 @@
-import psycopg2
-from typing import Dict, Any, List, Optional
+import json
+from typing import Dict, Any, List, Optional, Set
 
-def get_current_locks(conn) -> List[Dict[str, Any]]:
+# Один снимок на вызов: pg_locks читается один раз (функция берёт согласованный
+# снимок менеджера блокировок), блокировки группируются по процессам и
+# дополняются данными pg_stat_activity. pg_blocking_pids вызывается только для
+# ожидающих процессов.
+LOCK_SNAPSHOT_SQL = """
+    WITH l AS (
+        SELECT
+            pid,
+            json_agg(json_build_object(
+                'locktype', locktype,
+                'relation', relation::regclass::text,
+                'mode', mode,
+                'granted', granted,
+                'fastpath', fastpath,
+                'virtualtransaction', virtualtransaction,
+                'transactionid', transactionid::text,
+                'virtualxid', virtualxid,
+                'database', database
+            )) AS locks,
+            bool_or(NOT granted) AS waiting
+        FROM pg_locks
+        WHERE pid IS NOT NULL AND pid <> pg_backend_pid()
+        GROUP BY pid
+    )
+    SELECT
+        l.pid,
+        a.application_name,
+        a.state,
+        a.query,
+        now() - a.query_start AS query_duration,
+        CASE WHEN l.waiting THEN pg_blocking_pids(l.pid) END AS blocked_by,
+        l.locks
+    FROM l
+    LEFT JOIN pg_stat_activity a USING (pid)
+"""
+
+# Поля процесса, которые копируются в каждую блокировку плоского списка
+_PROCESS_FIELDS = ('application_name', 'state', 'query', 'query_duration')
+
+
+class LockSnapshot:
     """
-    Возвращает список текущих блокировок в базе.
+    Снимок блокировок и граф ожидания (waiter -> blocker по pg_blocking_pids).
+    Все производные представления считаются из одного снимка.
     """
+
+    def __init__(self, processes: Dict[int, Dict[str, Any]]):
+        self.processes = processes
+        self.waits_for: Dict[int, List[int]] = {
+            pid: p['blocked_by'] for pid, p in processes.items() if p['blocked_by']
+        }
+        self.blocks: Dict[int, List[int]] = {}
+        for waiter, blockers in self.waits_for.items():
+            for blocker in blockers:
+                self.blocks.setdefault(blocker, []).append(waiter)
+        self._cycles: Optional[List[List[int]]] = None
+        self._depths: Optional[Dict[int, int]] = None
+
+    @classmethod
+    def from_rows(cls, rows) -> 'LockSnapshot':
+        processes = {}
+        for pid, application_name, state, query, query_duration, blocked_by, locks in rows:
+            if isinstance(locks, str):
+                locks = json.loads(locks)
+            processes[pid] = {
+                'pid': pid,
+                'application_name': application_name,
+                'state': state,
+                'query': query,
+                'query_duration': query_duration,
+                'blocked_by': list(blocked_by or ()),
+                'locks': locks,
+            }
+        return cls(processes)
+
+    def locks(self, relation_only: bool = False) -> List[Dict[str, Any]]:
+        """
+        Плоский список блокировок всех типов; relation_only — только блокировки
+        отношений, как раньше возвращал get_current_locks (без virtualxid,
+        transactionid и прочих).
+        """
+        flat = []
+        for p in self.processes.values():
+            process_fields = {k: p[k] for k in _PROCESS_FIELDS}
+            for lock in p['locks']:
+                if relation_only and lock['relation'] is None:
+                    continue
+                flat.append({'pid': p['pid'], **lock, **process_fields})
+        return flat
+
+    def cycles(self) -> List[List[int]]:
+        """
+        Циклы ожидания (сильно связные компоненты графа из 2+ процессов или петли).
+        Итеративный алгоритм Тарьяна.
+        """
+        if self._cycles is not None:
+            return self._cycles
+        index: Dict[int, int] = {}
+        low: Dict[int, int] = {}
+        on_stack: Set[int] = set()
+        stack: List[int] = []
+        cycles = []
+        counter = 0
+        for root in self.waits_for:
+            if root in index:
+                continue
+            work = [(root, 0)]
+            while work:
+                node, i = work.pop()
+                if i == 0:
+                    index[node] = low[node] = counter
+                    counter += 1
+                    stack.append(node)
+                    on_stack.add(node)
+                successors = self.waits_for.get(node, ())
+                if i < len(successors):
+                    work.append((node, i + 1))
+                    succ = successors[i]
+                    if succ not in index:
+                        work.append((succ, 0))
+                    elif succ in on_stack:
+                        low[node] = min(low[node], index[succ])
+                    continue
+                if low[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == node:
+                            break
+                    if len(component) > 1 or node in self.waits_for.get(node, ()):
+                        cycles.append(sorted(component))
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[node])
+        self._cycles = cycles
+        return cycles
+
+    def chain_depths(self) -> Dict[int, int]:
+        """
+        Длина самой длинной цепочки ожидания от каждого ожидающего процесса
+        до процесса, который ничего не ждёт (1 — ждёт напрямую корневого).
+        Процессы внутри цикла считаются до входа в цикл.
+        """
+        if self._depths is not None:
+            return self._depths
+        depths: Dict[int, int] = {}
+        in_cycle = {pid for cycle in self.cycles() for pid in cycle}
+        for start in self.waits_for:
+            if start in depths:
+                continue
+            # обход в глубину без рекурсии: цепочки на загруженных кластерах бывают длинными
+            work = [(start, False)]
+            visiting: Set[int] = set()
+            while work:
+                node, expanded = work.pop()
+                if node in depths:
+                    continue
+                blockers = [] if node in in_cycle else self.waits_for.get(node, [])
+                if not expanded:
+                    visiting.add(node)
+                    work.append((node, True))
+                    for b in blockers:
+                        if b not in depths and b not in visiting:
+                            work.append((b, False))
+                    continue
+                visiting.discard(node)
+                if node in in_cycle:
+                    depths[node] = 1
+                else:
+                    depths[node] = max((depths.get(b, 0) + 1 for b in blockers), default=0)
+        self._depths = {pid: d for pid, d in depths.items() if pid in self.waits_for}
+        return self._depths
+
+    def root_blockers(self) -> List[Dict[str, Any]]:
+        """
+        Процессы, которые блокируют других, но сами ничего не ждут, с числом
+        процессов, ожидающих их прямо или транзитивно. Самые «вредные» — первыми.
+        """
+        roots = []
+        for pid in self.blocks:
+            if pid in self.waits_for:
+                continue
+            seen: Set[int] = set()
+            frontier = [pid]
+            while frontier:
+                node = frontier.pop()
+                for waiter in self.blocks.get(node, ()):
+                    if waiter not in seen:
+                        seen.add(waiter)
+                        frontier.append(waiter)
+            p = self.processes.get(pid, {})
+            roots.append({
+                'pid': pid,
+                'blocked_directly': len(self.blocks[pid]),
+                'blocked_total': len(seen),
+                **{k: p.get(k) for k in _PROCESS_FIELDS},
+            })
+        return sorted(roots, key=lambda r: r['blocked_total'], reverse=True)
+
+    def wait_graph(self) -> Dict[str, Any]:
+        depths = self.chain_depths()
+        return {
+            'edges': [{'waiter': w, 'blocker': b} for w, blockers in self.waits_for.items() for b in blockers],
+            'root_blockers': self.root_blockers(),
+            'max_chain_depth': max(depths.values(), default=0),
+            'chain_depths': depths,
+            'cycles': self.cycles(),
+        }
+
+
+def take_lock_snapshot(conn) -> LockSnapshot:
     with conn.cursor() as cur:
-        cur.execute("""
-            SELECT
-                pid,
-                locktype,
-                relation::regclass AS relation,
-                mode,
-                granted,
-                fastpath,
-                virtualtransaction,
-                transactionid,
-                virtualxid,
-                database,
-                application_name,
-                state,
-                query,
-                now() - query_start AS query_duration
-            FROM pg_locks
-            LEFT JOIN pg_stat_activity USING (pid)
-            WHERE relation IS NOT NULL
-            ORDER BY granted DESC, query_duration DESC
-        """)
-        columns = [desc[0] for desc in cur.description]
-        return [dict(zip(columns, row)) for row in cur.fetchall()]
+        cur.execute(LOCK_SNAPSHOT_SQL)
+        return LockSnapshot.from_rows(cur.fetchall())
 
-def get_blocked_processes(conn) -> List[Dict[str, Any]]:
-    """
-    Возвращает процессы, которые ждут блокировки (не granted).
-    """
-    locks = get_current_locks(conn)
+async def take_lock_snapshot_async(aconn) -> LockSnapshot:
+    async with aconn.cursor() as cur:
+        await cur.execute(LOCK_SNAPSHOT_SQL)
+        return LockSnapshot.from_rows(await cur.fetchall())
+
+def blocked_from_locks(locks: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
     return [lock for lock in locks if not lock['granted']]
 
-def get_lock_stats(conn) -> Dict[str, Any]:
+def lock_stats_all_from_locks(locks: List[Dict[str, Any]]) -> Dict[str, Any]:
     """
-    Возвращает агрегированные метрики по блокировкам.
+    Счётчики по блокировкам всех типов: ожидание строки, например, видно
+    только как ожидание transactionid.
     """
-    locks = get_current_locks(conn)
-    blocked = [l for l in locks if not l['granted']]
+    by_type: Dict[str, Dict[str, int]] = {}
+    for lock in locks:
+        counts = by_type.setdefault(lock['locktype'], {'total': 0, 'blocked': 0})
+        counts['total'] += 1
+        counts['blocked'] += not lock['granted']
+    return {
+        "total_locks": len(locks),
+        "blocked_count": sum(c['blocked'] for c in by_type.values()),
+        "by_locktype": by_type,
+    }
+
+def lock_stats_from_locks(locks: List[Dict[str, Any]]) -> Dict[str, Any]:
+    blocked = blocked_from_locks(locks)
     by_table = {}
     for lock in blocked:
         rel = lock['relation']
+        if rel is None:
+            continue
         by_table.setdefault(rel, 0)
         by_table[rel] += 1
     return {
@@ -54,54 +257,80 @@ def get_lock_stats(conn) -> Dict[str, Any]:
         "blocked_tables": by_table,
     }
 
+def long_locks_from_locks(locks: List[Dict[str, Any]], threshold_seconds: int = 10) -> List[Dict[str, Any]]:
+    return [
+        lock for lock in locks
+        if lock['granted'] and lock['query_duration'] and lock['query_duration'].total_seconds() > threshold_seconds
+    ]
+
+def deadlocks_from_snapshot(snapshot: LockSnapshot) -> List[Dict[str, Any]]:
+    return [
+        {
+            'pids': cycle,
+            'processes': [
+                {'pid': pid, **{k: snapshot.processes.get(pid, {}).get(k) for k in _PROCESS_FIELDS},
+                 'blocked_by': snapshot.waits_for.get(pid, [])}
+                for pid in cycle
+            ],
+        }
+        for cycle in snapshot.cycles()
+    ]
+
+def get_current_locks(conn) -> List[Dict[str, Any]]:
+    """
+    Возвращает список текущих блокировок отношений в базе.
+    """
+    return take_lock_snapshot(conn).locks(relation_only=True)
+
+def get_blocked_processes(conn) -> List[Dict[str, Any]]:
+    """
+    Возвращает процессы, которые ждут блокировки (не granted).
+    """
+    return blocked_from_locks(get_current_locks(conn))
+
+def get_lock_stats(conn) -> Dict[str, Any]:
+    """
+    Возвращает агрегированные метрики по блокировкам.
+    """
+    return lock_stats_from_locks(get_current_locks(conn))
+
 def detect_long_locks(conn, threshold_seconds: int = 10) -> List[Dict[str, Any]]:
     """
     Находит блокировки, которые держатся дольше threshold_seconds.
     """
-    locks = get_current_locks(conn)
-    long_locks = [
-        lock for lock in locks
-        if lock['granted'] and lock['query_duration'] and lock['query_duration'].total_seconds() > threshold_seconds
-    ]
-    return long_locks
+    return long_locks_from_locks(get_current_locks(conn), threshold_seconds)
 
 def get_deadlocks(conn) -> List[Dict[str, Any]]:
     """
-    Находит процессы, которые могут быть вовлечены в deadlock (грубо).
+    Циклы в графе ожидания — процессы, взаимно ждущие друг друга.
+    Сам PostgreSQL разрывает такие циклы через deadlock_timeout, так что
+    обнаруживаются они, только если попали в снимок до этого.
     """
-    # В реальности deadlock-ы ловятся по логам или pg_stat_activity, но можно попытаться найти циклы ожидания
-    with conn.cursor() as cur:
-        cur.execute("""
-            SELECT
-                a.pid AS waiting_pid,
-                a.query AS waiting_query,
-                a.state AS waiting_state,
-                b.pid AS blocking_pid,
-                b.query AS blocking_query,
-                b.state AS blocking_state
-            FROM pg_locks bl
-            JOIN pg_stat_activity a ON bl.pid = a.pid
-            JOIN pg_locks wl ON bl.locktype = wl.locktype
-                AND bl.database IS NOT DISTINCT FROM wl.database
-                AND bl.relation IS NOT DISTINCT FROM wl.relation
-                AND bl.page IS NOT DISTINCT FROM wl.page
-                AND bl.tuple IS NOT DISTINCT FROM wl.tuple
-                AND bl.virtualxid IS NOT DISTINCT FROM wl.virtualxid
-                AND bl.transactionid IS NOT DISTINCT FROM wl.transactionid
-                AND bl.classid IS NOT DISTINCT FROM wl.classid
-                AND bl.objid IS NOT DISTINCT FROM wl.objid
-                AND bl.objsubid IS NOT DISTINCT FROM wl.objsubid
-            JOIN pg_stat_activity b ON wl.pid = b.pid
-            WHERE NOT bl.granted AND wl.granted
-        """)
-        columns = [desc[0] for desc in cur.description]
-        return [dict(zip(columns, row)) for row in cur.fetchall()]
+    return deadlocks_from_snapshot(take_lock_snapshot(conn))
+
+def lock_metrics_from_snapshot(snapshot: LockSnapshot) -> Dict[str, Any]:
+    """
+    lock_stats, blocked_processes и long_locks, как и раньше, считаются по
+    блокировкам отношений; *_all — по блокировкам всех типов.
+    """
+    all_locks = snapshot.locks()
+    locks = [lock for lock in all_locks if lock['relation'] is not None]
+    return {
+        "lock_stats": lock_stats_from_locks(locks),
+        "blocked_processes": blocked_from_locks(locks),
+        "long_locks": long_locks_from_locks(locks),
+        "lock_stats_all": lock_stats_all_from_locks(all_locks),
+        "blocked_processes_all": blocked_from_locks(all_locks),
+        "deadlocks": deadlocks_from_snapshot(snapshot),
+        "wait_graph": snapshot.wait_graph(),
+    }
 
 # Основная точка входа для сбора всех метрик по блокировкам
 def collect_lock_metrics(conn) -> Dict[str, Any]:
-    return {
-        "lock_stats": get_lock_stats(conn),
-        "blocked_processes": get_blocked_processes(conn),
-        "long_locks": detect_long_locks(conn),
-        "deadlocks": get_deadlocks(conn),
-    }
\ No newline at end of file
+    return lock_metrics_from_snapshot(take_lock_snapshot(conn))
+
+async def collect_lock_metrics_async(aconn) -> Dict[str, Any]:
+    """
+    То же, что collect_lock_metrics, для асинхронного соединения psycopg 3.
+    """
+    return lock_metrics_from_snapshot(await take_lock_snapshot_async(aconn))
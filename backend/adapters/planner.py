@@ -1,6 +1,11 @@
 import psycopg2
 from typing import Dict, Any, Optional, List
 
+# Параметр сессии на время транзакции EXPLAIN. Имя и значение передаются
+# параметрами: SET их не принимает (psycopg 3 связывает параметры на сервере),
+# а имя, подставленное в текст, было бы SQL-инъекцией
+SET_OPTION_SQL = "SELECT set_config(%s, %s, true)"
+
 def get_explain_plan(
     conn,
     query: str,
@@ -8,19 +13,43 @@ def get_explain_plan(
     analyze: bool = False,
     buffers: bool = False,
     settings: bool = False,
+    generic_plan: bool = False,
+    verbose: bool = False,
     options: Optional[Dict[str, Any]] = None
 ) -> Dict[str, Any]:
     """
-    Получить план выполнения запроса (EXPLAIN [ANALYZE] [BUFFERS] [SETTINGS] FORMAT JSON).
-    options — временные параметры сессии (например, {'work_mem': '128MB'})
+    Получить план выполнения запроса (EXPLAIN [ANALYZE] [BUFFERS] [SETTINGS] [VERBOSE] FORMAT JSON).
+    generic_plan — обобщённый план для запроса с параметрами $1, $2... (PostgreSQL 16+).
+    verbose — с колонками Output узлов и квалифицированными условиями.
+    options — временные параметры (например, {'work_mem': '128MB'}), действуют
+    до конца текущей транзакции
     """
-    # 1. Установить временные параметры сессии (если есть)
+    # 1. Установить временные параметры (если есть)
     if options:
-        for k, v in options.items():
-            with conn.cursor() as cur:
-                cur.execute(f"SET {k} = %s", (v,))
+        with conn.cursor() as cur:
+            for k, v in options.items():
+                cur.execute(SET_OPTION_SQL, (k, str(v)))
     
     # 2. Собрать EXPLAIN-строку
+    sql = build_explain_sql(query, analyze=analyze, buffers=buffers, settings=settings,
+                            generic_plan=generic_plan, verbose=verbose)
+    with conn.cursor() as cur:
+        cur.execute(sql)
+        plan = cur.fetchone()[0][0]  # FORMAT JSON всегда возвращает список из одного элемента
+    return plan
+
+def build_explain_sql(
+    query: str,
+    *,
+    analyze: bool = False,
+    buffers: bool = False,
+    settings: bool = False,
+    generic_plan: bool = False,
+    verbose: bool = False,
+) -> str:
+    """
+    Текст EXPLAIN. Опции всегда в скобках: без них PostgreSQL не принимает FORMAT JSON.
+    """
     explain_opts = []
     if analyze:
         explain_opts.append("ANALYZE")
@@ -28,14 +57,34 @@ def get_explain_plan(
         explain_opts.append("BUFFERS")
     if settings:
         explain_opts.append("SETTINGS")
+    if generic_plan:
+        explain_opts.append("GENERIC_PLAN")
+    if verbose:
+        explain_opts.append("VERBOSE")
     explain_opts.append("FORMAT JSON")
-    explain_str = " ".join(explain_opts)
-    
-    sql = f"EXPLAIN {explain_str} {query}"
-    with conn.cursor() as cur:
-        cur.execute(sql)
-        plan = cur.fetchone()[0][0]  # FORMAT JSON всегда возвращает список из одного элемента
-    return plan
+    return f"EXPLAIN ({', '.join(explain_opts)}) {query}"
+
+async def get_explain_plan_async(
+    aconn,
+    query: str,
+    *,
+    analyze: bool = False,
+    buffers: bool = False,
+    settings: bool = False,
+    generic_plan: bool = False,
+    verbose: bool = False,
+    options: Optional[Dict[str, Any]] = None
+) -> Dict[str, Any]:
+    """
+    То же, что get_explain_plan, для асинхронного соединения psycopg 3.
+    """
+    async with aconn.cursor() as cur:
+        for k, v in (options or {}).items():
+            await cur.execute(SET_OPTION_SQL, (k, str(v)))
+        await cur.execute(build_explain_sql(query, analyze=analyze, buffers=buffers, settings=settings,
+                                            generic_plan=generic_plan, verbose=verbose))
+        row = await cur.fetchone()
+    return row[0][0]
 
 def reset_session_settings(conn):
     """
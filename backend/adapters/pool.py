@@ -0,0 +1,346 @@
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from typing import Dict, Any, List, Optional, Tuple
+
+import psycopg2
+import psycopg2.extensions
+
+from adapters.planner import reset_session_settings
+from instrumentation import timed_stage
+
+PoolKey = Tuple[str, int, str, str, str]
+
+# Асинхронный пул (psycopg_pool) заранее открывает столько соединений
+POOL_MIN_SIZE = int(os.getenv('PG_POOL_MIN_SIZE', 1))
+# Синхронный пул соединения не открывает заранее; столько простаивающих
+# соединений не закрывается по max_idle
+POOL_MIN_IDLE = int(os.getenv('PG_POOL_MIN_IDLE', 1))
+POOL_MAX_SIZE = int(os.getenv('PG_POOL_MAX_SIZE', 10))
+POOL_MAX_IDLE = float(os.getenv('PG_POOL_MAX_IDLE', 300))
+POOL_ACQUIRE_TIMEOUT = float(os.getenv('PG_POOL_ACQUIRE_TIMEOUT', 30))
+POOL_PING_AFTER = float(os.getenv('PG_POOL_PING_AFTER', 5))
+# Сколько пулов (целей) держать одновременно: при переполнении закрываются
+# давно не использовавшиеся пулы без выданных соединений
+POOL_MAX_POOLS = int(os.getenv('PG_POOL_MAX_POOLS', 32))
+# Пул без выданных соединений, не использовавшийся столько секунд, закрывается
+POOL_TARGET_IDLE = float(os.getenv('PG_POOL_TARGET_IDLE', 1800))
+# Пул, только что выданный get_pool, не закрывается, пока из него не взяли соединение
+_POOL_GRACE = 1.0
+# Таймаут установки соединения, секунды (недоступный узел не должен держать поток)
+POOL_CONNECT_TIMEOUT = int(os.getenv('PG_CONNECT_TIMEOUT', 10))
+
+
+class PoolExhausted(Exception):
+    """
+    Не удалось получить соединение из пула за отведённое время.
+    """
+
+
+def pool_key(params) -> PoolKey:
+    """
+    Ключ пула по параметрам подключения (DBConnectionParams, dict или argparse.Namespace).
+    """
+    if isinstance(params, dict):
+        get = params.get
+    else:
+        def get(name, default=None):
+            return getattr(params, name, default)
+    return (
+        get('host') or 'localhost',
+        int(get('port') or 5432),
+        get('user') or 'postgres',
+        get('password') or '',
+        get('dbname') or 'postgres',
+    )
+
+
+def params_from_dsn(dsn: str) -> Dict[str, Any]:
+    """
+    Параметры подключения из DSN (URI postgresql://... или key=value).
+    """
+    parsed = psycopg2.extensions.parse_dsn(dsn)
+    params: Dict[str, Any] = {k: parsed[k] for k in ('host', 'user', 'password', 'dbname') if k in parsed}
+    if 'port' in parsed:
+        params['port'] = int(parsed['port'])
+    return params
+
+
+def describe_key(key: PoolKey) -> str:
+    """
+    Человекочитаемое имя цели без пароля.
+    """
+    host, port, user, _, dbname = key
+    return f"{user}@{host}:{port}/{dbname}"
+
+
+class ConnectionPool:
+    """
+    Пул соединений psycopg2 для одной цели.
+
+    Соединения открываются по требованию. Свободные хранятся стеком (LIFO),
+    простаивающие дольше max_idle закрываются, пока в пуле больше min_idle
+    соединений. При выдаче соединение
+    проверяется, при возврате — откатывается транзакция и сбрасываются параметры сессии.
+    """
+
+    def __init__(
+        self,
+        key: PoolKey,
+        *,
+        min_idle: int = POOL_MIN_IDLE,
+        max_size: int = POOL_MAX_SIZE,
+        max_idle: float = POOL_MAX_IDLE,
+        acquire_timeout: float = POOL_ACQUIRE_TIMEOUT,
+        ping_after: float = POOL_PING_AFTER,
+    ):
+        self.key = key
+        self.min_idle = min_idle
+        self.max_size = max(max_size, 1)
+        self.max_idle = max_idle
+        self.acquire_timeout = acquire_timeout
+        self.ping_after = ping_after
+        self._idle = deque()  # (conn, last_used)
+        self._in_use = 0
+        self._cond = threading.Condition()
+        self._closed = False
+        self.last_used = time.monotonic()
+        self._stats = {
+            'created': 0,
+            'reused': 0,
+            'discarded': 0,
+            'evicted': 0,
+            'waits': 0,
+            'timeouts': 0,
+        }
+
+    def _connect(self):
+        host, port, user, password, dbname = self.key
+        conn = psycopg2.connect(host=host, port=port, user=user, password=password, dbname=dbname,
+                                connect_timeout=POOL_CONNECT_TIMEOUT)
+        with self._cond:
+            self._stats['created'] += 1
+        return conn
+
+    def _is_healthy(self, conn, idle_for: float) -> bool:
+        if conn.closed:
+            return False
+        if conn.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+            return False
+        if idle_for < self.ping_after:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _evict_idle_locked(self, now: float):
+        # самые старые соединения лежат в начале очереди
+        while self._idle and len(self._idle) + self._in_use > self.min_idle:
+            conn, last_used = self._idle[0]
+            if now - last_used < self.max_idle:
+                break
+            self._idle.popleft()
+            self._stats['evicted'] += 1
+            self._close_quietly(conn)
+
+    @staticmethod
+    def _close_quietly(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def acquire(self, timeout: Optional[float] = None):
+        """
+        Взять соединение из пула (или открыть новое, если лимит не исчерпан).
+        """
+        timeout = self.acquire_timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._cond:
+                if self._closed:
+                    raise PoolExhausted(f"Пул {describe_key(self.key)} закрыт")
+                while True:
+                    now = time.monotonic()
+                    self._evict_idle_locked(now)
+                    self.last_used = now
+                    if self._idle:
+                        conn, last_used = self._idle.pop()
+                        self._in_use += 1
+                        break
+                    if self._in_use < self.max_size:
+                        conn, last_used = None, now
+                        self._in_use += 1
+                        break
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        self._stats['timeouts'] += 1
+                        raise PoolExhausted(
+                            f"Нет свободных соединений к {describe_key(self.key)} (max_size={self.max_size})"
+                        )
+                    self._stats['waits'] += 1
+                    self._cond.wait(remaining)
+
+            if conn is None:
+                try:
+                    return self._connect()
+                except Exception:
+                    with self._cond:
+                        self._in_use -= 1
+                        self._cond.notify()
+                    raise
+
+            if self._is_healthy(conn, time.monotonic() - last_used):
+                with self._cond:
+                    self._stats['reused'] += 1
+                return conn
+
+            # соединение умерло, пока лежало в пуле — выбрасываем и пробуем снова
+            self._close_quietly(conn)
+            with self._cond:
+                self._in_use -= 1
+                self._stats['discarded'] += 1
+                self._cond.notify()
+
+    def release(self, conn, discard: bool = False):
+        """
+        Вернуть соединение в пул, предварительно сбросив состояние сессии.
+        """
+        if not discard and not conn.closed:
+            try:
+                conn.rollback()
+                reset_session_settings(conn)
+                conn.commit()
+            except psycopg2.Error:
+                discard = True
+        if conn.closed:
+            discard = True
+        with self._cond:
+            self._in_use -= 1
+            if discard or self._closed:
+                if discard:
+                    self._stats['discarded'] += 1
+                self._close_quietly(conn)
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self.last_used = time.monotonic()
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self, timeout: Optional[float] = None):
+        with timed_stage('connect'):
+            conn = self.acquire(timeout)
+        discard = False
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            discard = True
+            raise
+        finally:
+            self.release(conn, discard=discard)
+
+    def touch(self):
+        with self._cond:
+            self.last_used = time.monotonic()
+
+    def is_busy(self, now: float) -> bool:
+        """
+        Есть выданные соединения или пул только что выдан из реестра.
+        """
+        with self._cond:
+            return self._in_use > 0 or now - self.last_used < _POOL_GRACE
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            while self._idle:
+                conn, _ = self._idle.popleft()
+                self._close_quietly(conn)
+            self._cond.notify_all()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            self._evict_idle_locked(time.monotonic())
+            return {
+                'target': describe_key(self.key),
+                'min_idle': self.min_idle,
+                'max_size': self.max_size,
+                'idle': len(self._idle),
+                'in_use': self._in_use,
+                **self._stats,
+            }
+
+
+# ────────────────────────────────────────────────────────────────
+# Реестр пулов по параметрам подключения
+
+_pools: 'OrderedDict[PoolKey, ConnectionPool]' = OrderedDict()
+_pools_lock = threading.Lock()
+
+
+def _prune_pools_locked(now: float) -> List[ConnectionPool]:
+    """
+    Убрать из реестра пулы без выданных соединений: простаивающие дольше
+    POOL_TARGET_IDLE и, пока реестр полон, самые давно использованные.
+    Занятые пулы не трогаются, так что лимит мягкий. Возвращает пулы,
+    которые нужно закрыть (вне блокировки реестра).
+    """
+    removed = []
+    for key, pool in list(_pools.items()):
+        if now - pool.last_used > POOL_TARGET_IDLE and not pool.is_busy(now):
+            removed.append(_pools.pop(key))
+    for key, pool in list(_pools.items()):
+        if len(_pools) < POOL_MAX_POOLS:
+            break
+        if not pool.is_busy(now):
+            removed.append(_pools.pop(key))
+    return removed
+
+
+def get_pool(params, **pool_options) -> ConnectionPool:
+    """
+    Получить (или создать) пул для указанных параметров подключения.
+    Реестр ограничен POOL_MAX_POOLS целями (LRU).
+    """
+    key = pool_key(params)
+    removed = []
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            removed = _prune_pools_locked(time.monotonic())
+            pool = _pools[key] = ConnectionPool(key, **pool_options)
+        else:
+            _pools.move_to_end(key)
+            pool.touch()
+    for old in removed:
+        old.close()
+    return pool
+
+
+@contextmanager
+def pooled_connection(params, timeout: Optional[float] = None):
+    """
+    Соединение из пула на время блока with.
+    """
+    with get_pool(params).connection(timeout) as conn:
+        yield conn
+
+
+def pool_stats() -> List[Dict[str, Any]]:
+    with _pools_lock:
+        pools = list(_pools.values())
+    return [p.stats() for p in pools]
+
+
+def close_all_pools():
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for p in pools:
+        p.close()
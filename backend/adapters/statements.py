@@ -0,0 +1,65 @@
+from typing import Any, Dict
+
+from adapters.stats import get_server_capabilities
+
+# Сколько строк pg_stat_statements читать за один снимок (по умолчанию pg_stat_statements.max = 5000)
+STATEMENTS_FETCH_LIMIT = 5000
+
+PGSS_INSTALLED_SQL = "SELECT EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_stat_statements')"
+
+
+def statements_sql(server_version: int) -> str:
+    """
+    Запрос счётчиков pg_stat_statements текущей БД. В PostgreSQL 13 колонки
+    времени переименованы (total_time -> total_exec_time).
+    """
+    total_time = 'total_exec_time' if server_version >= 130000 else 'total_time'
+    return f"""
+        SELECT
+            s.queryid,
+            s.query,
+            s.calls,
+            s.{total_time},
+            s.rows,
+            s.shared_blks_read + s.local_blks_read + s.temp_blks_read + s.temp_blks_written
+        FROM pg_stat_statements s
+        JOIN pg_database d ON d.oid = s.dbid
+        WHERE d.datname = current_database() AND s.queryid IS NOT NULL
+        ORDER BY s.{total_time} DESC
+        LIMIT %s
+    """
+
+
+def has_pg_stat_statements(conn) -> bool:
+    with conn.cursor() as cur:
+        cur.execute(PGSS_INSTALLED_SQL)
+        return cur.fetchone()[0]
+
+
+def collect_statement_stats(conn, limit: int = STATEMENTS_FETCH_LIMIT) -> Dict[int, Dict[str, Any]]:
+    """
+    Накопительные счётчики операторов из pg_stat_statements: queryid -> счётчики.
+    Один и тот же queryid может встречаться у разных пользователей — счётчики суммируются.
+    """
+    server_version = get_server_capabilities(conn)['server_version']
+    stats: Dict[int, Dict[str, Any]] = {}
+    with conn.cursor() as cur:
+        cur.execute(statements_sql(server_version), (limit,))
+        for queryid, query, calls, total_time, rows, io_blocks in cur.fetchall():
+            entry = stats.get(queryid)
+            if entry is None:
+                stats[queryid] = {
+                    "queryid": queryid,
+                    "query": query,
+                    "calls": calls,
+                    "total_time": float(total_time),
+                    "rows": rows,
+                    "io_blocks": io_blocks,
+                }
+            else:
+                entry["calls"] += calls
+                entry["total_time"] += float(total_time)
+                entry["rows"] += rows
+                entry["io_blocks"] += io_blocks
+    return stats
+
@@ -1,7 +1,65 @@
 import psycopg2
-from typing import Dict, Any
+import threading
+from typing import Dict, Any, Optional, Tuple
 from metrics import make_metrics_dict
 
+# Сколько запросов к серверу делает collect_all_metrics по отдельным функциям
+# (без учёта двух EXPLAIN для cost/rows)
+PER_METRIC_ROUND_TRIPS = 12
+
+# Кэш возможностей сервера: (dsn, server_version) -> {...}
+_capabilities: Dict[Tuple[str, int], Dict[str, Any]] = {}
+_capabilities_lock = threading.Lock()
+
+CAPABILITIES_SQL = """
+    SELECT column_name
+    FROM information_schema.columns
+    WHERE table_name = 'pg_stat_database'
+"""
+
+def _server_key(conn) -> Tuple[str, int]:
+    # psycopg2: conn.dsn / conn.server_version, psycopg 3: conn.info.*
+    dsn = getattr(conn, 'dsn', None) or conn.info.dsn
+    version = getattr(conn, 'server_version', None) or conn.info.server_version
+    return dsn, version
+
+def _remember_capabilities(key: Tuple[str, int], columns) -> Dict[str, Any]:
+    caps = {
+        'server_version': key[1],
+        'blks_written': 'blks_written' in columns,
+    }
+    with _capabilities_lock:
+        _capabilities[key] = caps
+    return caps
+
+def _known_capabilities(key: Tuple[str, int]) -> Optional[Dict[str, Any]]:
+    with _capabilities_lock:
+        return _capabilities.get(key)
+
+def get_server_capabilities(conn) -> Dict[str, Any]:
+    """
+    Возможности сервера (наличие колонок статистики и т.п.), проверяются один раз
+    на пару (соединение, версия сервера).
+    """
+    key = _server_key(conn)
+    caps = _known_capabilities(key)
+    if caps is not None:
+        return caps
+    with conn.cursor() as cur:
+        cur.execute(CAPABILITIES_SQL)
+        columns = {r[0] for r in cur.fetchall()}
+    return _remember_capabilities(key, columns)
+
+async def get_server_capabilities_async(aconn) -> Dict[str, Any]:
+    key = _server_key(aconn)
+    caps = _known_capabilities(key)
+    if caps is not None:
+        return caps
+    async with aconn.cursor() as cur:
+        await cur.execute(CAPABILITIES_SQL)
+        columns = {r[0] for r in await cur.fetchall()}
+    return _remember_capabilities(key, columns)
+
 def get_query_cost(conn, query: str) -> float:
     with conn.cursor() as cur:
         cur.execute(f"EXPLAIN (FORMAT JSON) {query}")
@@ -45,14 +103,9 @@ def get_wait_time(conn) -> int:
 
 
 def get_disk_io(conn) -> Dict[str, Any]:
+    caps = get_server_capabilities(conn)
     with conn.cursor() as cur:
-        cur.execute("""
-            SELECT column_name
-            FROM information_schema.columns
-            WHERE table_name = 'pg_stat_database'
-        """)
-        columns = [r[0] for r in cur.fetchall()]
-        if 'blks_written' in columns:
+        if caps['blks_written']:
             cur.execute("""
                 SELECT sum(blks_read) as blocks_read, sum(blks_written) as blocks_written
                 FROM pg_stat_database
@@ -101,30 +154,196 @@ def get_lock_contention(conn) -> float:
         """)
         return cur.fetchone()[0]
 
+# Отставание репликации в байтах WAL. На реплике pg_current_wal_lsn() падает
+# («recovery is in progress»), поэтому там считается, насколько воспроизведение
+# отстаёт от полученного WAL; на primary — худшая реплика по pg_stat_replication.
+REPLICATION_LAG_SQL = """
+    CASE WHEN pg_is_in_recovery()
+        THEN coalesce(pg_wal_lsn_diff(pg_last_wal_receive_lsn(), pg_last_wal_replay_lsn()), 0)
+        ELSE coalesce((SELECT max(pg_wal_lsn_diff(pg_current_wal_lsn(), replay_lsn))
+                       FROM pg_stat_replication), 0)
+    END
+"""
+
 def get_replication_lag(conn) -> float:
     with conn.cursor() as cur:
-        cur.execute("""
-            SELECT CASE WHEN pg_last_wal_receive_lsn() IS NULL THEN 0
-            ELSE pg_wal_lsn_diff(pg_current_wal_lsn(), pg_last_wal_receive_lsn())
-            END
-        """)
+        cur.execute(f"SELECT {REPLICATION_LAG_SQL}")
         return cur.fetchone()[0]
 
-def collect_all_metrics(conn, dbname: str, query: str = None) -> Dict[str, Any]:
-    disk_io = get_disk_io(conn)
-    metrics = make_metrics_dict(
-        cost=get_query_cost(conn, query) if query else None,
-        rows=get_query_result_volume(conn, query) if query else None,
-        cache_hit_ratio=get_cache_hit_ratio(conn),
-        index_usage=get_index_usage(conn),
-        wait_time=get_wait_time(conn),
-        disk_io_read=disk_io["disk_io_read"],
-        disk_io_write=disk_io["disk_io_write"],
-        database_size=get_database_size(conn, dbname),
-        deadlock_count=get_deadlock_count(conn),
-        uptime=get_uptime(conn),
-        active_connections=get_active_connections(conn),
-        lock_contention=get_lock_contention(conn),
-        replication_lag=get_replication_lag(conn),
-    )
-    return metrics
\ No newline at end of file
+# Роль узла: реплика ли он, задержка воспроизведения и число подключённых реплик
+NODE_ROLE_SQL = """
+    SELECT
+        pg_is_in_recovery(),
+        CASE WHEN pg_is_in_recovery()
+            THEN extract(epoch FROM now() - pg_last_xact_replay_timestamp())
+        END,
+        (SELECT count(*) FROM pg_stat_replication),
+        current_setting('server_version_num')::int
+"""
+
+def _node_role(row) -> Dict[str, Any]:
+    in_recovery, replay_delay, replicas, server_version = row
+    return {
+        'role': 'replica' if in_recovery else 'primary',
+        'replay_delay': float(replay_delay) if replay_delay is not None else None,
+        'replicas': replicas,
+        'server_version': server_version,
+    }
+
+def get_node_role(conn) -> Dict[str, Any]:
+    with conn.cursor() as cur:
+        cur.execute(NODE_ROLE_SQL)
+        return _node_role(cur.fetchone())
+
+async def get_node_role_async(aconn) -> Dict[str, Any]:
+    async with aconn.cursor() as cur:
+        await cur.execute(NODE_ROLE_SQL)
+        return _node_role(await cur.fetchone())
+
+def _plan_root(plan: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    if plan is None:
+        return None
+    return plan.get('Plan', plan)
+
+SNAPSHOT_SQL = """
+    SELECT
+        (SELECT CASE WHEN sum(blks_hit + blks_read) = 0 THEN 1
+                ELSE sum(blks_hit)::float / sum(blks_hit + blks_read)
+                END
+         FROM pg_stat_database) AS cache_hit_ratio,
+        (SELECT CASE WHEN sum(seq_scan + idx_scan) = 0 THEN 1
+                ELSE sum(idx_scan)::float / sum(seq_scan + idx_scan)
+                END
+         FROM pg_stat_user_tables) AS index_usage,
+        (SELECT count(*) FROM pg_stat_activity WHERE wait_event_type IS NOT NULL) AS wait_time,
+        (SELECT sum(blks_read) FROM pg_stat_database) AS disk_io_read,
+        (SELECT sum(blks_hit) FROM pg_stat_database) AS blks_hit,
+        {disk_io_write} AS disk_io_write,
+        pg_database_size(%s) AS database_size,
+        (SELECT sum(deadlocks) FROM pg_stat_database) AS deadlock_count,
+        extract(epoch FROM now() - pg_postmaster_start_time()) AS uptime,
+        (SELECT count(*) FROM pg_stat_activity WHERE state = 'active') AS active_connections,
+        (SELECT count(*) FROM pg_locks WHERE granted = false) AS lock_contention,
+        {replication_lag} AS replication_lag
+"""
+
+def snapshot_sql(caps: Dict[str, Any]) -> str:
+    disk_io_write = "(SELECT sum(blks_written) FROM pg_stat_database)" if caps['blks_written'] else "NULL"
+    return SNAPSHOT_SQL.format(disk_io_write=disk_io_write, replication_lag=REPLICATION_LAG_SQL)
+
+def plan_metrics(plan: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    cost/rows запроса из уже полученного плана.
+    """
+    root = _plan_root(plan)
+    return {
+        'cost': root.get('Total Cost', 0) if root is not None else None,
+        'rows': root.get('Plan Rows', 0) if root is not None else None,
+    }
+
+def _snapshot_result(row: Dict[str, Any], root, round_trips: int, reuses_plan: bool) -> Dict[str, Any]:
+    metrics = make_metrics_dict(**plan_metrics(root), **row)
+    legacy_round_trips = PER_METRIC_ROUND_TRIPS + (2 if root is not None or reuses_plan else 0)
+    return {
+        'metrics': metrics,
+        'round_trips': round_trips,
+        'round_trips_saved': legacy_round_trips - round_trips,
+    }
+
+def collect_metrics_snapshot(
+    conn,
+    dbname: str,
+    query: str = None,
+    plan: Optional[Dict[str, Any]] = None,
+    reuses_plan: bool = False,
+) -> Dict[str, Any]:
+    """
+    Собрать все метрики кластера одним запросом.
+    cost/rows берутся из уже полученного плана (plan), EXPLAIN выполняется только
+    если плана нет, но передан query. reuses_plan — вызывающий код сам подставит
+    cost/rows из своего плана (plan_metrics). Возвращает метрики и число
+    сэкономленных обращений к серверу.
+    """
+    round_trips = 0
+    if dbname is None:
+        dbname = conn.get_dsn_parameters().get('dbname')
+    if _known_capabilities(_server_key(conn)) is None:
+        round_trips += 1
+    caps = get_server_capabilities(conn)
+
+    root = _plan_root(plan)
+    if root is None and query:
+        with conn.cursor() as cur:
+            cur.execute(f"EXPLAIN (FORMAT JSON) {query}")
+            root = cur.fetchone()[0][0]['Plan']
+        round_trips += 1
+
+    row = fetch_snapshot_row(conn, dbname, caps)
+    round_trips += 1
+    return _snapshot_result(row, root, round_trips, reuses_plan)
+
+def fetch_snapshot_row(conn, dbname: str, caps: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    Сырые значения снимка кластера (включая служебные счётчики вроде blks_hit,
+    которых нет в METRIC_KEYS).
+    """
+    caps = caps or get_server_capabilities(conn)
+    with conn.cursor() as cur:
+        cur.execute(snapshot_sql(caps), (dbname,))
+        columns = [desc[0] for desc in cur.description]
+        return dict(zip(columns, cur.fetchone()))
+
+async def collect_metrics_snapshot_async(
+    aconn,
+    dbname: str,
+    query: str = None,
+    plan: Optional[Dict[str, Any]] = None,
+    reuses_plan: bool = False,
+) -> Dict[str, Any]:
+    """
+    То же, что collect_metrics_snapshot, для асинхронного соединения psycopg 3.
+    """
+    round_trips = 0
+    if dbname is None:
+        dbname = aconn.info.dbname
+    if _known_capabilities(_server_key(aconn)) is None:
+        round_trips += 1
+    caps = await get_server_capabilities_async(aconn)
+
+    root = _plan_root(plan)
+    async with aconn.cursor() as cur:
+        if root is None and query:
+            await cur.execute(f"EXPLAIN (FORMAT JSON) {query}")
+            root = (await cur.fetchone())[0][0]['Plan']
+            round_trips += 1
+        await cur.execute(snapshot_sql(caps), (dbname,))
+        columns = [desc[0] for desc in cur.description]
+        row = dict(zip(columns, await cur.fetchone()))
+    round_trips += 1
+    return _snapshot_result(row, root, round_trips, reuses_plan)
+
+def collect_all_metrics(conn, dbname: str, query: str = None, plan: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    return collect_metrics_snapshot(conn, dbname, query, plan)['metrics']
+
+STATS_EPOCH_SQL = """
+    SELECT
+        (SELECT coalesce(sum(analyze_count + autoanalyze_count), 0) FROM pg_stat_user_tables),
+        (SELECT count(*) FROM pg_class),
+        (SELECT max(xmin::text::bigint) FROM pg_class)
+"""
+
+def get_stats_epoch(conn) -> str:
+    """
+    Дешёвый «номер эпохи» статистики: меняется после ANALYZE/autoanalyze
+    и после DDL (создание/удаление/изменение отношений в pg_class).
+    """
+    with conn.cursor() as cur:
+        cur.execute(STATS_EPOCH_SQL)
+        analyzes, relations, catalog_xmin = cur.fetchone()
+    return f"{analyzes}:{relations}:{catalog_xmin}"
+
+async def get_stats_epoch_async(aconn) -> str:
+    async with aconn.cursor() as cur:
+        await cur.execute(STATS_EPOCH_SQL)
+        analyzes, relations, catalog_xmin = await cur.fetchone()
+    return f"{analyzes}:{relations}:{catalog_xmin}"
@@ -0,0 +1,73 @@
+import os
+import shutil
+import subprocess
+from typing import Any, Dict
+
+# Дамп учебной БД (pg_dump в custom-формате) в корне репозитория
+HACKATHON_DUMP = os.path.abspath(os.path.join(os.path.dirname(__file__), '../../hackathon.sql'))
+BENCH_DBNAME = os.getenv('BENCH_DBNAME', 'hackathon_bench')
+
+# Запросы к учебной БД для сквозного замера /analyze
+FIXTURE_QUERIES = (
+    "SELECT * FROM orders WHERE status = 'shipped'",
+    "SELECT * FROM orders ORDER BY order_date DESC LIMIT 100",
+    "SELECT u.user_id, count(*) FROM users u JOIN orders o ON o.user_id = u.user_id GROUP BY u.user_id",
+    "SELECT r.product_id, avg(r.rating) FROM reviews r JOIN users u ON u.user_id = r.user_id "
+    "WHERE u.registration_date > now() - interval '1 year' GROUP BY r.product_id",
+    "SELECT * FROM addresses a JOIN users u ON u.user_id = a.user_id WHERE a.city = 'Moscow'",
+)
+
+
+def server_params(args) -> Dict[str, Any]:
+    return {
+        'host': args.host,
+        'port': args.port,
+        'user': args.user,
+        'password': args.password,
+        'dbname': 'postgres',
+    }
+
+
+def prepare_fixture(params: Dict[str, Any], dbname: str = BENCH_DBNAME, dump: str = HACKATHON_DUMP,
+                    recreate: bool = False) -> Dict[str, Any]:
+    """
+    Локальная БД для замеров из hackathon.sql: создаётся (или пересоздаётся
+    при recreate) база dbname, дамп восстанавливается pg_restore без
+    владельцев и прав, затем ANALYZE. Если база уже есть — используется как
+    есть. Возвращает параметры подключения к ней.
+    """
+    import psycopg2
+
+    if shutil.which('pg_restore') is None:
+        raise RuntimeError("pg_restore не найден: установите клиент PostgreSQL")
+    admin = psycopg2.connect(**params)
+    admin.autocommit = True
+    try:
+        with admin.cursor() as cur:
+            cur.execute("SELECT 1 FROM pg_database WHERE datname = %s", (dbname,))
+            exists = cur.fetchone() is not None
+            if exists and recreate:
+                cur.execute(f'DROP DATABASE "{dbname}"')
+                exists = False
+            if not exists:
+                cur.execute(f'CREATE DATABASE "{dbname}"')
+    finally:
+        admin.close()
+
+    target = {**params, 'dbname': dbname}
+    if not exists:
+        env = {**os.environ, 'PGPASSWORD': str(params.get('password') or '')}
+        subprocess.run(
+            ['pg_restore', '--no-owner', '--no-acl', '--exit-on-error',
+             '-h', str(params['host']), '-p', str(params['port']), '-U', str(params['user']),
+             '-d', dbname, dump],
+            check=True, env=env,
+        )
+        conn = psycopg2.connect(**target)
+        conn.autocommit = True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("ANALYZE")
+        finally:
+            conn.close()
+    return target
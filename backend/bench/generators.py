@@ -0,0 +1,201 @@
+import json
+import random
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterator, List, Optional
+
+import yaml
+
+Plan = Dict[str, Any]
+
+# Типы узлов синтетических планов
+SCAN_TYPES = ('Seq Scan', 'Index Scan', 'Index Only Scan', 'Bitmap Heap Scan')
+JOIN_TYPES = ('Hash Join', 'Nested Loop', 'Merge Join')
+UNARY_TYPES = ('Sort', 'Hash', 'Materialize', 'Aggregate', 'Limit')
+# Начиная с этого размера поддерева генератор иногда вставляет Append с множеством секций
+APPEND_MIN_BUDGET = 64
+
+# Проблемы и таблицы синтетической истории
+HISTORY_ISSUES = (
+    'Seq Scan на большой таблице', 'Seq Scan без фильтра', 'Nested Loop с большим числом строк',
+    'Hash Join', 'Высокая стоимость', 'Много строк', 'Bitmap Heap Scan', 'Sort',
+)
+PRIORITIES = ('high', 'medium', 'low')
+QUERY_TEMPLATES = (
+    "SELECT * FROM {t} WHERE id = {n}",
+    "SELECT * FROM {t} WHERE status = 'S{n}' ORDER BY created_at DESC LIMIT 100",
+    "SELECT count(*) FROM {t} a JOIN {t2} b ON b.{t}_id = a.id WHERE a.amount > {n}",
+    "UPDATE {t} SET status = 'done' WHERE id IN ({n}, {n2}, {n3})",
+    "SELECT {t}.*, {t2}.name FROM {t} LEFT JOIN {t2} USING (id) WHERE {t}.region = {n}",
+)
+
+
+def _tables(count: int) -> List[str]:
+    return [f"table_{k}" for k in range(count)]
+
+
+def generate_plan(nodes: int, seed: int = 0, analyze: bool = False, relations: int = 50) -> Plan:
+    """
+    Синтетический план EXPLAIN (корень 'Plan') ровно из nodes узлов.
+    Бюджет узлов делится между детьми случайно, так что глубина растёт
+    примерно логарифмически; в больших поддеревьях встречаются Append с
+    десятками и сотнями секций. analyze=True добавляет Actual-поля с
+    разбросом оценок, чтобы срабатывали и правила по кардинальности.
+    """
+    if nodes < 1:
+        raise ValueError("nodes должно быть не меньше 1")
+    rng = random.Random(seed)
+    tables = _tables(relations)
+
+    def finish(node: Plan, children: List[Plan]) -> Plan:
+        rows = rng.choice((1, 10, 500, 5000, 50000, 500000))
+        cost = sum(c['Total Cost'] for c in children) + rng.uniform(1, 2000)
+        node.update({
+            'Startup Cost': round(cost * rng.uniform(0, 0.3), 2),
+            'Total Cost': round(cost, 2),
+            'Plan Rows': rows,
+            'Plan Width': rng.choice((4, 8, 32, 64, 128)),
+        })
+        if analyze:
+            node.update({
+                'Actual Startup Time': round(rng.uniform(0, 5), 3),
+                'Actual Total Time': round(rng.uniform(0.01, 500), 3),
+                'Actual Rows': max(0, int(rows * rng.choice((0.001, 0.1, 1, 1, 1, 3, 250)))),
+                'Actual Loops': rng.choice((1, 1, 1, 10)),
+                'Shared Hit Blocks': rng.randint(0, 10000),
+                'Shared Read Blocks': rng.randint(0, 1000),
+            })
+        if children:
+            node['Plans'] = children
+        return node
+
+    def make(budget: int) -> Plan:
+        if budget == 1:
+            table = rng.choice(tables)
+            alias = table[0] + table.rsplit('_', 1)[1]
+            node = {'Node Type': rng.choice(SCAN_TYPES), 'Relation Name': table, 'Alias': alias}
+            if rng.random() < 0.7:
+                node['Filter'] = f"(({alias}.status)::text = 'S{rng.randint(0, 99)}'::text)"
+            if node['Node Type'] != 'Seq Scan':
+                node['Index Name'] = f"{table}_pkey"
+                node['Index Cond'] = f"({alias}.id = {rng.randint(1, 10 ** 6)})"
+            return finish(node, [])
+        if budget == 2:
+            return finish({'Node Type': rng.choice(UNARY_TYPES)}, [make(1)])
+        if budget > APPEND_MIN_BUDGET and rng.random() < 0.2:
+            parts = min(budget - 1, rng.randint(8, 256))
+            sizes = [1] * parts
+            for _ in range(budget - 1 - parts):
+                sizes[rng.randrange(parts)] += 1
+            return finish({'Node Type': 'Append'}, [make(s) for s in sizes])
+        if rng.random() < 0.15:
+            return finish({'Node Type': rng.choice(UNARY_TYPES)}, [make(budget - 1)])
+        left = rng.randint(1, budget - 2)
+        node = {'Node Type': rng.choice(JOIN_TYPES), 'Join Type': 'Inner'}
+        if node['Node Type'] == 'Hash Join':
+            node['Hash Cond'] = f"(x{rng.randint(0, 9)}.id = y{rng.randint(0, 9)}.ref_id)"
+        return finish(node, [make(left), make(budget - 1 - left)])
+
+    return make(nodes)
+
+
+def generate_explain(nodes: int, seed: int = 0, analyze: bool = False) -> Dict[str, Any]:
+    """
+    Результат EXPLAIN (FORMAT JSON)[0]: {'Plan': ..., 'Planning Time': ...}.
+    """
+    explain = {'Plan': generate_plan(nodes, seed, analyze), 'Planning Time': 0.5}
+    if analyze:
+        explain['Execution Time'] = explain['Plan']['Actual Total Time']
+    return explain
+
+
+def generate_rules(count: int, seed: int = 0) -> List[Dict[str, Any]]:
+    """
+    Набор правил в формате rulesets/*.yaml: примерно половина привязана к
+    типу узла, остальные — общие пороги по строкам и стоимости.
+    """
+    rng = random.Random(seed)
+    node_types = SCAN_TYPES + JOIN_TYPES + UNARY_TYPES + ('Append',)
+    rules = []
+    for k in range(count):
+        match: Dict[str, Any] = {}
+        roll = rng.random()
+        if roll < 0.35:
+            match['node_type'] = rng.choice(node_types)
+        elif roll < 0.5:
+            match['node_type_in'] = rng.sample(node_types, 3)
+        if rng.random() < 0.5:
+            match['plan_rows_gt'] = rng.choice((100, 1000, 10000, 100000))
+        if rng.random() < 0.3:
+            match['total_cost_gt'] = rng.choice((100, 1000, 100000))
+        if rng.random() < 0.1:
+            match['filter_absent'] = True
+        rules.append({
+            'name': f'Синтетическое правило {k}',
+            'match': match,
+            'recommendation': 'Синтетическая рекомендация для {node_type}.',
+            'fix_ddl': "CREATE INDEX IF NOT EXISTS idx_{relation}_{column} ON {relation} ({column});" if k % 3 == 0 else "",
+            'priority': rng.choice(PRIORITIES),
+        })
+    return rules
+
+
+def write_rules_yaml(path: str, count: int, seed: int = 0) -> str:
+    with open(path, 'w', encoding='utf-8') as f:
+        yaml.safe_dump(generate_rules(count, seed), f, allow_unicode=True, sort_keys=False)
+    return path
+
+
+def generate_history(count: int, seed: int = 0, start: Optional[datetime] = None, tables: int = 200) -> Iterator[Dict[str, Any]]:
+    """
+    Записи истории в формате /analyze, от старых к новым с шагом около
+    минуты. Запросы строятся из нескольких шаблонов со случайными
+    литералами, поэтому отпечатков заметно меньше, чем записей.
+    """
+    rng = random.Random(seed)
+    names = _tables(tables)
+    date = start or datetime.utcnow() - timedelta(minutes=count)
+    for k in range(count):
+        date += timedelta(seconds=rng.randint(1, 119))
+        t, t2 = rng.sample(names, 2)
+        n = rng.randint(1, 10 ** 6)
+        query = rng.choice(QUERY_TEMPLATES).format(t=t, t2=t2, n=n, n2=n + 1, n3=n + 2)
+        advice = []
+        for _ in range(rng.randint(0, 5)):
+            relation = rng.choice((t, t2))
+            cost = round(rng.uniform(1, 10 ** 6), 2)
+            advice.append({
+                'issue': rng.choice(HISTORY_ISSUES),
+                'recommendation': 'Синтетическая рекомендация.',
+                'priority': rng.choice(PRIORITIES),
+                'metrics': {'cost': cost, 'rows': rng.randint(1, 10 ** 6)},
+                'node': {'index': rng.randint(0, 30), 'node_type': rng.choice(SCAN_TYPES), 'relation': relation},
+                'fix_ddl': None,
+            })
+        yield {
+            'date': date.isoformat(),
+            'query': query,
+            'tables': [t, t2],
+            'advice': advice,
+            'metrics': {'cost': round(rng.uniform(1, 10 ** 6), 2), 'rows': rng.randint(1, 10 ** 6)},
+        }
+
+
+def write_history_json(path: str, count: int, seed: int = 0, chunk: int = 100000) -> str:
+    """
+    Файл истории в старом формате optimization_history.json (от новых к
+    старым). Пишется по частям по chunk записей, так что миллион записей
+    не держится в памяти целиком.
+    """
+    # шаг между записями меньше двух минут, поэтому части не перекрываются по времени
+    start = datetime.utcnow() - timedelta(minutes=2 * count)
+    first = True
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('[')
+        for offset in reversed(range(0, count, chunk)):
+            size = min(chunk, count - offset)
+            part = list(generate_history(size, seed + offset, start + timedelta(minutes=2 * offset)))
+            for record in reversed(part):
+                f.write(('\n' if first else ',\n') + json.dumps(record, ensure_ascii=False))
+                first = False
+        f.write('\n]')
+    return path
@@ -0,0 +1,322 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional
+
+SUITES = ('plans', 'rules', 'heatmap', 'history', 'analyze')
+DEFAULT_PLAN_SIZES = (10, 100, 1000, 10000, 50000)
+DEFAULT_RULE_COUNTS = (100, 1000)
+DEFAULT_HISTORY_SIZES = (10000, 100000)
+DEFAULT_RULES_PLAN_NODES = 1000
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+# Замедление, начиная с которого --compare считает результат регрессией
+DEFAULT_REGRESSION_THRESHOLD = 1.2
+
+
+def _ints(value: str) -> List[int]:
+    return [int(v) for v in value.split(',') if v.strip()]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Замеры производительности конвейера анализа")
+    parser.add_argument('--suite', action='append', choices=SUITES,
+                        help='Набор замеров; можно повторять (по умолчанию все, кроме analyze без --pg)')
+    parser.add_argument('--plan-sizes', type=_ints, default=list(DEFAULT_PLAN_SIZES),
+                        help='Размеры синтетических планов, узлов (через запятую)')
+    parser.add_argument('--rule-counts', type=_ints, default=list(DEFAULT_RULE_COUNTS),
+                        help='Размеры синтетических наборов правил (через запятую)')
+    parser.add_argument('--rules-plan-nodes', type=int, default=DEFAULT_RULES_PLAN_NODES,
+                        help='Размер плана для замеров больших наборов правил')
+    parser.add_argument('--history-sizes', type=_ints, default=list(DEFAULT_HISTORY_SIZES),
+                        help='Размеры синтетической истории, записей (до 1000000)')
+    parser.add_argument('--repeat', type=int, default=5, help='Повторов каждого замера')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--pg', action='store_true',
+                        help='Сквозной замер /analyze на локальной БД из hackathon.sql')
+    parser.add_argument('--recreate-fixture', action='store_true', help='Пересоздать БД для замеров')
+    parser.add_argument('--host', default=os.getenv('PGHOST', 'localhost'))
+    parser.add_argument('--port', type=int, default=int(os.getenv('PGPORT', 5432)))
+    parser.add_argument('--user', default=os.getenv('PGUSER', 'postgres'))
+    parser.add_argument('--password', default=os.getenv('PGPASSWORD', ''))
+    parser.add_argument('--output', help='Файл результатов JSON (по умолчанию bench/results/<время>.json)')
+    parser.add_argument('--compare', help='Файл результатов прошлого прогона для сравнения')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_REGRESSION_THRESHOLD,
+                        help='Во сколько раз медленнее медиана считается регрессией')
+    parser.add_argument('--fail-on-regression', action='store_true', help='Код возврата 1 при регрессиях')
+    return parser.parse_args()
+
+
+class Recorder:
+    """
+    Результаты замеров: время каждого повтора и сводка (min/медиана/p95).
+    """
+
+    def __init__(self, repeat: int):
+        self.repeat = repeat
+        self.results: List[Dict[str, Any]] = []
+
+    def measure(self, name: str, fn: Callable[[], Any], repeat: Optional[int] = None,
+                items: Optional[int] = None, **params) -> Any:
+        """
+        Замер fn: один прогревочный вызов (не для тяжёлых одноразовых
+        замеров с repeat=1), затем repeat повторов. items — сколько единиц
+        работы в одном вызове, для расчёта пропускной способности.
+        """
+        repeat = repeat or self.repeat
+        result = None
+        if repeat > 1:
+            result = fn()
+        times = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            result = fn()
+            times.append(time.perf_counter() - started)
+        self.add(name, times, items, **params)
+        return result
+
+    def add(self, name: str, times: List[float], items: Optional[int] = None, **params) -> Dict[str, Any]:
+        median = statistics.median(times)
+        entry = {
+            'name': name,
+            'params': params,
+            'runs': len(times),
+            'min': min(times),
+            'median': median,
+            'p95': statistics.quantiles(times, n=20, method='inclusive')[-1] if len(times) > 1 else times[0],
+            'max': max(times),
+            'unit': 'seconds',
+        }
+        if items:
+            entry['items'] = items
+            entry['items_per_second'] = items / median if median > 0 else None
+        self.results.append(entry)
+        label = ', '.join(f'{k}={v}' for k, v in params.items())
+        print(f"{name:32} {label:40} median {median * 1000:10.3f} ms  p95 {entry['p95'] * 1000:10.3f} ms",
+              file=sys.stderr)
+        return entry
+
+
+def bench_plans(rec: Recorder, args):
+    from bench.generators import generate_plan
+    from services.advisor import generate_advice
+    from services.cardinality import find_hotspots
+    from services.detector import collect_node_flags, get_compiled_rules
+    from services.plan_diff import diff_plans
+    from services.plan_table import PlanTable
+
+    rules = get_compiled_rules()
+    for size in args.plan_sizes:
+        plan = generate_plan(size, args.seed)
+        other = generate_plan(size, args.seed + 1)
+        table = rec.measure('plan_table.build', lambda: PlanTable.from_plan(plan), nodes=size)
+        rec.measure('detector.rules', lambda: collect_node_flags(table, rules), nodes=size, rules=len(rules))
+        rec.measure('advisor.generate_advice', lambda: generate_advice(plan), nodes=size)
+        rec.measure('plan_diff.diff_plans', lambda: diff_plans(plan, other), nodes=size)
+        analyzed = generate_plan(size, args.seed, analyze=True)
+        rec.measure('cardinality.find_hotspots', lambda: find_hotspots(analyzed), nodes=size)
+
+
+def bench_rules(rec: Recorder, args):
+    from bench.generators import generate_plan, write_rules_yaml
+    from services.detector import CompiledRules, collect_node_flags, load_rules_from_yaml
+    from services.plan_table import PlanTable
+
+    nodes = args.rules_plan_nodes
+    table = PlanTable.from_plan(generate_plan(nodes, args.seed))
+    with tempfile.TemporaryDirectory() as tmp:
+        for count in args.rule_counts:
+            path = write_rules_yaml(os.path.join(tmp, f'rules_{count}.yaml'), count, args.seed)
+            raw = rec.measure('detector.load_rules_yaml', lambda: load_rules_from_yaml(path), rules=count)
+            compiled = rec.measure('detector.compile_rules', lambda: CompiledRules(raw), rules=count)
+            rec.measure('detector.rules', lambda: collect_node_flags(table, compiled), nodes=nodes, rules=count)
+
+
+def bench_heatmap(rec: Recorder, args):
+    from bench.generators import generate_history
+    from services.heatmap import rollup_increments
+    from services.history import SQLiteHistoryStore
+
+    for size in args.history_sizes:
+        records = list(generate_history(min(size, 100000), args.seed))
+        rec.measure('heatmap.rollup_increments', lambda: [rollup_increments(r) for r in records],
+                    items=len(records), records=len(records))
+        with tempfile.TemporaryDirectory() as tmp:
+            store = SQLiteHistoryStore(os.path.join(tmp, 'history.sqlite'))
+            store.append_many(generate_history(size, args.seed))
+            for window in (None, '1h', '24h', '7d'):
+                rec.measure('history.heatmap', lambda: store.heatmap(window), records=size, window=window or 'all')
+            rec.measure('history.rebuild_rollups', store.rebuild_rollups, repeat=1, items=size, records=size)
+
+
+def bench_history(rec: Recorder, args):
+    from bench.generators import write_history_json, generate_history
+    from services.history import SQLiteHistoryStore, migrate_json_history
+
+    for size in args.history_sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            json_path = write_history_json(os.path.join(tmp, 'history.json'), size, args.seed)
+            store = SQLiteHistoryStore(os.path.join(tmp, 'history.sqlite'))
+            rec.measure('history.migrate_json', lambda: migrate_json_history(json_path, store, force=True),
+                        repeat=1, items=size, records=size)
+            extra = list(generate_history(1000, args.seed + 1))
+            rec.measure('history.append', lambda: [store.append(r) for r in extra[:100]],
+                        items=100, records=size)
+            rec.measure('history.append_many', lambda: store.append_many(extra), items=len(extra), records=size)
+            rec.measure('history.page', lambda: store.page(limit=100), records=size)
+            rec.measure('history.page_deep', lambda: _deep_page(store), records=size)
+            rec.measure('history.page_by_table', lambda: store.page(limit=100, table='table_7'), records=size)
+            rec.measure('history.page_by_issue', lambda: store.page(limit=100, issue='Hash Join'), records=size)
+            fingerprint = store.fingerprints(limit=1)[0]['fingerprint']
+            rec.measure('history.page_by_fingerprint', lambda: store.page(limit=100, fingerprint=fingerprint),
+                        records=size)
+            for sort in ('count', 'worst_cost', 'last_seen'):
+                rec.measure('history.fingerprints', lambda: store.fingerprints(limit=50, sort=sort),
+                            records=size, sort=sort)
+            rec.measure('history.count', store.count, records=size)
+
+
+def _deep_page(store):
+    # страница из середины истории: курсор по id
+    return store.page(cursor=store.count() // 2, limit=100)
+
+
+def bench_analyze(rec: Recorder, args):
+    import asyncio
+    from bench.fixture import FIXTURE_QUERIES, prepare_fixture, server_params
+
+    params = prepare_fixture(server_params(args), recreate=args.recreate_fixture)
+    import main as app
+    from adapters.aio import close_all_async_pools
+    from adapters.pool import close_all_pools
+
+    connection = app.DBConnectionParams(**params)
+
+    async def run(query: str, bypass_cache: bool):
+        return await app.analyze_query(app.QueryRequest(
+            query=query, connection=connection, bypass_cache=bypass_cache, whatif='off'), app.Response())
+
+    async def measure_all():
+        loop = asyncio.get_running_loop()
+        for k, query in enumerate(FIXTURE_QUERIES):
+            for bypass in (True, False):
+                times = []
+                await run(query, bypass)  # прогрев: пулы соединений, кэш возможностей сервера
+                for _ in range(rec.repeat):
+                    started = loop.time()
+                    await run(query, bypass)
+                    times.append(loop.time() - started)
+                rec.add('analyze.end_to_end', times, query=k, cache='bypass' if bypass else 'hit')
+        await close_all_async_pools()
+
+    asyncio.run(measure_all())
+    close_all_pools()
+
+
+BENCHES = {
+    'plans': bench_plans,
+    'rules': bench_rules,
+    'heatmap': bench_heatmap,
+    'history': bench_history,
+    'analyze': bench_analyze,
+}
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(__file__)).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def _result_key(entry: Dict[str, Any]):
+    return entry['name'], json.dumps(entry['params'], sort_keys=True)
+
+
+def compare_results(baseline: Dict[str, Any], current: Dict[str, Any], threshold: float) -> List[Dict[str, Any]]:
+    """
+    Сравнение медиан с прошлым прогоном по совпадающим (замер, параметры).
+    """
+    before = {_result_key(e): e for e in baseline.get('results', ())}
+    rows = []
+    for entry in current['results']:
+        old = before.get(_result_key(entry))
+        if old is None or not old['median']:
+            continue
+        ratio = entry['median'] / old['median']
+        rows.append({
+            'name': entry['name'],
+            'params': entry['params'],
+            'before': old['median'],
+            'after': entry['median'],
+            'ratio': ratio,
+            'regression': ratio >= threshold,
+        })
+    return rows
+
+
+def main():
+    args = parse_args()
+    suites = args.suite or [s for s in SUITES if s != 'analyze' or args.pg]
+    if 'analyze' in suites and not args.pg:
+        print("Error: набор analyze требует --pg (локальный PostgreSQL)", file=sys.stderr)
+        sys.exit(2)
+
+    # история /analyze во время замеров пишется во временный файл, а не в рабочую БД
+    tmp_history = tempfile.mkdtemp(prefix='bench_history_')
+    os.environ['HISTORY_DB'] = os.path.join(tmp_history, 'history.sqlite')
+
+    rec = Recorder(args.repeat)
+    started = datetime.utcnow()
+    for suite in suites:
+        BENCHES[suite](rec, args)
+
+    report = {
+        'meta': {
+            'started': started.isoformat(),
+            'duration': (datetime.utcnow() - started).total_seconds(),
+            'commit': _git_commit(),
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'suites': suites,
+            'repeat': args.repeat,
+            'seed': args.seed,
+            'plan_sizes': args.plan_sizes,
+            'rule_counts': args.rule_counts,
+            'rules_plan_nodes': args.rules_plan_nodes,
+            'history_sizes': args.history_sizes,
+        },
+        'results': rec.results,
+    }
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f"{started.strftime('%Y%m%dT%H%M%S')}.json")
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"Результаты: {output}", file=sys.stderr)
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        rows = compare_results(baseline, report, args.threshold)
+        regressions = [r for r in rows if r['regression']]
+        for r in rows:
+            label = ', '.join(f'{k}={v}' for k, v in r['params'].items())
+            mark = '  REGRESSION' if r['regression'] else ''
+            print(f"{r['name']:32} {label:40} {r['before'] * 1000:10.3f} -> {r['after'] * 1000:10.3f} ms "
+                  f"x{r['ratio']:.2f}{mark}")
+        print(f"Сравнено замеров: {len(rows)}, регрессий: {len(regressions)}")
+        if regressions and args.fail_on_regression:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
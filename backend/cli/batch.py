@@ -0,0 +1,269 @@
+import glob
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from adapters.pool import get_pool, pooled_connection, pool_key, describe_key, POOL_MAX_SIZE
+from adapters.planner import get_explain_plan
+from adapters.stats import collect_metrics_snapshot, get_stats_epoch, plan_metrics
+from adapters.locks import collect_lock_metrics
+from services.advisor import advise_query
+from services.plan_cache import make_cache_key, cached_analysis
+from services.baseline import BaselineStore
+from services.sqltext import split_statements, is_explainable, normalize_query_text, fingerprint_text, text_digest
+from instrumentation import Timings, collecting
+
+Statement = Tuple[str, int, str]  # (источник, номер оператора в источнике, текст)
+
+
+def expand_paths(paths: List[str]) -> List[str]:
+    """
+    Файлы по списку путей: файлы, каталоги (рекурсивно *.sql) и glob-шаблоны.
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            matches = glob.glob(os.path.join(path, '**', '*.sql'), recursive=True)
+        elif glob.has_magic(path):
+            matches = glob.glob(path, recursive=True)
+        else:
+            matches = [path]
+        for match in sorted(matches):
+            if os.path.isfile(match) and match not in files:
+                files.append(match)
+    return files
+
+
+def collect_statements(files: List[str]) -> List[Statement]:
+    statements = []
+    for path in files:
+        with open(path, 'r', encoding='utf-8') as f:
+            for i, statement in enumerate(split_statements(f.read()), 1):
+                statements.append((path, i, statement))
+    return statements
+
+
+def analyze_statement(args, statement: Statement, stats_epoch: str,
+                      baseline: Optional[BaselineStore] = None) -> Dict[str, Any]:
+    """
+    План и рекомендации для одного оператора на соединении из общего пула.
+    С baseline план сверяется с эталоном отпечатка (или принимается как
+    эталон при --accept-baseline).
+    """
+    source, index, query = statement
+    normalized = fingerprint_text(query)
+    result = {
+        "source": source,
+        "index": index,
+        "query": query,
+        "fingerprint": text_digest(normalized),
+        "normalized_query": normalized,
+    }
+    if not is_explainable(query):
+        result["skipped"] = "EXPLAIN не поддерживается для этого оператора"
+        return result
+    timings = Timings('batch', describe_key(pool_key(args)))
+    try:
+        with collecting(timings), timings.stage("total"), pooled_connection(args) as conn:
+
+            def run_pipeline():
+                with timings.stage("plan"):
+                    plan = get_explain_plan(conn, query)['Plan']
+                with timings.stage("advice"):
+                    advice = advise_query(plan)
+                return {"plan": plan, "advice": advice}
+
+            cache_key = make_cache_key(timings.target, query, stats_epoch)
+            analysis, cache_status = cached_analysis(cache_key, run_pipeline, bypass=args.no_cache)
+    except Exception as e:
+        result["error"] = str(e)
+        result["timings"] = timings.as_dict()
+        return result
+    result.update(
+        advice=analysis['advice'],
+        metrics=plan_metrics(analysis['plan']),
+        plan_cache=cache_status,
+        timings=timings.as_dict(),
+    )
+    if baseline is not None:
+        result["baseline"] = check_baseline(args, baseline, result, analysis['plan'])
+    return result
+
+
+def check_baseline(args, baseline: BaselineStore, result: Dict[str, Any], plan) -> Dict[str, Any]:
+    """
+    Сверка плана с эталоном отпечатка; при --accept-baseline план становится эталоном.
+    """
+    fingerprint = result["fingerprint"]
+    if args.accept_baseline:
+        baseline.accept(fingerprint, result["normalized_query"], plan, source=result.get("source"))
+        return {"status": "accepted", "reasons": []}
+    return baseline.compare(fingerprint, plan, cost_threshold=args.cost_threshold,
+                            rows_threshold=args.rows_threshold)
+
+
+def is_baseline_failure(args, comparison: Optional[Dict[str, Any]]) -> bool:
+    if comparison is None:
+        return False
+    return comparison["status"] == "regressed" or (args.fail_on_shape_change and comparison["status"] == "changed")
+
+
+def run_batch(
+    args,
+    statements: List[Statement],
+    baseline: Optional[BaselineStore] = None,
+    on_result: Optional[Callable[[Dict[str, Any]], None]] = None,
+) -> Dict[str, Any]:
+    """
+    Анализ набора операторов пулом потоков. Метрики кластера и блокировки
+    собираются один раз на весь запуск. on_result вызывается (в вызывающем
+    потоке) для каждого результата по мере готовности — для потокового
+    вывода; дубликаты приходят после всех уникальных операторов.
+    """
+    started = time.perf_counter()
+    workers = max(1, args.workers)
+    get_pool(args, max_size=max(POOL_MAX_SIZE, workers + 1))
+
+    with pooled_connection(args) as conn:
+        stats_epoch = get_stats_epoch(conn)
+        cluster_metrics = collect_metrics_snapshot(conn, args.dbname)['metrics']
+        lock_metrics = collect_lock_metrics(conn)
+
+    # Одинаковые (после нормализации) операторы анализируются один раз
+    unique: Dict[str, Statement] = {}
+    for statement in statements:
+        unique.setdefault(normalize_query_text(statement[2]), statement)
+    analyzed_once: Dict[str, Dict[str, Any]] = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(analyze_statement, args, st, stats_epoch, baseline): key
+                   for key, st in unique.items()}
+        for future in as_completed(futures):
+            result = analyzed_once[futures[future]] = future.result()
+            if on_result is not None:
+                on_result(result)
+
+    results = []
+    for source, index, query in statements:
+        first = analyzed_once[normalize_query_text(query)]
+        if first["source"] == source and first["index"] == index:
+            results.append(first)
+        else:
+            results.append({**first, "source": source, "index": index, "query": query,
+                            "duplicate_of": f"{first['source']}#{first['index']}"})
+            if on_result is not None:
+                on_result(results[-1])
+
+    analyzed = [r for r in results if 'advice' in r]
+    high = sum(1 for r in analyzed for a in r['advice']['advice'] if a['priority'] == 'high')
+    baseline_statuses: Dict[str, int] = {}
+    for r in analyzed:
+        if 'baseline' in r and 'duplicate_of' not in r:
+            status = r['baseline']['status']
+            baseline_statuses[status] = baseline_statuses.get(status, 0) + 1
+    return {
+        "summary": {
+            "statements": len(results),
+            "analyzed": len(analyzed),
+            "unique": len(unique),
+            "skipped": sum(1 for r in results if 'skipped' in r),
+            "errors": sum(1 for r in results if 'error' in r),
+            "high_priority_flags": high,
+            "baseline_failures": sum(1 for r in analyzed if 'duplicate_of' not in r
+                                     and is_baseline_failure(args, r.get('baseline'))),
+            "baseline": baseline_statuses,
+            "workers": workers,
+            "duration": time.perf_counter() - started,
+        },
+        "metrics": cluster_metrics,
+        "locks": lock_metrics,
+        "results": results,
+        "fingerprints": summarize_fingerprints(results),
+    }
+
+
+def summarize_fingerprints(results: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Частота и худшая стоимость по формам запросов, самые частые — первыми.
+    """
+    groups: Dict[str, Dict[str, Any]] = {}
+    for r in results:
+        group = groups.setdefault(r['fingerprint'], {
+            "fingerprint": r['fingerprint'],
+            "normalized_query": r['normalized_query'],
+            "count": 0,
+            "worst_cost": None,
+            "worst": None,
+        })
+        group["count"] += 1
+        cost = (r.get('metrics') or {}).get('cost')
+        if cost is not None and (group["worst_cost"] is None or cost > group["worst_cost"]):
+            group["worst_cost"] = cost
+            group["worst"] = f"{r['source']}#{r['index']}"
+    return sorted(groups.values(), key=lambda g: (-g["count"], -(g["worst_cost"] or 0)))
+
+
+def render_batch_markdown(report: Dict[str, Any]) -> str:
+    summary = report['summary']
+    md = "## Summary\n"
+    for k, v in summary.items():
+        md += f"- {k}: {round(v, 3) if isinstance(v, float) else v}\n"
+    md += "\n## Queries\n"
+    md += "| Source | # | Status | High | Cost | Time, s |\n|---|---|---|---|---|---|\n"
+    for r in report['results']:
+        if 'error' in r:
+            status, high, cost = 'error', '-', '-'
+        elif 'skipped' in r:
+            status, high, cost = 'skipped', '-', '-'
+        else:
+            flags = r['advice']['advice']
+            status = 'ok'
+            high = sum(1 for a in flags if a['priority'] == 'high')
+            cost = r['metrics']['cost']
+        total = r.get('timings', {}).get('total')
+        md += f"| {r['source']} | {r['index']} | {status} | {high} | {cost} | {'-' if total is None else round(total, 3)} |\n"
+    regressions = [r for r in report['results'] if 'duplicate_of' not in r
+                   and (r.get('baseline') or {}).get('status') in ('regressed', 'changed')]
+    if regressions:
+        md += "\n## Baseline\n"
+        for r in regressions:
+            b = r['baseline']
+            details = '; '.join(b['reasons']) or 'изменилась форма плана'
+            md += f"- `{r['source']}#{r['index']}` {b['status']}: {details}\n"
+    md += "\n## Query shapes\n"
+    md += "| Fingerprint | Count | Worst cost | Query |\n|---|---|---|---|\n"
+    for g in report['fingerprints']:
+        md += f"| {g['fingerprint']} | {g['count']} | {'-' if g['worst_cost'] is None else g['worst_cost']} | `{g['normalized_query']}` |\n"
+    md += "\n## Advice\n"
+    for r in report['results']:
+        if 'duplicate_of' in r:
+            continue
+        for a in r.get('advice', {}).get('advice', ()):
+            md += f"- `{r['source']}#{r['index']}` {a['issue']} ({a['priority']}): {a['recommendation']}\n"
+        if 'error' in r:
+            md += f"- `{r['source']}#{r['index']}` ошибка: {r['error']}\n"
+    md += "\n## Metrics\n"
+    for k, v in report['metrics'].items():
+        md += f"- {k}: {v}\n"
+    md += "\n## Locks\n"
+    md += f"- Blocked: {report['locks']['lock_stats']['blocked_count']}\n"
+    return md
+
+
+def render_batch_log(report: Dict[str, Any]) -> str:
+    for r in report['results']:
+        where = f"{r['source']}#{r['index']}"
+        if 'error' in r:
+            print(f"[ERROR] {where}: {r['error']}")
+        elif 'skipped' in r:
+            print(f"[SKIP] {where}: {r['skipped']}")
+        elif 'duplicate_of' in r:
+            print(f"[DUP] {where}: см. {r['duplicate_of']}")
+        else:
+            for a in r['advice']['advice']:
+                print(f"[{a['priority'].upper()}] {where} {a['issue']}: {a['recommendation']}")
+            b = r.get('baseline')
+            if b and b['status'] in ('regressed', 'changed'):
+                print(f"[{b['status'].upper()}] {where}: {'; '.join(b['reasons']) or 'изменилась форма плана'}")
+    print("Summary:", report['summary'])
+    return ""
@@ -1,13 +1,23 @@
 import argparse
 import os
 import sys
-import psycopg2
 import json
 
-from adapters.stats import collect_all_metrics
+from adapters.pool import pooled_connection, pool_key, describe_key
+from adapters.stats import collect_all_metrics, get_stats_epoch
 from adapters.locks import collect_lock_metrics
 from services.advisor import advise_query
 from adapters.planner import get_explain_plan
+from services.plan_cache import make_cache_key, cached_analysis
+from services.serialization import json_default, dumps
+from instrumentation import Timings, collecting
+from services.profiler import profile_query, PROFILE_WARMUP
+from services.sqltext import split_statements, fingerprint_text, text_digest
+from services.baseline import BaselineStore, BASELINE_FILE, BASELINE_COST_THRESHOLD, BASELINE_ROWS_THRESHOLD
+from cli.batch import (
+    expand_paths, collect_statements, run_batch, render_batch_markdown, render_batch_log,
+    check_baseline, is_baseline_failure,
+)
 
 def parse_args():
     parser = argparse.ArgumentParser(description="PostgreSQL Query Guard")
@@ -18,10 +28,33 @@ def parse_args():
     parser.add_argument('--dbname', default=os.getenv('PGDATABASE', 'postgres'))
     parser.add_argument('--query', help='SQL query to analyze')
     parser.add_argument('--query-file', help='Path to file with SQL query')
-    parser.add_argument('--output', choices=['json', 'md', 'log'], default='json')
+    parser.add_argument('--output', choices=['json', 'ndjson', 'md', 'log'], default='json',
+                        help='ndjson: compact JSON lines; in batch mode results are streamed as they complete')
     parser.add_argument('--fail-on-high', action='store_true', help='Exit with error if high-priority flags found')
+    parser.add_argument('--no-cache', action='store_true', help='Bypass the plan/advice cache')
+    parser.add_argument('--path', action='append', default=[],
+                        help='SQL file, directory (*.sql, recursive) or glob; may be repeated (batch mode)')
+    parser.add_argument('--profile-runs', type=int, default=0,
+                        help='Measure the query with N EXPLAIN (ANALYZE, BUFFERS) runs, rolled back (single mode)')
+    parser.add_argument('--workers', type=int, default=int(os.getenv('GUARD_WORKERS', 4)),
+                        help='Parallel workers in batch mode')
+    parser.add_argument('--baseline', nargs='?', const=BASELINE_FILE,
+                        help=f'Compare plans with baselines per query fingerprint (default file: {BASELINE_FILE})')
+    parser.add_argument('--accept-baseline', action='store_true',
+                        help='Store current plans as the new baselines instead of comparing')
+    parser.add_argument('--cost-threshold', type=float, default=BASELINE_COST_THRESHOLD,
+                        help='Fail if root cost grows more than this many times over the baseline')
+    parser.add_argument('--rows-threshold', type=float, default=BASELINE_ROWS_THRESHOLD,
+                        help='Fail if root row estimate grows more than this many times over the baseline')
+    parser.add_argument('--fail-on-shape-change', action='store_true',
+                        help='Also fail if the plan shape changed without crossing the thresholds')
     return parser.parse_args()
 
+def open_baseline(args):
+    if not (args.baseline or args.accept_baseline):
+        return None
+    return BaselineStore(args.baseline or BASELINE_FILE)
+
 def read_query(args):
     if args.query:
         return args.query
@@ -34,36 +67,65 @@ def read_query(args):
 
 def main():
     args = parse_args()
+    baseline = open_baseline(args)
+    if args.path:
+        return main_batch(args, collect_statements(expand_paths(args.path)), baseline)
     query = read_query(args)
+    if args.query_file and len(split_statements(query)) > 1:
+        return main_batch(args, collect_statements([args.query_file]), baseline)
 
-    # Подключение к БД
-    conn = psycopg2.connect(
-        host=args.host, port=args.port,
-        user=args.user, password=args.password,
-        dbname=args.dbname
-    )
+    # Подключение к БД (через общий пул соединений); время этапов — в timings
+    timings = Timings('guard', describe_key(pool_key(args)))
+    with collecting(timings), timings.stage("total"), pooled_connection(args) as conn:
+        # Получение плана выполнения и анализ запроса (с кэшем по эпохе статистики)
+        def run_pipeline():
+            with timings.stage("plan"):
+                plan = get_explain_plan(conn, query)['Plan']
+            with timings.stage("advice"):
+                return {"plan": plan, "advice": advise_query(plan)}
 
-    # Получение плана выполнения
-    plan = get_explain_plan(conn, query)  # реализуй функцию, возвращающую dict из EXPLAIN (FORMAT JSON)
+        with timings.stage("stats_epoch"):
+            cache_key = make_cache_key(timings.target, query, get_stats_epoch(conn))
+        analysis, _ = cached_analysis(cache_key, run_pipeline, bypass=args.no_cache)
+        plan, advice = analysis['plan'], analysis['advice']
 
-    # Анализ запроса
-    advice = advise_query(plan)
+        # Сбор метрик
+        with timings.stage("metrics"):
+            metrics = collect_all_metrics(conn, args.dbname, plan=plan)
+        with timings.stage("locks"):
+            lock_metrics = collect_lock_metrics(conn)
 
-    # Сбор метрик
-    metrics = collect_all_metrics(conn, args.dbname, query)
-    lock_metrics = collect_lock_metrics(conn)
+        profile = None
+        if args.profile_runs > 0:
+            with timings.stage("profile"):
+                profile = profile_query(conn, query, runs=args.profile_runs, warmup=PROFILE_WARMUP)
+            root = profile.pop('plan')
+            metrics['actual_time'] = profile['execution_time']['p50']
+            metrics['actual_rows'] = root.get('Actual Rows')
 
     # Формирование результата
+    normalized = fingerprint_text(query)
     result = {
         "query": query,
+        "fingerprint": text_digest(normalized),
+        "normalized_query": normalized,
         "advice": advice,
         "metrics": metrics,
         "locks": lock_metrics,
     }
+    if profile is not None:
+        result["profile"] = profile
+    if baseline is not None:
+        result["baseline"] = check_baseline(args, baseline, result, plan)
+        if args.accept_baseline:
+            baseline.save()
+    result["timings"] = timings.as_dict()
 
     # Вывод
     if args.output == 'json':
-        print(json.dumps(result, indent=2, ensure_ascii=False))
+        print(json.dumps(result, indent=2, ensure_ascii=False, default=json_default))
+    elif args.output == 'ndjson':
+        print(dumps(result))
     elif args.output == 'md':
         print(render_markdown(result))
     else:
@@ -74,6 +136,42 @@ def main():
         high_flags = [a for a in advice['advice'] if a['priority'] == 'high']
         if high_flags:
             sys.exit(1)
+    if is_baseline_failure(args, result.get("baseline")):
+        sys.exit(1)
+    sys.exit(0)
+
+def main_batch(args, statements, baseline=None):
+    if not statements:
+        print("Error: No SQL statements found", file=sys.stderr)
+        sys.exit(2)
+
+    on_result = None
+    if args.output == 'ndjson':
+        # строка на оператор сразу по готовности, в конце — строка со сводкой
+        def on_result(result):
+            print(dumps(result), flush=True)
+
+    report = run_batch(args, statements, baseline, on_result=on_result)
+    if baseline is not None and baseline.dirty:
+        baseline.save()
+
+    if args.output == 'json':
+        print(json.dumps(report, indent=2, ensure_ascii=False, default=json_default))
+    elif args.output == 'ndjson':
+        print(dumps({k: v for k, v in report.items() if k != 'results'}))
+    elif args.output == 'md':
+        print(render_batch_markdown(report))
+    else:
+        print(render_batch_log(report))
+
+    # Коды возврата: ошибки анализа важнее найденных проблем
+    summary = report['summary']
+    if summary['errors']:
+        sys.exit(2)
+    if args.fail_on_high and summary['high_priority_flags']:
+        sys.exit(1)
+    if summary['baseline_failures']:
+        sys.exit(1)
     sys.exit(0)
 
 def render_markdown(result):
@@ -87,12 +185,41 @@ def render_markdown(result):
         md += f"- {k}: {v}\n"
     md += "\n## Locks\n"
     md += f"- Blocked: {result['locks']['lock_stats']['blocked_count']}\n"
+    if 'baseline' in result:
+        b = result['baseline']
+        md += f"\n## Baseline\n- Status: {b['status']}\n"
+        for reason in b['reasons']:
+            md += f"- {reason}\n"
+        if b.get('cost'):
+            md += f"- Cost: {b['cost']['baseline']} -> {b['cost']['current']}\n"
+    if 'profile' in result:
+        profile = result['profile']
+        md += f"\n## Profile ({profile['runs']} runs)\n"
+        md += f"- Execution time p50/p95, ms: {profile['execution_time']['p50']} / {profile['execution_time']['p95']}\n"
+        md += f"- Cold vs warm: {profile['cold_vs_warm']}\n"
+        md += "| Node | p50, ms | p95, ms | Self p50, ms | Hit | Read |\n|---|---|---|---|---|---|\n"
+        for n in profile['nodes']:
+            md += (f"| {'  ' * n['depth']}{n['node']} | {n['time_p50']} | {n['time_p95']} | "
+                   f"{n['self_time_p50']} | {n['shared_hit_p50']} | {n['shared_read_p50']} |\n")
+        cardinality = profile.get('cardinality') or {}
+        if cardinality.get('hotspots'):
+            md += "\n## Cardinality\n"
+            for h in cardinality['hotspots']:
+                md += f"- {h['label']}: estimated {h['estimated_rows']}, actual {h['actual_rows']} (q-error {h['q_error']:.1f})\n"
+            for a in cardinality['advice']:
+                md += f"- {a['issue']} ({a['priority']}): {a['recommendation']}"
+                md += f" `{a['fix_ddl']}`\n" if a['fix_ddl'] else "\n"
     return md
 
 def render_log(result):
     # Цветной лог (можно использовать colorama)
     for a in result['advice']['advice']:
         print(f"[{a['priority'].upper()}] {a['issue']}: {a['recommendation']}")
+    for a in (result.get('profile') or {}).get('cardinality', {}).get('advice', ()):
+        print(f"[{a['priority'].upper()}] {a['issue']}: {a['recommendation']}")
+    b = result.get('baseline')
+    if b:
+        print(f"[BASELINE {b['status'].upper()}]", '; '.join(b['reasons']))
     print("Metrics:", result['metrics'])
     print("Locks:", result['locks']['lock_stats'])
     return ""
@@ -0,0 +1,212 @@
+import math
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Awaitable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+# Границы корзин гистограмм длительности этапов, секунды
+STAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+Labels = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Labels, extra: str = '') -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf'
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Counter:
+    """
+    Счётчик Prometheus с метками.
+    """
+
+    def __init__(self, name: str, help_text: str, label_names: Sequence[str]):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(label_names)
+        self._values: Dict[Labels, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels: str, amount: float = 1.0):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self._lock:
+            items = sorted(self._values.items())
+        for labels, value in items:
+            lines.append(f'{self.name}{_format_labels(self.label_names, labels)} {_format_value(value)}')
+        return lines
+
+
+class Histogram:
+    """
+    Гистограмма Prometheus с метками: на каждый набор меток — счётчики по
+    корзинам (не накопительные, суммируются при выводе), сумма и число.
+    """
+
+    def __init__(self, name: str, help_text: str, label_names: Sequence[str], buckets: Sequence[float] = STAGE_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self._series: Dict[Labels, List[float]] = {}  # [по корзинам..., +Inf, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels: str):
+        k = 0
+        while k < len(self.buckets) and value > self.buckets[k]:
+            k += 1
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0.0] * (len(self.buckets) + 2)
+            series[k] += 1
+            series[-1] += value
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            items = sorted((labels, list(series)) for labels, series in self._series.items())
+        for labels, series in items:
+            cumulative = 0.0
+            for bound, count in zip(self.buckets + (math.inf,), series):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f'{self.name}_bucket{_format_labels(self.label_names, labels, le)} {_format_value(cumulative)}')
+            label_text = _format_labels(self.label_names, labels)
+            lines.append(f'{self.name}_sum{label_text} {_format_value(series[-1])}')
+            lines.append(f'{self.name}_count{label_text} {_format_value(cumulative)}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: List[Any] = []
+
+    def counter(self, name: str, help_text: str, label_names: Sequence[str]) -> Counter:
+        metric = Counter(name, help_text, label_names)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help_text: str, label_names: Sequence[str], buckets: Sequence[float] = STAGE_BUCKETS) -> Histogram:
+        metric = Histogram(name, help_text, label_names, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """
+        Все метрики в текстовом формате Prometheus (exposition format 0.0.4).
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+STAGE_SECONDS = registry.histogram(
+    'pgguard_stage_duration_seconds', 'Длительность этапа анализа', ('pipeline', 'stage', 'target'))
+STAGE_ERRORS = registry.counter(
+    'pgguard_stage_errors_total', 'Этапы анализа, завершившиеся ошибкой', ('pipeline', 'stage', 'target'))
+REQUESTS = registry.counter(
+    'pgguard_requests_total', 'Запросы анализа по результату кэша планов', ('pipeline', 'target', 'cache'))
+
+
+class Timings:
+    """
+    Разбивка времени одного анализа по этапам. Время этапа суммируется, если
+    этап выполнялся несколько раз (например, connect — на каждое соединение
+    из пула); каждое выполнение попадает в гистограмму с метками конвейера,
+    этапа и цели. Этапы могут идти параллельно в разных задачах и потоках.
+    """
+
+    def __init__(self, pipeline: str, target: str):
+        self.pipeline = pipeline
+        self.target = target
+        self.stages: Dict[str, float] = {}
+        self.calls: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def add(self, stage: str, seconds: float):
+        with self._lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+            self.calls[stage] = self.calls.get(stage, 0) + 1
+        STAGE_SECONDS.observe(seconds, self.pipeline, stage, self.target)
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            STAGE_ERRORS.inc(self.pipeline, name, self.target)
+            raise
+        finally:
+            self.add(name, time.perf_counter() - started)
+
+    async def timed(self, name: str, awaitable: Awaitable[Any]) -> Any:
+        """
+        Дождаться awaitable как этапа name (удобно для asyncio.gather).
+        """
+        with self.stage(name):
+            return await awaitable
+
+    def as_dict(self) -> Dict[str, float]:
+        """
+        Время этапов в секундах.
+        """
+        with self._lock:
+            return dict(self.stages)
+
+    def server_timing(self) -> str:
+        """
+        Значение заголовка Server-Timing (длительности в миллисекундах).
+        """
+        with self._lock:
+            items = list(self.stages.items())
+        return ', '.join(f'{name};dur={seconds * 1000:.1f}' for name, seconds in items)
+
+
+_current: ContextVar[Optional[Timings]] = ContextVar('pgguard_timings', default=None)
+
+
+@contextmanager
+def collecting(timings: Timings) -> Iterator[Timings]:
+    """
+    Сделать timings текущими: этапы, отмеченные через timed_stage глубже по
+    стеку (в том числе в задачах asyncio и asyncio.to_thread, которые
+    копируют контекст), попадут в них.
+    """
+    token = _current.set(timings)
+    try:
+        yield timings
+    finally:
+        _current.reset(token)
+
+
+@contextmanager
+def timed_stage(name: str) -> Iterator[None]:
+    """
+    Этап текущего анализа; вне collecting ничего не измеряет.
+    """
+    timings = _current.get()
+    if timings is None:
+        yield
+        return
+    with timings.stage(name):
+        yield
@@ -1,31 +1,61 @@
-from fastapi import FastAPI, Query, UploadFile, File, HTTPException, Body, Depends
+from fastapi import FastAPI, Query, UploadFile, File, HTTPException, Body, Depends, WebSocket, Request, Response
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-import psycopg2
-from adapters.stats import collect_all_metrics
-from adapters.locks import collect_lock_metrics
-from services.advisor import advise_query, compare_plans, extract_plan_metrics
+from fastapi.middleware.gzip import GZipMiddleware
+from pydantic import BaseModel, Field
+from fastapi.concurrency import run_in_threadpool
+from adapters.pool import pooled_connection, pool_stats, close_all_pools, pool_key, describe_key
+from adapters.aio import run_collector, close_all_async_pools, async_pool_stats
+from adapters.planner import get_explain_plan, get_explain_plan_async
+from adapters.stats import (
+    collect_metrics_snapshot, collect_metrics_snapshot_async,
+    get_stats_epoch, get_stats_epoch_async, plan_metrics,
+)
+from adapters.locks import collect_lock_metrics, collect_lock_metrics_async
+from adapters.dbinfo import dbinfo_cache, page_db_info
+from services.advisor import advise_query, plan_relations, compare_plans
+from services.plan_diff import diff_plans
 from metrics import METRIC_KEYS
 from services.detector import load_rules_from_yaml, Rule
+from services.history import get_history_store, migrate_json_history
+from services.plan_cache import plan_cache, make_cache_key, cached_analysis_async
+from services.whatif import evaluate_whatif
+from services.sqltext import fingerprint_text, text_digest
+from services.harvester import (
+    start_harvester, stop_harvester, harvester_status, stop_all_harvesters,
+    HARVEST_INTERVAL, HARVEST_TOP_N, HARVEST_MAX_PER_MINUTE, HARVEST_COOLDOWN,
+)
+from services.sampler import (
+    get_sampler, find_sampler, stop_sampler, sampler_status, stop_all_samplers, SAMPLER_INTERVAL, AGGREGATES,
+)
+from services.feedback import (
+    feedback_hub, ClientChannel, Subscription, OVERFLOW_POLICIES, red_flag_messages, progress_message,
+)
+from services.profiler import profile_query, PROFILE_RUNS, PROFILE_WARMUP, PROFILE_MAX_RUNS
+from services.index_advisor import index_advice_report, INDEX_ADVISOR_WORKLOAD, INDEX_ADVISOR_TOP, WORKLOAD_SOURCES
+from services.serialization import dumpb, NDJSON_MEDIA_TYPE
+from services.fleet import get_registry, collect_fleet, fleet_pool_stats, close_fleet_pools, FLEET_COLLECTORS, ROLES
+from instrumentation import Timings, collecting, registry, REQUESTS
+import asyncio
+import uuid
 import os
 import tempfile
 import shutil
-import json
 from typing import List, Optional
 from datetime import datetime
-from decimal import Decimal
-
-def convert_decimals(obj):
-    if isinstance(obj, dict):
-        return {k: convert_decimals(v) for k, v in obj.items()}
-    elif isinstance(obj, list):
-        return [convert_decimals(i) for i in obj]
-    elif isinstance(obj, Decimal):
-        return float(obj)
-    else:
-        return obj
 
-hacaton = FastAPI(title="PostgreSQL Query Guard API")
+# Ответы меньше этого размера (байт) не сжимаются
+GZIP_MIN_SIZE = int(os.getenv('GZIP_MIN_SIZE', 1024))
+
+class FastJSONResponse(JSONResponse):
+    """
+    Компактный JSON через services.serialization (orjson, если установлен):
+    Decimal, datetime и timedelta кодируются без промежуточной копии.
+    """
+    def render(self, content) -> bytes:
+        return dumpb(content)
+
+hacaton = FastAPI(title="PostgreSQL Query Guard API", default_response_class=FastJSONResponse)
 
 hacaton.add_middleware(
     CORSMiddleware,
@@ -34,6 +64,8 @@ hacaton.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# Сжатие по Accept-Encoding, в том числе потоковых ответов NDJSON
+hacaton.add_middleware(GZipMiddleware, minimum_size=GZIP_MIN_SIZE)
 
 HISTORY_FILE = "optimization_history.json"
 DEFAULT_CONNECTION_PARAMS = None
@@ -48,12 +80,33 @@ class DBConnectionParams(BaseModel):
 class QueryRequest(BaseModel):
     query: str
     connection: Optional[DBConnectionParams] = None
+    bypass_cache: bool = False
+    whatif: str = Field("auto", pattern="^(auto|hypothetical|real|off)$")
+    analysis_id: Optional[str] = None
+    profile: bool = False
+    profile_runs: int = Field(PROFILE_RUNS, ge=1, le=PROFILE_MAX_RUNS)
+    profile_warmup: int = Field(PROFILE_WARMUP, ge=0, le=PROFILE_MAX_RUNS)
 
 class CompareRequest(BaseModel):
     before_query: str
     after_query: str
     connection: DBConnectionParams
 
+class HarvesterRequest(BaseModel):
+    connection: Optional[DBConnectionParams] = None
+    interval: float = Field(HARVEST_INTERVAL, gt=0)
+    top_n: int = Field(HARVEST_TOP_N, ge=1)
+    max_per_minute: float = Field(HARVEST_MAX_PER_MINUTE, gt=0)
+    cooldown: float = Field(HARVEST_COOLDOWN, ge=0)
+
+class FleetTargetRequest(BaseModel):
+    name: str
+    dsn: Optional[str] = None
+    connection: Optional[DBConnectionParams] = None
+    role: str = Field("primary", pattern=f"^({'|'.join(ROLES)})$")
+    cluster: Optional[str] = None
+    timeout: Optional[float] = Field(None, gt=0)
+
 class HistoryRecord(BaseModel):
     date: str
     query: str
@@ -62,89 +115,83 @@ class HistoryRecord(BaseModel):
     before_metrics: Optional[dict] = None
     after_metrics: Optional[dict] = None
 
-def get_conn(params: DBConnectionParams):
-    return psycopg2.connect(
-        host=params.host,
-        port=params.port,
-        user=params.user,
-        password=params.password,
-        dbname=params.dbname
-    )
-
-def load_history() -> List[dict]:
-    if not os.path.exists(HISTORY_FILE):
-        return []
-    with open(HISTORY_FILE, "r", encoding="utf-8") as f:
-        content = f.read().strip()
-        if not content:
-            return []
-        return json.loads(content)
-
-def save_history(history: list):
-    with open(HISTORY_FILE, "w", encoding="utf-8") as f:
-        json.dump(convert_decimals(history), f, ensure_ascii=False, indent=2)
+@hacaton.on_event("startup")
+def migrate_legacy_history():
+    migrate_json_history(HISTORY_FILE, get_history_store())
 
 @hacaton.get("/history")
-def get_history():
-    return {"history": load_history()}
+def get_history(
+    request: Request,
+    cursor: Optional[int] = None,
+    limit: Optional[int] = Query(None, ge=1, le=1000),
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    table: Optional[str] = None,
+    issue: Optional[str] = None,
+    fingerprint: Optional[str] = None,
+    format: Optional[str] = Query(None, pattern="^(json|ndjson)$"),
+):
+    """
+    История анализов (от новых к старым) с фильтрами и курсорной пагинацией.
+    format=ndjson (или Accept: application/x-ndjson) — поток по записи на
+    строку, читается пачками и не собирается в памяти целиком; курсор
+    следующей страницы — id последней записи, если их пришло limit.
+    """
+    filters = dict(date_from=date_from, date_to=date_to, table=table, issue=issue, fingerprint=fingerprint)
+    if format == "ndjson" or (format is None and NDJSON_MEDIA_TYPE in request.headers.get("accept", "")):
+        lines = get_history_store().iter_lines(cursor=cursor, limit=limit, **filters)
+        return StreamingResponse(lines, media_type=NDJSON_MEDIA_TYPE)
+    records, next_cursor = get_history_store().page(cursor=cursor, limit=limit, **filters)
+    # готовый ответ минует jsonable_encoder — историю незачем копировать перед кодированием
+    return FastJSONResponse({"history": records, "next_cursor": next_cursor})
+
+@hacaton.get("/fingerprints")
+def get_fingerprints(
+    limit: Optional[int] = Query(50, ge=1, le=1000),
+    sort: str = Query("count", pattern="^(count|worst_cost|last_seen)$"),
+):
+    """
+    Формы запросов (отпечатки без литералов): сколько раз анализировались и худшая стоимость.
+    """
+    return {"fingerprints": get_history_store().fingerprints(limit=limit, sort=sort)}
 
 @hacaton.get("/dbinfo")
-def get_db_info():
+def get_db_info(
+    schema: Optional[str] = None,
+    sort: str = Query("size", pattern="^(size|name)$"),
+    order: str = Query("desc", pattern="^(asc|desc)$"),
+    offset: int = Query(0, ge=0),
+    limit: Optional[int] = Query(None, ge=1, le=5000),
+    refresh: bool = False,
+):
+    """
+    Информация о БД: таблицы всех схем (или одной schema) с размерами и индексами.
+    Снимок каталога кэшируется и обновляется в фоне; refresh=true — собрать заново.
+    """
     global DEFAULT_CONNECTION_PARAMS
     if DEFAULT_CONNECTION_PARAMS:
         params = DBConnectionParams(**DEFAULT_CONNECTION_PARAMS)
     else:
         params = DBConnectionParams()
-    conn = get_conn(params)
-    try:
-        with conn.cursor() as cur:
-            cur.execute("SELECT current_database();")
-            dbname = cur.fetchone()[0]
-            cur.execute("SELECT pg_database_size(current_database());")
-            dbsize = cur.fetchone()[0]
-            cur.execute("SELECT count(*) FROM information_schema.tables WHERE table_schema = 'public';")
-            tables_count = cur.fetchone()[0]
-            cur.execute("SELECT count(*) FROM pg_user;")
-            users_count = cur.fetchone()[0]
-            cur.execute("SELECT tablename FROM pg_tables WHERE schemaname = 'public';")
-            tables = [r[0] for r in cur.fetchall()]
-            tables_info = []
-            for tablename in tables:
-                cur.execute(f"SELECT pg_total_relation_size('public.\"{tablename}\"');")
-                tsize = cur.fetchone()[0]
-                cur.execute(f"SELECT indexname, indexdef FROM pg_indexes WHERE tablename = %s;", (tablename,))
-                indexes = [{"name": idx[0], "def": idx[1]} for idx in cur.fetchall()]
-                cur.execute("""
-                    SELECT last_vacuum, last_autovacuum, last_analyze, last_autoanalyze
-                    FROM pg_stat_user_tables WHERE relname = %s;
-                """, (tablename,))
-                stat = cur.fetchone()
-                last_update = max([d for d in stat if d is not None]) if stat else None
-                tables_info.append({
-                    "name": tablename,
-                    "size": tsize,
-                    "indexes": indexes,
-                    "last_update": last_update
-                })
-        return {
-            "dbname": dbname,
-            "dbsize": dbsize,
-            "tables_count": tables_count,
-            "users_count": users_count,
-            "tables": tables_info
-        }
-    finally:
-        conn.close()
+    snapshot = dbinfo_cache.get(params, force_refresh=refresh)
+    return {
+        **page_db_info(snapshot, schema=schema, sort=sort, descending=(order == "desc"),
+                       offset=offset, limit=limit),
+        "collected_at": snapshot["collected_at"],
+    }
 
 @hacaton.post("/history")
 def add_history(record: HistoryRecord):
-    history = load_history()
-    history.insert(0, record.dict())
-    save_history(history)
+    get_history_store().append(record.dict())
     return {"status": "ok", "record": record}
 
 @hacaton.post("/analyze")
-def analyze_query(req: QueryRequest):
+async def analyze_query(req: QueryRequest, response: Response):
+    """
+    Анализ запроса. Работа с БД асинхронная: план, метрики кластера и блокировки
+    собираются параллельно на отдельных соединениях, не занимая пул потоков.
+    Время этапов — в поле timings, заголовке Server-Timing и /metrics/prometheus.
+    """
     global DEFAULT_CONNECTION_PARAMS
     if req.connection:
         conn_params = req.connection
@@ -152,43 +199,141 @@ def analyze_query(req: QueryRequest):
         conn_params = DBConnectionParams(**DEFAULT_CONNECTION_PARAMS)
     else:
         conn_params = DBConnectionParams()
-    conn = get_conn(conn_params)
-    try:
-        plan = get_explain_plan(conn, req.query)
-        advice = advise_query(plan)
-        metrics = collect_all_metrics(conn, conn_params.dbname, req.query)
-        lock_metrics = collect_lock_metrics(conn)
-
-        for a in advice['advice']:
-            fix_ddl = a.get('fix_ddl')
-            if fix_ddl:
-                with conn.cursor() as cur:
-                    try:
-                        cur.execute("BEGIN;")
-                        cur.execute(fix_ddl)
-                        alt_plan = get_explain_plan(conn, req.query)
-                        cur.execute("ROLLBACK;")
-                        a['metrics_before'] = a['metrics']
-                        a['metrics_after'] = extract_plan_metrics(alt_plan)
-                        a['improvement'] = compare_plans(plan, alt_plan)['improvement']
-                    except Exception as e:
-                        a['metrics_after'] = None
-                        a['improvement'] = None
-                        a['error'] = str(e)
-
-        record = {
-            "date": datetime.utcnow().isoformat(),
-            "query": req.query,
-            "advice": advice['advice'],
-            "metrics": metrics,
-            "locks": lock_metrics,
-        }
-        history = load_history()
-        history.insert(0, record)
-        save_history(history)
-        return record
-    finally:
-        conn.close()
+    analysis_id = req.analysis_id or uuid.uuid4().hex
+    database = conn_params.dbname
+    timings = Timings('analyze', describe_key(pool_key(conn_params)))
+    with collecting(timings), timings.stage('total'):
+        record = await _analyze(req, conn_params, analysis_id, database, timings)
+    REQUESTS.inc('analyze', timings.target, record['plan_cache'])
+    record["timings"] = timings.as_dict()
+    response.headers["Server-Timing"] = timings.server_timing()
+    return record
+
+async def _analyze(req: QueryRequest, conn_params: DBConnectionParams, analysis_id: str, database: str,
+                   timings: Timings):
+
+    def progress(stage: str, **extra):
+        feedback_hub.publish(progress_message(analysis_id, database, stage, **extra))
+
+    async def run_pipeline():
+        plan = (await timings.timed("plan", run_collector(
+            conn_params, get_explain_plan_async, get_explain_plan, req.query)))['Plan']
+        progress("plan")
+        advice = await timings.timed("advice", asyncio.to_thread(advise_query, plan))
+        progress("advice", flags=len(advice['advice']))
+        whatif = await timings.timed("whatif", asyncio.to_thread(
+            evaluate_whatif, conn_params, None, req.query, plan, advice['advice'], req.whatif))
+        progress("whatif")
+        return {"plan": plan, "advice": advice['advice'], "whatif": whatif}
+
+    progress("started")
+
+    stats_epoch = await timings.timed("stats_epoch", run_collector(
+        conn_params, get_stats_epoch_async, get_stats_epoch))
+    cache_key = make_cache_key(timings.target, req.query, stats_epoch, variant=f"whatif={req.whatif}")
+    (analysis, cache_status), snapshot, lock_metrics = await asyncio.gather(
+        cached_analysis_async(cache_key, run_pipeline, bypass=req.bypass_cache),
+        timings.timed("metrics", run_collector(
+            conn_params, collect_metrics_snapshot_async, collect_metrics_snapshot,
+            conn_params.dbname, reuses_plan=True)),
+        timings.timed("locks", run_collector(conn_params, collect_lock_metrics_async, collect_lock_metrics)),
+    )
+    plan = analysis['plan']
+    metrics = {**snapshot['metrics'], **plan_metrics(plan)}
+
+    profile = None
+    if req.profile:
+        # Измерения не кэшируются: каждый раз реальные прогоны
+        def run_profile():
+            with pooled_connection(conn_params) as conn:
+                return profile_query(conn, req.query, runs=req.profile_runs, warmup=req.profile_warmup)
+        try:
+            profile = await timings.timed("profile", asyncio.to_thread(run_profile))
+        except Exception as e:
+            profile = {"error": str(e)}
+        else:
+            root = profile.pop('plan')
+            metrics["actual_time"] = profile['execution_time']['p50']
+            metrics["actual_rows"] = root.get('Actual Rows')
+        progress("profile")
+    advice = analysis['advice']
+    if profile is not None and profile.get('cardinality', {}).get('advice'):
+        advice = advice + profile['cardinality']['advice']
+    for message in red_flag_messages(advice, database, req.query, analysis_id):
+        feedback_hub.publish(message)
+    normalized = fingerprint_text(req.query)
+
+    record = {
+        "date": datetime.utcnow().isoformat(),
+        "query": req.query,
+        "fingerprint": text_digest(normalized),
+        "normalized_query": normalized,
+        "tables": plan_relations(plan),
+        "advice": advice,
+        "metrics": metrics,
+        "locks": lock_metrics,
+        "metrics_collection": {
+            "round_trips": snapshot['round_trips'],
+            "round_trips_saved": snapshot['round_trips_saved'],
+        },
+        "whatif": analysis['whatif'],
+        "plan_cache": cache_status,
+    }
+    if profile is not None:
+        record["profile"] = profile
+    with timings.stage("history"):
+        record["id"] = await run_in_threadpool(get_history_store().append, record)
+    record["analysis_id"] = analysis_id
+    progress("done", history_id=record["id"], plan_cache=cache_status)
+    return record
+
+@hacaton.get("/metrics/prometheus", response_class=PlainTextResponse)
+def prometheus_metrics():
+    """
+    Гистограммы длительности этапов анализа по целям и счётчики запросов
+    в текстовом формате Prometheus.
+    """
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@hacaton.post("/compare")
+async def compare_queries(req: CompareRequest, include_unchanged: bool = False):
+    """
+    Сравнить планы двух запросов: метрики корня и узел-за-узлом diff.
+    """
+    conn_params = req.connection
+    before, after = await asyncio.gather(
+        run_collector(conn_params, get_explain_plan_async, get_explain_plan, req.before_query),
+        run_collector(conn_params, get_explain_plan_async, get_explain_plan, req.after_query),
+    )
+    comparison = compare_plans(before['Plan'], after['Plan'])
+    comparison['diff'] = diff_plans(before['Plan'], after['Plan'], include_unchanged=include_unchanged)
+    return comparison
+
+@hacaton.websocket("/ws/feedback")
+async def feedback_socket(
+    websocket: WebSocket,
+    database: Optional[str] = None,
+    priority: Optional[str] = None,
+    types: Optional[str] = None,
+    policy: str = "drop_oldest",
+):
+    """
+    Поток обратной связи: red_flag и progress от /analyze. Темы задаются
+    параметрами database/priority/types (через запятую) и могут меняться
+    сообщением {"subscribe": {"databases": [...], "priorities": [...], "types": [...]}}.
+    Медленному клиенту сообщения не копятся бесконечно: policy=drop_oldest|drop_new.
+    """
+    split = lambda v: [x.strip() for x in v.split(',') if x.strip()] if v else None
+    if policy not in OVERFLOW_POLICIES:
+        await websocket.close(code=1008)
+        return
+    await websocket.accept()
+    channel = ClientChannel(Subscription(split(database), split(priority), split(types)), policy=policy)
+    await feedback_hub.serve(websocket, channel)
+
+@hacaton.get("/feedback/status")
+def get_feedback_status():
+    return feedback_hub.status()
 
 @hacaton.get("/metrics")
 def get_metrics():
@@ -197,6 +342,47 @@ def get_metrics():
     """
     return {"metrics": METRIC_KEYS}
 
+def _default_params() -> DBConnectionParams:
+    return DBConnectionParams(**(DEFAULT_CONNECTION_PARAMS or {}))
+
+@hacaton.get("/metrics/timeseries")
+def get_metrics_timeseries(
+    metrics: Optional[str] = Query(None, description="Через запятую; по умолчанию все"),
+    window: Optional[float] = Query(None, gt=0, description="Последние N секунд"),
+    points: Optional[int] = Query(None, ge=1, le=2000),
+    agg: str = Query("avg", pattern=f"^({'|'.join(AGGREGATES)})$"),
+):
+    """
+    Временные ряды метрик кластера из фонового сэмплера. Чтение сэмплер не
+    запускает (иначе опрос страницы отменял бы /metrics/sampler/stop): пока он
+    не запущен через /metrics/sampler/start — 404.
+    Накопительные счётчики отдаются как скорость в секунду.
+    """
+    sampler = find_sampler(_default_params())
+    if sampler is None:
+        raise HTTPException(status_code=404, detail="Сэмплер метрик не запущен: POST /metrics/sampler/start")
+    try:
+        return sampler.timeseries(
+            metrics=[m.strip() for m in metrics.split(',') if m.strip()] if metrics else None,
+            window=window, points=points, agg=agg,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@hacaton.post("/metrics/sampler/start")
+def metrics_sampler_start(interval: float = Query(SAMPLER_INTERVAL, gt=0)):
+    params = _default_params()
+    stop_sampler(params)
+    return get_sampler(params, interval=interval).status()
+
+@hacaton.post("/metrics/sampler/stop")
+def metrics_sampler_stop():
+    return {"status": "ok" if stop_sampler(_default_params()) else "not_running"}
+
+@hacaton.get("/metrics/sampler/status")
+def get_metrics_sampler_status():
+    return {"samplers": sampler_status()}
+
 @hacaton.post("/rules/upload")
 async def upload_rules(file: UploadFile = File(...)):
     """
@@ -214,47 +400,152 @@ async def upload_rules(file: UploadFile = File(...)):
         os.remove(tmp_path)
 
 @hacaton.get("/heatmap")
-def get_heatmap():
-    history = load_history()
-    issues = {}
-    by_table = {}
-    by_hour = {}
-    for rec in history:
-        advice_list = rec.get("advice", [])
-        dt = rec.get("date")
-        hour = None
-        if dt:
-            hour = dt[11:13]
-        for a in advice_list:
-            issue = a.get("issue")
-            table = a.get("metrics", {}).get("relation") or "unknown"
-            issues[issue] = issues.get(issue, 0) + 1
-            by_table[table] = by_table.get(table, 0) + 1
-            if hour:
-                by_hour[hour] = by_hour.get(hour, 0) + 1
-    return {
-        "issues": issues,
-        "by_table": by_table,
-        "by_hour": by_hour,
-    }
+def get_heatmap(window: Optional[str] = Query(None, description="1h, 24h или 7d; по умолчанию — за всё время")):
+    """
+    Тепловая карта проблем из счётчиков, которые обновляются при записи в историю.
+    """
+    try:
+        return {**get_history_store().heatmap(window), "window": window}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@hacaton.get("/indexes/advice")
+def get_index_advice(
+    source: str = Query("history", pattern=f"^({'|'.join(WORKLOAD_SOURCES)})$"),
+    limit: int = Query(INDEX_ADVISOR_WORKLOAD, ge=1, le=1000, description="Сколько операторов нагрузки разбирать"),
+    top: int = Query(INDEX_ADVISOR_TOP, ge=1, le=200),
+):
+    """
+    Рекомендации индексов по всей нагрузке (частые отпечатки истории или
+    pg_stat_statements) с учётом существующих индексов.
+    """
+    try:
+        with pooled_connection(_default_params()) as conn:
+            return index_advice_report(conn, source=source, limit=limit, top=top)
+    except RuntimeError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@hacaton.get("/cache/stats")
+def get_cache_stats():
+    """
+    Статистика кэша планов и рекомендаций.
+    """
+    return plan_cache.stats()
+
+@hacaton.delete("/cache")
+def clear_cache():
+    plan_cache.clear()
+    return {"status": "ok"}
+
+@hacaton.get("/pool/stats")
+def get_pool_stats():
+    """
+    Статистика пулов соединений по всем целям.
+    """
+    return {"pools": pool_stats(), "async_pools": async_pool_stats(), "fleet_pools": fleet_pool_stats()}
+
+@hacaton.post("/harvester/start")
+def harvester_start(req: HarvesterRequest):
+    """
+    Запустить фоновый сбор горячих запросов из pg_stat_statements.
+    """
+    params = req.connection or DBConnectionParams(**(DEFAULT_CONNECTION_PARAMS or {}))
+    harvester = start_harvester(params, interval=req.interval, top_n=req.top_n,
+                                max_per_minute=req.max_per_minute, cooldown=req.cooldown)
+    return harvester.status()
+
+@hacaton.post("/harvester/stop")
+def harvester_stop(connection: Optional[DBConnectionParams] = None):
+    params = connection or DBConnectionParams(**(DEFAULT_CONNECTION_PARAMS or {}))
+    return {"status": "ok" if stop_harvester(params) else "not_running"}
+
+@hacaton.get("/harvester/status")
+def get_harvester_status():
+    return {"harvesters": harvester_status()}
+
+@hacaton.get("/fleet/targets")
+def get_fleet_targets():
+    """
+    Зарегистрированные цели флота (без паролей).
+    """
+    return {"targets": get_registry().describe()}
+
+@hacaton.post("/fleet/targets")
+def add_fleet_target(req: FleetTargetRequest):
+    """
+    Добавить или заменить цель флота: DSN или параметры подключения, роль, кластер.
+    """
+    try:
+        get_registry().add(
+            req.name, dsn=req.dsn, params=req.connection.dict() if req.connection else None,
+            role=req.role, cluster=req.cluster, timeout=req.timeout,
+        )
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"status": "ok", "targets": get_registry().describe()}
+
+@hacaton.delete("/fleet/targets/{name}")
+def remove_fleet_target(name: str):
+    return {"status": "ok" if get_registry().remove(name) else "not_found"}
+
+async def _fleet(kinds, targets: Optional[str], cluster: Optional[str], timeout: Optional[float]):
+    names = [n.strip() for n in targets.split(',') if n.strip()] if targets else None
+    try:
+        return await collect_fleet(kinds, names=names, cluster=cluster, timeout=timeout)
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=f"Неизвестные цели: {e.args[0]}")
+
+@hacaton.get("/fleet/overview")
+async def get_fleet_overview(
+    collectors: Optional[str] = Query(None, description=f"Через запятую из {', '.join(FLEET_COLLECTORS)}; по умолчанию все"),
+    targets: Optional[str] = Query(None, description="Имена целей через запятую; по умолчанию все"),
+    cluster: Optional[str] = None,
+    timeout: Optional[float] = Query(None, gt=0, description="Таймаут на узел, с; по умолчанию — из цели"),
+):
+    """
+    Опрос всех узлов флота параллельно со сводкой по кластерам. Медленные
+    узлы не задерживают ответ дольше таймаута: результат частичный.
+    """
+    kinds = [k.strip() for k in collectors.split(',') if k.strip()] if collectors else FLEET_COLLECTORS
+    unknown = sorted(set(kinds) - set(FLEET_COLLECTORS))
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Неизвестные сборщики: {', '.join(unknown)}")
+    return await _fleet(kinds, targets, cluster, timeout)
+
+@hacaton.get("/fleet/metrics")
+async def get_fleet_metrics(targets: Optional[str] = None, cluster: Optional[str] = None,
+                            timeout: Optional[float] = Query(None, gt=0)):
+    return await _fleet(['metrics'], targets, cluster, timeout)
+
+@hacaton.get("/fleet/locks")
+async def get_fleet_locks(targets: Optional[str] = None, cluster: Optional[str] = None,
+                          timeout: Optional[float] = Query(None, gt=0)):
+    return await _fleet(['locks'], targets, cluster, timeout)
+
+@hacaton.get("/fleet/dbinfo")
+async def get_fleet_dbinfo(targets: Optional[str] = None, cluster: Optional[str] = None,
+                           timeout: Optional[float] = Query(None, gt=0)):
+    return await _fleet(['dbinfo'], targets, cluster, timeout)
+
+@hacaton.on_event("shutdown")
+async def shutdown_pools():
+    stop_all_harvesters()
+    stop_all_samplers()
+    close_all_pools()
+    await close_all_async_pools()
+    await close_fleet_pools()
 
 @hacaton.get("/health")
-def health():
+async def health():
     return {"status": "ok"}
 
 @hacaton.post("/check_connection")
 def check_connection(params: DBConnectionParams):
     global DEFAULT_CONNECTION_PARAMS
     try:
-        conn = get_conn(params)
-        conn.close()
+        with pooled_connection(params):
+            pass
         DEFAULT_CONNECTION_PARAMS = params.dict()
         return {"status": "ok", "message": "Соединение успешно"}
     except Exception as e:
         return {"status": "error", "message": str(e)}
-
-def get_explain_plan(conn, query: str) -> dict:
-    with conn.cursor() as cur:
-        cur.execute(f"EXPLAIN (FORMAT JSON) {query}")
-        plan = cur.fetchone()[0][0]['Plan']
-        return plan
\ No newline at end of file
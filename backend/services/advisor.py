@@ -1,12 +1,17 @@
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, List, Optional, Union
 from metrics import make_metrics_dict
-from services.detector import collect_flags, Rule
+from services.detector import collect_node_flags, Rule
+from services.plan_diff import diff_plans, diff_summary
+from services.plan_table import PlanTable, as_plan_table
+from services.predicates import parse_condition, parse_sort_key
 
 Plan = Dict[str, Any]
 Flag = Dict[str, Any]
 Advice = Dict[str, Any]
 
-def extract_plan_metrics(plan: Plan) -> Dict[str, Any]:
+def extract_plan_metrics(plan: Union[Plan, PlanTable]) -> Dict[str, Any]:
+    if isinstance(plan, PlanTable):
+        return plan.metrics(0)
     return make_metrics_dict(
         cost=plan.get('Total Cost', 0),
         rows=plan.get('Plan Rows', 0),
@@ -33,10 +38,12 @@ def extract_placeholders(plan: Plan) -> Dict[str, str]:
     for key in ['Index Cond', 'Filter', 'Hash Cond', 'Sort Key']:
         cond = plan.get(key)
         if cond:
-            import re
-            match = re.search(r'([a-zA-Z_][a-zA-Z0-9_]*)', str(cond))
-            if match:
-                column = match.group(1)
+            if isinstance(cond, list):
+                refs = [ref for ref, _ in parse_sort_key(cond)]
+            else:
+                refs = [p.column for p in parse_condition(str(cond))]
+            if refs:
+                column = refs[0][1]
                 break
     placeholders['column'] = column or 'col1'
     placeholders['join_column'] = column or 'col1'
@@ -47,38 +54,73 @@ def extract_placeholders(plan: Plan) -> Dict[str, str]:
 
     return placeholders
 
-def fill_fix_ddl(fix_ddl: Optional[str], plan: Plan) -> Optional[str]:
+def node_placeholders(table: PlanTable, i: int) -> Optional[Dict[str, str]]:
+    """
+    То же, что extract_placeholders, для узла таблицы плана: колонка
+    извлекается из условий один раз на узел, у соединений таблица берётся по
+    алиасу колонки. None — таблицу определить не удалось.
+    """
+    relation, column = table.column_ref(i)
+    relation = relation or table.nodes[i].get('relation')
+    if not relation:
+        return None
+    column = column or 'col1'
+    placeholders = {
+        'relation': relation,
+        'column': column,
+        'join_column': column,
+        'sort_column': column,
+    }
+    if table.node_type[i] is not None:
+        placeholders['node_type'] = table.node_type[i]
+    return placeholders
+
+def fill_fix_ddl(fix_ddl: Optional[str], plan: Plan, placeholders: Optional[Dict[str, str]] = None) -> Optional[str]:
     """
     Подставляет значения в fix_ddl из плана.
     """
     if not fix_ddl:
         return None
-    placeholders = extract_placeholders(plan)
+    if placeholders is None:
+        placeholders = extract_placeholders(plan)
     try:
         return fix_ddl.format(**placeholders)
     except Exception:
         # Если не удалось подставить — вернуть как есть
         return fix_ddl
 
-def generate_advice(plan: Plan, rules: Optional[List[Rule]] = None) -> List[Advice]:
-    flags = collect_flags(plan, rules)
-    metrics = extract_plan_metrics(plan)
+def generate_advice(plan: Union[Plan, PlanTable], rules: Optional[List[Rule]] = None) -> List[Advice]:
+    """
+    Рекомендации по флагам детектора. Метрики, подстановки в fix_ddl и
+    сведения об узле (node) берутся из того узла, на котором сработало правило.
+    """
+    table = as_plan_table(plan)
     advice_list = []
-    for flag in flags:
+    for i, flag in collect_node_flags(table, rules):
         fix_ddl = None
-        if 'fix_ddl' in flag:
-            fix_ddl = fill_fix_ddl(flag['fix_ddl'], plan)
+        placeholders = node_placeholders(table, i) if flag.get('fix_ddl') else None
+        if placeholders is not None:
+            # без известной таблицы DDL было бы нерабочим ("ON table")
+            fix_ddl = fill_fix_ddl(flag['fix_ddl'], table.nodes[i], placeholders)
         advice = {
             'issue': flag['type'],
             'recommendation': flag['recommendation'],
             'priority': flag['priority'],
-            'metrics': metrics,
+            'metrics': table.metrics(i),
+            'node': table.node_info(i),
             'fix_ddl': fix_ddl
         }
         advice_list.append(advice)
     return advice_list
 
-def compare_plans(before: Plan, after: Plan) -> Dict[str, Any]:
+def plan_relations(plan: Union[Plan, PlanTable]) -> List[str]:
+    """
+    Список отношений (таблиц), которые встречаются в плане, без повторов.
+    """
+    return as_plan_table(plan).relations()
+
+def compare_plans(before: Union[Plan, PlanTable], after: Union[Plan, PlanTable]) -> Dict[str, Any]:
+    before, after = as_plan_table(before), as_plan_table(after)
     before_metrics = extract_plan_metrics(before)
     after_metrics = extract_plan_metrics(after)
     improvement = make_metrics_dict(
@@ -90,13 +132,16 @@ def compare_plans(before: Plan, after: Plan) -> Dict[str, Any]:
         'before': before_metrics,
         'after': after_metrics,
         'improvement': improvement,
+        'diff': diff_summary(diff_plans(before, after)),
     }
 
 def advise_query(plan: Plan, alt_plan: Optional[Plan] = None) -> Dict[str, Any]:
-    advice = generate_advice(plan)
+    # план разворачивается в таблицу один раз и переиспользуется всеми этапами
+    table = as_plan_table(plan)
+    advice = generate_advice(table)
     comparison = None
     if alt_plan:
-        comparison = compare_plans(plan, alt_plan)
+        comparison = compare_plans(table, alt_plan)
     return {
         'advice': advice,
         'comparison': comparison,
@@ -0,0 +1,195 @@
+import json
+import os
+import threading
+from collections import Counter
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+from services.plan_diff import diff_plans, diff_summary
+from services.plan_table import PlanTable, as_plan_table
+from services.sqltext import text_digest
+
+Plan = Dict[str, Any]
+
+BASELINE_FILE = os.getenv('BASELINE_FILE', 'plan_baselines.json')
+# Регрессия: стоимость корня выросла больше чем в столько раз
+BASELINE_COST_THRESHOLD = float(os.getenv('BASELINE_COST_THRESHOLD', 1.5))
+# Регрессия: оценка числа строк корня выросла больше чем в столько раз
+BASELINE_ROWS_THRESHOLD = float(os.getenv('BASELINE_ROWS_THRESHOLD', 10))
+BASELINE_FORMAT_VERSION = 1
+
+# Поля узла, которые сохраняются в эталоне: всё, что нужно для diff, без
+# условий, Output и фактических значений
+BASELINE_NODE_KEYS = (
+    'Node Type', 'Parent Relationship', 'Join Type', 'Strategy', 'Relation Name', 'Alias',
+    'Index Name', 'CTE Name', 'Function Name', 'Subplan Name',
+    'Startup Cost', 'Total Cost', 'Plan Rows', 'Plan Width',
+)
+INDEX_SCAN_TYPES = frozenset({'Index Scan', 'Index Only Scan', 'Bitmap Heap Scan'})
+
+
+def compact_plan(plan: Plan) -> Plan:
+    """
+    Скелет плана для эталона: типы узлов, объекты и оценки.
+    """
+    node = {k: plan[k] for k in BASELINE_NODE_KEYS if k in plan}
+    if plan.get('Plans'):
+        node['Plans'] = [compact_plan(child) for child in plan['Plans']]
+    return node
+
+
+def plan_shape(plan: Union[Plan, PlanTable]) -> str:
+    """
+    Отпечаток формы плана: типы узлов, объекты, алиасы и вложенность, без
+    стоимостей. Совпадение отпечатков позволяет не строить diff.
+    """
+    table = as_plan_table(plan)
+    parts = []
+    for i in range(len(table)):
+        parts.append(f"{table.depth[i]}:{table.node_type[i]}:{table.object_name[i] or ''}:{table.alias[i] or ''}:"
+                      f"{table.nodes[i].get('Join Type') or ''}")
+    return text_digest('|'.join(parts))
+
+
+def _scan_counts(table: PlanTable) -> Tuple[Counter, Counter]:
+    """
+    Сколько раз каждое отношение читается индексным сканированием и Seq Scan.
+    """
+    index_scans, seq_scans = Counter(), Counter()
+    for i in range(len(table)):
+        relation = table.relation[i]
+        if relation is None:
+            continue
+        if table.node_type[i] in INDEX_SCAN_TYPES:
+            index_scans[relation] += 1
+        elif table.node_type[i] == 'Seq Scan':
+            seq_scans[relation] += 1
+    return index_scans, seq_scans
+
+
+def seq_scan_downgrades(before: Union[Plan, PlanTable], after: Union[Plan, PlanTable]) -> List[str]:
+    """
+    Отношения, которые в эталоне читались по индексу, а теперь — Seq Scan:
+    индексных чтений стало меньше, последовательных больше. Считается по
+    отношениям, а не по парам узлов diff: при смене Nested Loop на Hash Join
+    новый Seq Scan оказывается под узлом Hash, и выравнивание узлов его
+    со старым Index Scan не сопоставляет.
+    """
+    index_b, seq_b = _scan_counts(as_plan_table(before))
+    index_a, seq_a = _scan_counts(as_plan_table(after))
+    return [rel for rel in index_b if index_a[rel] < index_b[rel] and seq_a[rel] > seq_b[rel]]
+
+
+def _ratio(before: Optional[float], after: Optional[float]) -> Optional[float]:
+    if not before or after is None:
+        return None
+    return after / before
+
+
+def compare_with_baseline(
+    baseline: Optional[Dict[str, Any]],
+    plan: Union[Plan, PlanTable],
+    cost_threshold: float = BASELINE_COST_THRESHOLD,
+    rows_threshold: float = BASELINE_ROWS_THRESHOLD,
+) -> Dict[str, Any]:
+    """
+    Сравнение свежего плана с эталоном отпечатка. status:
+    - new — эталона нет;
+    - regressed — стоимость или оценка строк корня выросли больше порогов
+      либо таблица, которую читали по индексу, стала читаться Seq Scan;
+    - changed — форма плана изменилась без регрессии;
+    - improved — стоимость упала больше чем в cost_threshold раз;
+    - ok — без заметных изменений.
+    reasons — причины регрессии; diff — структурное сравнение, если форма
+    изменилась или есть регрессия.
+    """
+    if baseline is None:
+        return {'status': 'new', 'reasons': []}
+    table = as_plan_table(plan)
+    before = baseline['plan']
+    cost = {'baseline': before.get('Total Cost'), 'current': table.total_cost[0]}
+    cost['ratio'] = _ratio(cost['baseline'], cost['current'])
+    rows = {'baseline': before.get('Plan Rows'), 'current': table.plan_rows[0]}
+    rows['ratio'] = _ratio(rows['baseline'], rows['current'])
+    shape_changed = plan_shape(table) != baseline['shape']
+
+    reasons = []
+    if cost['ratio'] is not None and cost['ratio'] > cost_threshold:
+        reasons.append(f"стоимость выросла в {cost['ratio']:.2f} раза (порог {cost_threshold})")
+    if rows['ratio'] is not None and rows['ratio'] > rows_threshold:
+        reasons.append(f"оценка строк выросла в {rows['ratio']:.2f} раза (порог {rows_threshold})")
+    downgraded = seq_scan_downgrades(before, table) if shape_changed else []
+    for relation in downgraded:
+        reasons.append(f"{relation}: индексное сканирование сменилось на Seq Scan")
+
+    if reasons:
+        status = 'regressed'
+    elif shape_changed:
+        status = 'changed'
+    elif cost['ratio'] is not None and cost['ratio'] * cost_threshold < 1:
+        status = 'improved'
+    else:
+        status = 'ok'
+    result = {
+        'status': status,
+        'reasons': reasons,
+        'cost': cost,
+        'rows': rows,
+        'shape_changed': shape_changed,
+        'seq_scan_downgrades': downgraded,
+        'accepted_at': baseline.get('accepted_at'),
+    }
+    if shape_changed or reasons:
+        result['diff'] = diff_summary(diff_plans(before, table))
+    return result
+
+
+class BaselineStore:
+    """
+    Эталонные планы по отпечаткам запросов в JSON-файле (его удобно хранить
+    в репозитории рядом с миграциями). Файл читается один раз; save пишет
+    его атомарно, ключи отсортированы, чтобы diff в git был читаемым.
+    Потокобезопасен: пакетный режим сверяет и принимает планы из пула потоков.
+    """
+
+    def __init__(self, path: str = BASELINE_FILE):
+        self.path = path
+        self.baselines: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        self.dirty = False
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('version') != BASELINE_FORMAT_VERSION:
+                raise ValueError(f"Неподдерживаемая версия файла эталонов {path}: {data.get('version')}")
+            self.baselines = data['baselines']
+
+    def get(self, fingerprint: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            return self.baselines.get(fingerprint)
+
+    def accept(self, fingerprint: str, normalized_query: str, plan: Union[Plan, PlanTable], source: Optional[str] = None):
+        table = as_plan_table(plan)
+        entry = {
+            'normalized_query': normalized_query,
+            'shape': plan_shape(table),
+            'plan': compact_plan(table.nodes[0]),
+            'accepted_at': datetime.utcnow().isoformat(),
+            'source': source,
+        }
+        with self._lock:
+            self.baselines[fingerprint] = entry
+            self.dirty = True
+
+    def compare(self, fingerprint: str, plan: Union[Plan, PlanTable], **thresholds) -> Dict[str, Any]:
+        return compare_with_baseline(self.get(fingerprint), plan, **thresholds)
+
+    def save(self):
+        with self._lock:
+            data = {'version': BASELINE_FORMAT_VERSION, 'baselines': self.baselines}
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, indent=1, ensure_ascii=False, sort_keys=True)
+                f.write('\n')
+            os.replace(tmp_path, self.path)
+            self.dirty = False
@@ -0,0 +1,218 @@
+import math
+import os
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+from adapters.colstats import collect_cardinality_stats, extended_stats_covering
+from services.plan_table import PlanTable, as_plan_table
+
+Plan = Dict[str, Any]
+
+# Узел считается источником ошибки, если он сам вносит расхождение не меньше порога
+CARDINALITY_QERROR_THRESHOLD = float(os.getenv('CARDINALITY_QERROR_THRESHOLD', 10))
+CARDINALITY_TOP = int(os.getenv('CARDINALITY_TOP', 10))
+# Статистика отношения устарела, если с последнего ANALYZE изменено больше этой доли строк
+CARDINALITY_STALE_RATIO = float(os.getenv('CARDINALITY_STALE_RATIO', 0.1))
+# Предел для ALTER TABLE ... SET STATISTICS
+MAX_STATISTICS_TARGET = 10000
+
+# Условия, по которым ищутся колонки источника ошибки
+_SCAN_CONDITION_KEYS = ('Index Cond', 'Filter', 'Recheck Cond')
+_JOIN_CONDITION_KEYS = ('Hash Cond', 'Merge Cond', 'Join Filter')
+
+
+def node_estimates(table: PlanTable) -> List[Optional[Dict[str, Any]]]:
+    """
+    Ошибка оценки по узлам: q-error узла, сколько из неё внесено самим узлом
+    (q-error узла, делённая на наибольшую q-error выполненных детей) и на
+    сколько уровней вверх расхождение доходит, не опускаясь ниже порога.
+    None — узел без фактических значений.
+    """
+    n = len(table)
+    q = [table.row_estimate_error(i) for i in range(n)]
+    child_max = [1.0] * n
+    for i in range(n - 1, 0, -1):
+        parent = table.parent[i]
+        if q[i] is not None and q[i] > child_max[parent]:
+            child_max[parent] = q[i]
+    result: List[Optional[Dict[str, Any]]] = [None] * n
+    for i in range(n):
+        if q[i] is None:
+            continue
+        reach = 0
+        parent = table.parent[i]
+        while parent >= 0 and q[parent] is not None and q[parent] >= CARDINALITY_QERROR_THRESHOLD:
+            reach += 1
+            parent = table.parent[parent]
+        introduced = max(1.0, q[i] / child_max[i])
+        estimated, actual = table.plan_rows[i], table.actual_rows[i]
+        result[i] = {
+            'q_error': q[i],
+            'introduced': introduced,
+            'reach': reach,
+            'direction': 'under' if actual > estimated else 'over',
+            'estimated_rows': estimated,
+            'actual_rows': actual,
+            'loops': table.actual_loops[i],
+            'score': math.log10(introduced) * (1 + reach),
+        }
+    return result
+
+
+def _hotspot_columns(table: PlanTable, i: int) -> List[Tuple[str, str]]:
+    """
+    Колонки, по которым узел оценивал строки. Для соединения без своих
+    условий (Nested Loop) — условия сканирований-детей.
+    """
+    refs = table.column_refs(i, _SCAN_CONDITION_KEYS + _JOIN_CONDITION_KEYS)
+    if not refs and table.relation[i] is None:
+        for child in table.children(i):
+            refs.extend(table.column_refs(child, _SCAN_CONDITION_KEYS))
+    return [(rel, col) for rel, col in dict.fromkeys(refs) if rel]
+
+
+def find_hotspots(plan: Union[Plan, PlanTable], top: int = CARDINALITY_TOP) -> List[Dict[str, Any]]:
+    """
+    Узлы, в которых возникает ошибка оценки числа строк, по убыванию вклада:
+    log10(вносимой ошибки) × (1 + число затронутых ею предков).
+    """
+    table = as_plan_table(plan)
+    hotspots = []
+    for i, est in enumerate(node_estimates(table)):
+        if est is None or est['introduced'] < CARDINALITY_QERROR_THRESHOLD:
+            continue
+        hotspots.append({
+            'node': table.node_info(i),
+            'label': table.label(i),
+            'metrics': table.metrics(i),
+            **est,
+            'columns': [{'relation': rel, 'column': col} for rel, col in _hotspot_columns(table, i)],
+        })
+    hotspots.sort(key=lambda h: h['score'], reverse=True)
+    return hotspots[:top]
+
+
+def _is_stale(rel_stats: Dict[str, Any]) -> Optional[str]:
+    if rel_stats.get('last_analyze') is None:
+        return 'статистика не собиралась (ANALYZE не выполнялся)'
+    live = rel_stats.get('n_live_tup') or 0
+    modified = rel_stats.get('n_mod_since_analyze') or 0
+    if modified and modified >= CARDINALITY_STALE_RATIO * max(live, 1):
+        return f'с последнего ANALYZE изменено {modified} строк из {live}'
+    return None
+
+
+def _raised_target(current: Optional[int], default: Optional[int]) -> int:
+    base = current or default or 100
+    return min(MAX_STATISTICS_TARGET, max(base * 10, 1000))
+
+
+def _advice(issue: str, recommendation: str, priority: str, hotspot: Dict[str, Any], fix_ddl: str) -> Dict[str, Any]:
+    return {
+        'issue': issue,
+        'recommendation': recommendation,
+        'priority': priority,
+        'metrics': hotspot['metrics'],
+        'node': hotspot['node'],
+        'fix_ddl': fix_ddl,
+    }
+
+
+def recommend(hotspots: List[Dict[str, Any]], stats: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    Рекомендации по источникам ошибок: ANALYZE устаревших отношений,
+    расширенная статистика для нескольких колонок одного отношения в условии
+    сканирования, повышенная цель статистики для колонок с заполненными MCV
+    или гистограммой. Одно и то же действие рекомендуется один раз.
+    """
+    default_target = stats.get('default_statistics_target')
+    seen = set()
+    advice = []
+    for h in hotspots:
+        ratio = f"оценка {h['estimated_rows']:g} строк, факт {h['actual_rows']:g} (×{h['q_error']:.0f})"
+        by_relation: Dict[str, List[str]] = {}
+        for ref in h['columns']:
+            if (ref['relation'], ref['column']) in stats['columns']:
+                by_relation.setdefault(ref['relation'], []).append(ref['column'])
+        relations = list(by_relation) or [r for r in [h['node']['relation']] if r]
+
+        found = False
+        for rel in relations:
+            rel_stats = stats['relations'].get(rel)
+            if rel_stats is None:
+                continue
+            reason = _is_stale(rel_stats)
+            if reason:
+                # пока статистика устарела, остальные советы по отношению преждевременны
+                found = True
+                if ('analyze', rel) not in seen:
+                    seen.add(('analyze', rel))
+                    advice.append(_advice(
+                        'Устаревшая статистика',
+                        f"{h['label']}: {ratio}; у {rel} {reason}. Выполните ANALYZE.",
+                        'high', h, f"ANALYZE {rel};"))
+                continue
+
+            columns = by_relation.get(rel, [])
+            if len(columns) > 1 and h['node']['relation'] == rel and not extended_stats_covering(stats, rel, columns):
+                key = ('extended', rel, tuple(sorted(columns)))
+                if key not in seen:
+                    seen.add(key)
+                    found = True
+                    kinds = 'ndistinct, dependencies, mcv' if (stats.get('server_version') or 0) >= 120000 else 'ndistinct, dependencies'
+                    name = f"{rel}_{'_'.join(sorted(columns))}_stats"
+                    advice.append(_advice(
+                        'Коррелированные колонки',
+                        f"{h['label']}: {ratio}. Планировщик считает условия по {', '.join(columns)} независимыми — "
+                        f"создайте расширенную статистику.",
+                        'medium', h,
+                        f"CREATE STATISTICS IF NOT EXISTS {name} ({kinds}) ON {', '.join(sorted(columns))} FROM {rel}; ANALYZE {rel};"))
+                    continue
+
+            for col in columns:
+                col_stats = stats['columns'][(rel, col)]
+                target = col_stats['statistics_target'] or default_target
+                saturated = target and (
+                    (col_stats['mcv_entries'] or 0) >= target
+                    or (col_stats['histogram_buckets'] or 0) >= target + 1
+                )
+                if not saturated or ('target', rel, col) in seen:
+                    continue
+                seen.add(('target', rel, col))
+                found = True
+                new_target = _raised_target(col_stats['statistics_target'], default_target)
+                advice.append(_advice(
+                    'Мало статистики по колонке',
+                    f"{h['label']}: {ratio}. Списки MCV/гистограмма {rel}.{col} заполнены до цели {target} — "
+                    f"увеличьте цель статистики до {new_target}.",
+                    'medium', h,
+                    f"ALTER TABLE {rel} ALTER COLUMN {col} SET STATISTICS {new_target}; ANALYZE {rel};"))
+
+        if not found and ('note', h['node']['index']) not in seen:
+            seen.add(('note', h['node']['index']))
+            advice.append(_advice(
+                'Ошибка оценки числа строк',
+                f"{h['label']}: {ratio}. Статистика отношений свежая — причина, вероятно, в выражениях "
+                f"или корреляции между таблицами; проверьте условия узла.",
+                'low', h, None))
+    return advice
+
+
+def cardinality_report(conn, plan: Union[Plan, PlanTable], top: int = CARDINALITY_TOP) -> Dict[str, Any]:
+    """
+    Анализ ошибок оценки для плана EXPLAIN ANALYZE: источники ошибок,
+    статистика их отношений и колонок и рекомендации.
+    """
+    table = as_plan_table(plan)
+    hotspots = find_hotspots(table, top)
+    relations = {ref['relation'] for h in hotspots for ref in h['columns']}
+    relations |= {h['node']['relation'] for h in hotspots if h['node']['relation']}
+    columns = {(ref['relation'], ref['column']) for h in hotspots for ref in h['columns']}
+    stats = collect_cardinality_stats(conn, relations, columns) if hotspots else {
+        'relations': {}, 'columns': {}, 'extended': {}}
+    return {
+        'threshold': CARDINALITY_QERROR_THRESHOLD,
+        'hotspots': hotspots,
+        'relations': stats['relations'],
+        'columns': [{'relation': rel, 'column': col, **s} for (rel, col), s in stats['columns'].items()],
+        'advice': recommend(hotspots, stats),
+    }
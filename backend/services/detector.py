@@ -1,12 +1,16 @@
 from __future__ import annotations
 from dataclasses import dataclass
-from typing import Callable, Dict, List, Any, Iterable, Optional
+from typing import Callable, Dict, FrozenSet, List, Any, Iterable, Optional, Tuple, Union
 import os
+import threading
 import yaml
 
+from services.plan_table import PlanTable, as_plan_table
+
 Plan = Dict[str, Any]
 Flag = Dict[str, Any]
 Predicate = Callable[[Plan], bool]
+NodePredicate = Callable[[PlanTable, int], bool]
 Builder = Callable[[Plan], Flag]
 
 @dataclass(slots=True)
@@ -14,6 +18,71 @@ class Rule:
     name: str
     pred: Predicate
     build: Builder
+    node_types: Optional[FrozenSet[str]] = None  # None — правило для любого узла
+    node_pred: Optional[NodePredicate] = None  # проверка по строке таблицы узлов; без неё — pred(словарь узла)
+
+    def matches(self, table: PlanTable, i: int) -> bool:
+        if self.node_pred is not None:
+            return self.node_pred(table, i)
+        return self.pred(table.nodes[i])
+
+def row_estimate_error(plan: Plan) -> Optional[float]:
+    """
+    q-error оценки числа строк узла (см. PlanTable.row_estimate_error).
+    """
+    actual, loops = plan.get('Actual Rows'), plan.get('Actual Loops')
+    if actual is None or not loops:
+        return None
+    estimated = max(float(plan.get('Plan Rows') or 0), 1.0)
+    actual = max(float(actual), 1.0)
+    return max(estimated / actual, actual / estimated)
+
+def _match_node_types(match: Dict[str, Any]) -> Optional[FrozenSet[str]]:
+    node_types = None
+    if 'node_type' in match:
+        node_types = frozenset([match['node_type']])
+    if 'node_type_in' in match:
+        allowed = frozenset(match['node_type_in'])
+        node_types = allowed if node_types is None else node_types & allowed
+    return node_types
+
+# Поля узла, которые проверяют условия match, — для словаря узла и для
+# строки таблицы узлов. Семантика условий описана один раз в _matches.
+PLAN_FIELDS: Dict[str, Callable[..., Any]] = {
+    'node_type': lambda plan: plan.get('Node Type'),
+    'plan_rows': lambda plan: plan.get('Plan Rows', 0),
+    'total_cost': lambda plan: plan.get('Total Cost', 0),
+    'filter': lambda plan: plan.get('Filter'),
+    'row_misestimate': row_estimate_error,
+}
+TABLE_FIELDS: Dict[str, Callable[..., Any]] = {
+    'node_type': lambda table, i: table.node_type[i],
+    'plan_rows': lambda table, i: table.plan_rows[i],
+    'total_cost': lambda table, i: table.total_cost[i],
+    'filter': lambda table, i: table.condition(i, 'Filter'),
+    'row_misestimate': lambda table, i: table.row_estimate_error(i),
+}
+
+def _matches(match: Dict[str, Any], fields: Dict[str, Callable[..., Any]], *node) -> bool:
+    """
+    Проверка условий match правила; node — аргументы аксессоров fields
+    (словарь узла или таблица и номер строки).
+    """
+    if 'node_type' in match and fields['node_type'](*node) != match['node_type']:
+        return False
+    if 'node_type_in' in match and fields['node_type'](*node) not in match['node_type_in']:
+        return False
+    if 'plan_rows_gt' in match and fields['plan_rows'](*node) <= match['plan_rows_gt']:
+        return False
+    if 'total_cost_gt' in match and fields['total_cost'](*node) <= match['total_cost_gt']:
+        return False
+    if match.get('filter_absent') and fields['filter'](*node):
+        return False
+    if 'row_misestimate_gt' in match:
+        q_error = fields['row_misestimate'](*node)
+        if q_error is None or q_error <= match['row_misestimate_gt']:
+            return False
+    return True
 
 # ────────────────────────────────────────────────────────────────
 # 1.  Загрузка правил из YAML
@@ -25,17 +94,9 @@ def load_rules_from_yaml(path: str) -> List[Rule]:
     for r in raw_rules:
         match = r.get('match', {})
         def pred(plan, match=match):
-            if 'node_type' in match and plan.get('Node Type') != match['node_type']:
-                return False
-            if 'node_type_in' in match and plan.get('Node Type') not in match['node_type_in']:
-                return False
-            if 'plan_rows_gt' in match and plan.get('Plan Rows', 0) <= match['plan_rows_gt']:
-                return False
-            if 'total_cost_gt' in match and plan.get('Total Cost', 0) <= match['total_cost_gt']:
-                return False
-            if match.get('filter_absent') and plan.get('Filter'):
-                return False
-            return True
+            return _matches(match, PLAN_FIELDS, plan)
+        def node_pred(table, i, match=match):
+            return _matches(match, TABLE_FIELDS, table, i)
         def build(plan, r=r):
             rec = r['recommendation']
             # подстановка node_type если надо
@@ -44,36 +105,107 @@ def load_rules_from_yaml(path: str) -> List[Rule]:
             return {
                 'type': r['name'],
                 'recommendation': rec,
-                'priority': r['priority']
+                'priority': r['priority'],
+                'fix_ddl': r.get('fix_ddl'),
             }
-        rules.append(Rule(r['name'], pred, build))
+        rules.append(Rule(r['name'], pred, build, _match_node_types(match), node_pred))
     return rules
 
 # ────────────────────────────────────────────────────────────────
-# 2.  Загрузка всех правил (можно расширять)
+# 2.  Компиляция правил в таблицу диспетчеризации по Node Type
+
+class CompiledRules:
+    """
+    Правила, разложенные по типу узла: для каждого Node Type хранится
+    список подходящих правил (с сохранением исходного порядка), правила
+    без ограничения по типу узла применяются ко всем узлам.
+    """
+    __slots__ = ('rules', 'wildcard', 'by_node_type')
+
+    def __init__(self, rules: Iterable[Rule]):
+        self.rules = list(rules)
+        self.wildcard = [r for r in self.rules if r.node_types is None]
+        node_types = set()
+        for r in self.rules:
+            if r.node_types is not None:
+                node_types |= r.node_types
+        self.by_node_type = {
+            t: [r for r in self.rules if r.node_types is None or t in r.node_types]
+            for t in node_types
+        }
+
+    def for_node(self, plan: Plan) -> List[Rule]:
+        return self.by_node_type.get(plan.get('Node Type'), self.wildcard)
+
+    def for_node_type(self, node_type: Optional[str]) -> List[Rule]:
+        return self.by_node_type.get(node_type, self.wildcard)
+
+    def __iter__(self):
+        return iter(self.rules)
+
+    def __len__(self):
+        return len(self.rules)
+
+RuleSet = Union[CompiledRules, Iterable[Rule]]
+
+def compile_rules(rules: RuleSet) -> CompiledRules:
+    if isinstance(rules, CompiledRules):
+        return rules
+    return CompiledRules(rules)
+
+# ────────────────────────────────────────────────────────────────
+# 3.  Загрузка всех правил (один раз, с перезагрузкой при изменении файла)
+
+_BUILTIN_RULES_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '../rulesets/builtin.yaml'))
+_rules_cache: Dict[str, Tuple[Tuple[int, int], CompiledRules]] = {}
+_rules_cache_lock = threading.Lock()
+
+def get_compiled_rules(yaml_path: str = _BUILTIN_RULES_PATH) -> CompiledRules:
+    """
+    Скомпилированные правила из YAML. Файл перечитывается только если
+    изменились его mtime или размер.
+    """
+    st = os.stat(yaml_path)
+    version = (st.st_mtime_ns, st.st_size)
+    with _rules_cache_lock:
+        cached = _rules_cache.get(yaml_path)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+    compiled = CompiledRules(load_rules_from_yaml(yaml_path))
+    with _rules_cache_lock:
+        _rules_cache[yaml_path] = (version, compiled)
+    return compiled
 
 def get_all_rules() -> List[Rule]:
-    # путь до builtin.yaml
-    yaml_path = os.path.join(os.path.dirname(__file__), '../rulesets/builtin.yaml')
-    yaml_path = os.path.abspath(yaml_path)
-    rules = load_rules_from_yaml(yaml_path)
-    return rules
+    return get_compiled_rules().rules
 
 # ────────────────────────────────────────────────────────────────
-# 3.  Проверка одного плана
+# 4.  Проверка одного плана
 
-def detect_red_flags(plan: Plan, rules: Optional[Iterable[Rule]] = None) -> list[Flag]:
-    if rules is None:
-        rules = get_all_rules()
-    return [rule.build(plan) for rule in rules if rule.pred(plan)]
+def detect_red_flags(plan: Plan, rules: Optional[RuleSet] = None) -> list[Flag]:
+    compiled = get_compiled_rules() if rules is None else compile_rules(rules)
+    return [rule.build(plan) for rule in compiled.for_node(plan) if rule.pred(plan)]
 
 # ────────────────────────────────────────────────────────────────
-# 4.  Рекурсивный обход
+# 5.  Обход плана по таблице узлов
+
+def walk_table(table: PlanTable, rules: Optional[RuleSet] = None) -> Iterable[Tuple[int, Flag]]:
+    """
+    Флаги по узлам в порядке обхода в глубину: (номер узла в таблице, флаг).
+    """
+    compiled = get_compiled_rules() if rules is None else compile_rules(rules)
+    node_types = table.node_type
+    for i in range(len(table)):
+        for rule in compiled.for_node_type(node_types[i]):
+            if rule.matches(table, i):
+                yield i, rule.build(table.nodes[i])
+
+def walk_plan(plan: Union[Plan, PlanTable], rules: Optional[RuleSet] = None) -> Iterable[Flag]:
+    for _, flag in walk_table(as_plan_table(plan), rules):
+        yield flag
 
-def walk_plan(plan: Plan, rules: Optional[Iterable[Rule]] = None) -> Iterable[Flag]:
-    yield from detect_red_flags(plan, rules)
-    for sub in plan.get('Plans', ()):
-        yield from walk_plan(sub, rules)
+def collect_node_flags(plan: Union[Plan, PlanTable], rules: Optional[RuleSet] = None) -> list[Tuple[int, Flag]]:
+    return list(walk_table(as_plan_table(plan), rules))
 
-def collect_flags(plan: Plan, rules: Optional[Iterable[Rule]] = None) -> list[Flag]:
-    return list(walk_plan(plan, rules))
\ No newline at end of file
+def collect_flags(plan: Union[Plan, PlanTable], rules: Optional[RuleSet] = None) -> list[Flag]:
+    return list(walk_plan(plan, rules))
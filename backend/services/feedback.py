@@ -1,64 +1,218 @@
-import threading
-import queue
+import asyncio
+import itertools
 import json
 import logging
+import os
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional
 
-try:
-    import websockets
-    import asyncio
-except ImportError:
-    websockets = None
+from services.serialization import dumps
+
+# Сколько сообщений может ждать отправки одному клиенту
+FEEDBACK_QUEUE_SIZE = int(os.getenv('FEEDBACK_QUEUE_SIZE', 256))
+# Пакетирование: не больше FEEDBACK_BATCH_SIZE сообщений в кадре,
+# ожидание добора пакета — не дольше FEEDBACK_BATCH_DELAY секунд
+FEEDBACK_BATCH_SIZE = int(os.getenv('FEEDBACK_BATCH_SIZE', 50))
+FEEDBACK_BATCH_DELAY = float(os.getenv('FEEDBACK_BATCH_DELAY', 0.05))
+# Клиент, который не принял кадр за это время, считается зависшим и отключается
+FEEDBACK_SEND_TIMEOUT = float(os.getenv('FEEDBACK_SEND_TIMEOUT', 10))
+
+# drop_oldest — при переполнении выбрасывается самое старое сообщение;
+# drop_new — новое сообщение не ставится в очередь
+OVERFLOW_POLICIES = ('drop_oldest', 'drop_new')
+
+logger = logging.getLogger(__name__)
 
-# Очередь сообщений для обратной связи
-feedback_queue = queue.Queue()
 
 # 1. Логгер для CLI/CI
 def log_feedback(message: dict):
-    logging.warning(f"FEEDBACK: {json.dumps(message, ensure_ascii=False)}")
-
-# 2. WebSocket broadcaster (для фронта)
-class WebSocketFeedbackServer:
-    def __init__(self, host='localhost', port=8765):
-        self.host = host
-        self.port = port
-        self.clients = set()
-        self.loop = None
-
-    async def handler(self, websocket, path):
-        self.clients.add(websocket)
+    logging.warning(f"FEEDBACK: {dumps(message)}")
+
+
+class Subscription:
+    """
+    Темы, на которые подписан клиент. None — без фильтра по этому признаку.
+    Сообщения без поля database/priority проходят любой фильтр по нему.
+    """
+
+    def __init__(
+        self,
+        databases: Optional[Iterable[str]] = None,
+        priorities: Optional[Iterable[str]] = None,
+        types: Optional[Iterable[str]] = None,
+    ):
+        self.databases = set(databases) if databases else None
+        self.priorities = set(priorities) if priorities else None
+        self.types = set(types) if types else None
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'Subscription':
+        return cls(data.get('databases'), data.get('priorities'), data.get('types'))
+
+    def matches(self, message: Dict[str, Any]) -> bool:
+        for allowed, field in ((self.databases, 'database'), (self.priorities, 'priority'), (self.types, 'type')):
+            if allowed is not None and message.get(field) is not None and message[field] not in allowed:
+                return False
+        return True
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'databases': sorted(self.databases) if self.databases else None,
+            'priorities': sorted(self.priorities) if self.priorities else None,
+            'types': sorted(self.types) if self.types else None,
+        }
+
+
+class ClientChannel:
+    """
+    Очередь одного клиента: ограниченная по размеру, с политикой переполнения.
+    Сообщения с одинаковым coalesce_key (например, прогресс одного анализа)
+    не копятся — в очереди остаётся только последнее.
+    """
+
+    def __init__(self, subscription: Subscription, policy: str = 'drop_oldest', maxsize: int = FEEDBACK_QUEUE_SIZE):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Неизвестная политика: {policy}. Допустимо: {', '.join(OVERFLOW_POLICIES)}")
+        self.subscription = subscription
+        self.policy = policy
+        self.maxsize = maxsize
+        self._queue: 'OrderedDict[Any, Dict[str, Any]]' = OrderedDict()
+        self._seq = itertools.count()
+        self._ready = asyncio.Event()
+        self.stats = {'queued': 0, 'sent': 0, 'dropped': 0, 'coalesced': 0, 'batches': 0}
+
+    def offer(self, message: Dict[str, Any], force: bool = False):
+        if not force and not self.subscription.matches(message):
+            return
+        key = message.get('coalesce_key')
+        if key is not None and ('c', key) in self._queue:
+            # заменяем на месте: клиенту нужен только последний прогресс
+            self._queue[('c', key)] = message
+            self.stats['coalesced'] += 1
+            return
+        if len(self._queue) >= self.maxsize:
+            if self.policy == 'drop_new':
+                self.stats['dropped'] += 1
+                return
+            self._queue.popitem(last=False)
+            self.stats['dropped'] += 1
+        self._queue[('c', key) if key is not None else ('m', next(self._seq))] = message
+        self.stats['queued'] += 1
+        self._ready.set()
+
+    async def next_batch(self, size: int = FEEDBACK_BATCH_SIZE, delay: float = FEEDBACK_BATCH_DELAY) -> List[Dict[str, Any]]:
+        """
+        Дождаться хотя бы одного сообщения и забрать пакет (добирая до delay секунд).
+        """
+        while not self._queue:
+            self._ready.clear()
+            await self._ready.wait()
+        if len(self._queue) < size and delay > 0:
+            await asyncio.sleep(delay)
+        batch = []
+        while self._queue and len(batch) < size:
+            batch.append(self._queue.popitem(last=False)[1])
+        if not self._queue:
+            self._ready.clear()
+        self.stats['sent'] += len(batch)
+        self.stats['batches'] += 1
+        return batch
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            'policy': self.policy,
+            'pending': len(self._queue),
+            'subscription': self.subscription.to_dict(),
+            **self.stats,
+        }
+
+
+class FeedbackHub:
+    """
+    Рассылка обратной связи клиентам WebSocket в event loop приложения.
+    publish никогда не ждёт клиентов: сообщение раскладывается по их очередям,
+    а каждый клиент вычитывает свою очередь в собственной задаче, так что
+    медленный браузер влияет только на себя.
+    """
+
+    def __init__(self):
+        self.clients: Dict[int, ClientChannel] = {}
+        self._ids = itertools.count(1)
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def register(self, channel: ClientChannel) -> int:
+        self.loop = asyncio.get_running_loop()
+        client_id = next(self._ids)
+        self.clients[client_id] = channel
+        return client_id
+
+    def unregister(self, client_id: int):
+        self.clients.pop(client_id, None)
+
+    def publish(self, message: Dict[str, Any]):
+        """
+        Разослать сообщение (вызывать из event loop).
+        """
+        for channel in list(self.clients.values()):
+            channel.offer(message)
+
+    def publish_threadsafe(self, message: Dict[str, Any]):
+        """
+        Разослать сообщение из другого потока (CLI, фоновые задачи).
+        """
+        loop = self.loop
+        if loop is None or loop.is_closed() or not self.clients:
+            return
+        loop.call_soon_threadsafe(self.publish, message)
+
+    async def serve(self, websocket, channel: ClientChannel):
+        """
+        Обслуживать подключение starlette WebSocket: отправка пакетами из очереди
+        клиента и приём команд {"subscribe": {...}} для смены тем.
+        """
+        client_id = self.register(channel)
+        sender = asyncio.create_task(self._send_loop(websocket, channel))
         try:
             while True:
-                msg = await websocket.recv()
-                # Можно реализовать обратную связь от клиента
+                data = await websocket.receive_text()
+                try:
+                    command = json.loads(data)
+                except ValueError:
+                    continue
+                if isinstance(command, dict) and isinstance(command.get('subscribe'), dict):
+                    channel.subscription = Subscription.from_dict(command['subscribe'])
+                    # подтверждение идёт через очередь: отправляет только задача клиента
+                    channel.offer({'type': 'subscribed', **channel.subscription.to_dict()}, force=True)
+        except Exception:
+            pass  # клиент отключился
         finally:
-            self.clients.remove(websocket)
+            self.unregister(client_id)
+            sender.cancel()
 
-    async def broadcast(self, message: dict):
-        if self.clients:
-            await asyncio.wait([client.send(json.dumps(message, ensure_ascii=False)) for client in self.clients])
+    async def _send_loop(self, websocket, channel: ClientChannel):
+        try:
+            while True:
+                batch = await channel.next_batch()
+                frame = batch[0] if len(batch) == 1 else {'type': 'batch', 'messages': batch}
+                await asyncio.wait_for(
+                    websocket.send_text(dumps(frame)),
+                    FEEDBACK_SEND_TIMEOUT,
+                )
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.info("feedback client dropped: %s", e)
+            try:
+                await websocket.close()
+            except Exception:
+                pass
 
-    def start(self):
-        if not websockets:
-            print("websockets not installed")
-            return
-        self.loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(self.loop)
-        start_server = websockets.serve(self.handler, self.host, self.port)
-        self.loop.run_until_complete(start_server)
-        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+    def status(self) -> Dict[str, Any]:
+        return {'clients': [{'id': i, **c.status()} for i, c in list(self.clients.items())]}
 
-    def send(self, message: dict):
-        if self.loop:
-            asyncio.run_coroutine_threadsafe(self.broadcast(message), self.loop)
 
-# 3. Основная точка входа
-ws_server = None
+feedback_hub = FeedbackHub()
 
-def init_feedback_server():
-    global ws_server
-    if websockets:
-        ws_server = WebSocketFeedbackServer()
-        ws_server.start()
 
 def send_feedback(message: dict, level='info'):
     """
@@ -67,16 +221,37 @@ def send_feedback(message: dict, level='info'):
     # Логгер
     log_feedback(message)
     # WebSocket
-    if ws_server:
-        ws_server.send(message)
+    feedback_hub.publish_threadsafe(message)
     # Можно добавить email, telegram, etc.
 
-# 4. Пример использования
-if __name__ == "__main__":
-    init_feedback_server()
-    send_feedback({
-        "type": "red_flag",
-        "priority": "high",
-        "text": "Seq Scan на большой таблице! Рекомендуется создать индекс.",
-        "query": "SELECT * FROM big_table"
-    })
+
+def red_flag_messages(advice: Iterable[Dict[str, Any]], database: str, query: str, analysis_id: str) -> List[Dict[str, Any]]:
+    """
+    Сообщения red_flag по рекомендациям анализа.
+    """
+    return [
+        {
+            'type': 'red_flag',
+            'analysis_id': analysis_id,
+            'database': database,
+            'priority': a.get('priority'),
+            'issue': a.get('issue'),
+            'text': a.get('recommendation'),
+            'query': query,
+        }
+        for a in advice
+    ]
+
+
+def progress_message(analysis_id: str, database: str, stage: str, **extra) -> Dict[str, Any]:
+    """
+    Событие прогресса анализа; у клиента в очереди остаётся только последнее.
+    """
+    return {
+        'type': 'progress',
+        'analysis_id': analysis_id,
+        'database': database,
+        'stage': stage,
+        'coalesce_key': f'progress:{analysis_id}',
+        **extra,
+    }
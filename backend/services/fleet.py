@@ -0,0 +1,367 @@
+import asyncio
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional
+
+import yaml
+
+from adapters.aio import aio_available, open_async_pool
+from adapters.dbinfo import dbinfo_cache, page_db_info
+from adapters.locks import collect_lock_metrics, collect_lock_metrics_async
+from adapters.pool import ConnectionPool, PoolKey, describe_key, params_from_dsn, pool_key
+from adapters.stats import (
+    collect_metrics_snapshot, collect_metrics_snapshot_async, get_node_role, get_node_role_async,
+)
+
+# Таймаут сбора с одного узла, с
+FLEET_TIMEOUT = float(os.getenv('FLEET_TIMEOUT', 5))
+# Сколько узлов опрашивается одновременно
+FLEET_CONCURRENCY = int(os.getenv('FLEET_CONCURRENCY', 16))
+# Размер пула на узел: сборщики флота не должны занимать много соединений
+FLEET_POOL_MAX_SIZE = int(os.getenv('FLEET_POOL_MAX_SIZE', 2))
+# YAML- или JSON-файл с целями, загружается при первом обращении к реестру
+FLEET_TARGETS = os.getenv('FLEET_TARGETS')
+# Сколько самых больших таблиц узла отдавать в сводке dbinfo
+FLEET_DBINFO_TABLES = int(os.getenv('FLEET_DBINFO_TABLES', 10))
+
+ROLES = ('primary', 'replica')
+FLEET_COLLECTORS = ('metrics', 'locks', 'dbinfo')
+
+
+class TargetRegistry:
+    """
+    Именованные цели флота: параметры подключения, объявленная роль
+    (primary/replica), кластер и таймаут опроса. Потокобезопасен.
+    """
+
+    def __init__(self):
+        self._targets: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def add(
+        self,
+        name: str,
+        dsn: Optional[str] = None,
+        params: Optional[Dict[str, Any]] = None,
+        role: str = 'primary',
+        cluster: Optional[str] = None,
+        timeout: Optional[float] = None,
+    ) -> Dict[str, Any]:
+        """
+        Добавить или заменить цель. Подключение задаётся DSN или словарём
+        параметров; кластер по умолчанию — имя самой цели.
+        """
+        if role not in ROLES:
+            raise ValueError(f"Неизвестная роль {role!r}, ожидается одна из {', '.join(ROLES)}")
+        if (dsn is None) == (params is None):
+            raise ValueError(f"Цель {name}: нужен ровно один из dsn или params")
+        target = {
+            'name': name,
+            'role': role,
+            'cluster': cluster or name,
+            'timeout': timeout or FLEET_TIMEOUT,
+            'params': params_from_dsn(dsn) if dsn is not None else dict(params),
+        }
+        with self._lock:
+            self._targets[name] = target
+        return target
+
+    def remove(self, name: str) -> bool:
+        with self._lock:
+            return self._targets.pop(name, None) is not None
+
+    def get(self, name: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            return self._targets.get(name)
+
+    def select(self, names: Optional[Iterable[str]] = None, cluster: Optional[str] = None) -> List[Dict[str, Any]]:
+        """
+        Цели по именам (неизвестные имена — KeyError) и/или кластеру.
+        """
+        with self._lock:
+            if names:
+                missing = [n for n in names if n not in self._targets]
+                if missing:
+                    raise KeyError(', '.join(missing))
+                targets = [self._targets[n] for n in names]
+            else:
+                targets = sorted(self._targets.values(), key=lambda t: (t['cluster'], t['name']))
+        return [t for t in targets if cluster is None or t['cluster'] == cluster]
+
+    def describe(self) -> List[Dict[str, Any]]:
+        """
+        Цели без паролей.
+        """
+        return [
+            {k: t[k] for k in ('name', 'role', 'cluster', 'timeout')} | {'target': describe_key(pool_key(t['params']))}
+            for t in self.select()
+        ]
+
+    def load_file(self, path: str) -> int:
+        """
+        Загрузить цели из YAML/JSON: список или {targets: [...]}, элементы —
+        {name, dsn | params, role, cluster, timeout}. Возвращает число целей.
+        """
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f) if path.endswith('.json') else yaml.safe_load(f)
+        entries = data.get('targets', []) if isinstance(data, dict) else data or []
+        for entry in entries:
+            self.add(
+                entry['name'], dsn=entry.get('dsn'), params=entry.get('params'),
+                role=entry.get('role', 'primary'), cluster=entry.get('cluster'), timeout=entry.get('timeout'),
+            )
+        return len(entries)
+
+
+_registry: Optional[TargetRegistry] = None
+_registry_lock = threading.Lock()
+
+
+def get_registry() -> TargetRegistry:
+    """
+    Общий реестр целей; при первом обращении загружается FLEET_TARGETS.
+    """
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = TargetRegistry()
+            if FLEET_TARGETS:
+                _registry.load_file(FLEET_TARGETS)
+        return _registry
+
+
+# Пулы узлов флота — отдельный реестр размером FLEET_POOL_MAX_SIZE: цель флота
+# может совпадать с целью /analyze, и общий пул не должен получить этот лимит
+_pools: Dict[PoolKey, Any] = {}
+_apools: Dict[PoolKey, Any] = {}
+_pools_lock = threading.Lock()
+_apools_lock = asyncio.Lock()
+
+# statement_timeout на транзакцию сборщика; параметр передаётся значением
+# set_config, так как psycopg 3 связывает параметры на сервере, а SET их не принимает
+STATEMENT_TIMEOUT_SQL = "SELECT set_config('statement_timeout', %s, true)"
+
+
+def _statement_timeout(timeout: float) -> str:
+    return f"{max(int(timeout * 1000), 1)}ms"
+
+
+def _sync_pool(params) -> ConnectionPool:
+    key = pool_key(params)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = ConnectionPool(key, max_size=FLEET_POOL_MAX_SIZE)
+        return pool
+
+
+async def _async_pool(params):
+    key = pool_key(params)
+    pool = _apools.get(key)
+    if pool is not None:
+        return pool
+    async with _apools_lock:
+        pool = _apools.get(key)
+        if pool is None:
+            pool = _apools[key] = await open_async_pool(key, max_size=FLEET_POOL_MAX_SIZE)
+    return pool
+
+
+async def _ensure_pool(params):
+    """
+    Пул узла заводится до запуска сборщиков, чтобы недоступный узел
+    отсекался одной ошибкой connect.
+    """
+    if aio_available():
+        await _async_pool(params)
+    else:
+        _sync_pool(params)
+
+
+def _run_sync(params, sync_fn, timeout: float, args):
+    # транзакция сборщика откатывается при возврате соединения в пул
+    with _sync_pool(params).connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(STATEMENT_TIMEOUT_SQL, (_statement_timeout(timeout),))
+        return sync_fn(conn, *args)
+
+
+async def _collect(params, async_fn, sync_fn, timeout: float, *args):
+    """
+    Сборщик на соединении из пула флота с statement_timeout: поток или
+    запрос не должен висеть на медленном узле дольше, чем его ждут.
+    """
+    if aio_available():
+        pool = await _async_pool(params)
+        async with pool.connection() as aconn:
+            await aconn.execute(STATEMENT_TIMEOUT_SQL, (_statement_timeout(timeout),))
+            return await async_fn(aconn, *args)
+    return await asyncio.to_thread(_run_sync, params, sync_fn, timeout, args)
+
+
+def fleet_pool_stats() -> List[Dict[str, Any]]:
+    stats = [p.stats() for p in list(_pools.values())]
+    stats += [{'target': describe_key(key), **p.get_stats()} for key, p in list(_apools.items())]
+    return stats
+
+
+async def close_fleet_pools():
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close()
+    apools = list(_apools.values())
+    _apools.clear()
+    for pool in apools:
+        await pool.close()
+
+
+async def _metrics(params, timeout: float) -> Dict[str, Any]:
+    snapshot = await _collect(params, collect_metrics_snapshot_async, collect_metrics_snapshot, timeout,
+                              params.get('dbname'))
+    return snapshot['metrics']
+
+
+async def _locks(params, timeout: float) -> Dict[str, Any]:
+    return await _collect(params, collect_lock_metrics_async, collect_lock_metrics, timeout)
+
+
+async def _dbinfo(params, timeout: float) -> Dict[str, Any]:
+    snapshot = await asyncio.to_thread(dbinfo_cache.get, params)
+    return {**page_db_info(snapshot, limit=FLEET_DBINFO_TABLES), 'collected_at': snapshot['collected_at']}
+
+
+_COLLECTORS = {'metrics': _metrics, 'locks': _locks, 'dbinfo': _dbinfo}
+
+
+def _error(e: BaseException) -> str:
+    if isinstance(e, asyncio.TimeoutError):
+        return 'timeout'
+    return f"{type(e).__name__}: {e}"
+
+
+async def collect_target(target: Dict[str, Any], kinds: Iterable[str], timeout: Optional[float] = None) -> Dict[str, Any]:
+    """
+    Опросить один узел: роль и выбранные сборщики параллельно, каждый не
+    дольше таймаута цели. Ошибки не пробрасываются — они попадают в errors,
+    а status становится partial (часть данных есть), timeout или error.
+    """
+    kinds = list(kinds)
+    timeout = timeout or target['timeout']
+    params = target['params']
+    started = time.monotonic()
+    result: Dict[str, Any] = {
+        'name': target['name'],
+        'cluster': target['cluster'],
+        'declared_role': target['role'],
+        'target': describe_key(pool_key(params)),
+    }
+    errors: Dict[str, str] = {}
+    try:
+        await asyncio.wait_for(_ensure_pool(params), timeout)
+    except Exception as e:
+        errors['connect'] = _error(e)
+        kinds = []
+    else:
+        jobs = {'role': _collect(params, get_node_role_async, get_node_role, timeout)}
+        jobs.update({kind: _COLLECTORS[kind](params, timeout) for kind in kinds})
+        done = await asyncio.gather(
+            *(asyncio.wait_for(job, timeout) for job in jobs.values()), return_exceptions=True,
+        )
+        for kind, value in zip(jobs, done):
+            if isinstance(value, BaseException):
+                errors[kind] = _error(value)
+            else:
+                result[kind] = value
+
+    node = result.get('role')
+    if node is not None:
+        result['role_mismatch'] = node['role'] != target['role']
+    expected = 1 + len(kinds)
+    if not errors:
+        status = 'ok'
+    elif len(errors) < expected:
+        status = 'partial'
+    elif all(e == 'timeout' for e in errors.values()):
+        status = 'timeout'
+    else:
+        status = 'error'
+    result.update(status=status, errors=errors, elapsed=time.monotonic() - started)
+    return result
+
+
+def _cluster_summary(nodes: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Сводка кластера по ответившим узлам: роли, худшие отставание и попадание
+    в кэш, суммарные соединения и ожидающие блокировок процессы.
+    """
+    summary: Dict[str, Any] = {
+        'primaries': [], 'replicas': [], 'unreachable': [], 'role_mismatch': [],
+        'max_replication_lag': None, 'max_replay_delay': None,
+        'min_cache_hit_ratio': None, 'active_connections': 0, 'blocked': 0, 'deadlocks': 0,
+    }
+
+    def worst(field, value, pick):
+        if value is not None:
+            summary[field] = value if summary[field] is None else pick(summary[field], value)
+
+    for node in nodes:
+        role = node.get('role')
+        if role is None:
+            summary['unreachable'].append(node['name'])
+            continue
+        summary['primaries' if role['role'] == 'primary' else 'replicas'].append(node['name'])
+        if node.get('role_mismatch'):
+            summary['role_mismatch'].append(node['name'])
+        worst('max_replay_delay', role['replay_delay'], max)
+        metrics = node.get('metrics')
+        if metrics:
+            worst('max_replication_lag', metrics.get('replication_lag'), max)
+            worst('min_cache_hit_ratio', metrics.get('cache_hit_ratio'), min)
+            summary['active_connections'] += metrics.get('active_connections') or 0
+        locks = node.get('locks')
+        if locks:
+            summary['blocked'] += locks['lock_stats_all']['blocked_count']
+            summary['deadlocks'] += len(locks.get('deadlocks') or [])
+    return summary
+
+
+async def collect_fleet(
+    kinds: Iterable[str] = FLEET_COLLECTORS,
+    names: Optional[Iterable[str]] = None,
+    cluster: Optional[str] = None,
+    timeout: Optional[float] = None,
+    registry: Optional[TargetRegistry] = None,
+) -> Dict[str, Any]:
+    """
+    Опросить узлы флота параллельно (не больше FLEET_CONCURRENCY сразу).
+    Медленные и недоступные узлы не задерживают ответ дольше своего таймаута
+    и не роняют его: результат частичный, их ошибки — в nodes[].errors.
+    """
+    kinds = [k for k in kinds if k in _COLLECTORS]
+    targets = (registry or get_registry()).select(names, cluster)
+    semaphore = asyncio.Semaphore(FLEET_CONCURRENCY)
+
+    async def one(target):
+        async with semaphore:
+            return await collect_target(target, kinds, timeout)
+
+    started = time.monotonic()
+    nodes = await asyncio.gather(*(one(t) for t in targets))
+    clusters: Dict[str, List[Dict[str, Any]]] = {}
+    for node in nodes:
+        clusters.setdefault(node['cluster'], []).append(node)
+    statuses: Dict[str, int] = {}
+    for node in nodes:
+        statuses[node['status']] = statuses.get(node['status'], 0) + 1
+    return {
+        'collectors': kinds,
+        'partial': any(n['status'] != 'ok' for n in nodes),
+        'statuses': statuses,
+        'elapsed': time.monotonic() - started,
+        'clusters': {name: _cluster_summary(members) for name, members in sorted(clusters.items())},
+        'nodes': nodes,
+    }
@@ -0,0 +1,321 @@
+import argparse
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from adapters.planner import get_explain_plan
+from adapters.pool import pooled_connection, pool_key, describe_key, PoolKey
+from adapters.statements import collect_statement_stats, has_pg_stat_statements
+from adapters.stats import get_server_capabilities, get_stats_epoch, plan_metrics
+from services.advisor import advise_query, plan_relations
+from services.history import HistoryStore, get_history_store
+from services.serialization import dumps
+from services.plan_cache import make_cache_key, cached_analysis
+from services.sqltext import fingerprint_text, has_parameters, is_explainable, text_digest
+
+HARVEST_INTERVAL = float(os.getenv('HARVEST_INTERVAL', 60))
+HARVEST_TOP_N = int(os.getenv('HARVEST_TOP_N', 10))
+HARVEST_MAX_PER_MINUTE = float(os.getenv('HARVEST_MAX_PER_MINUTE', 6))
+HARVEST_COOLDOWN = float(os.getenv('HARVEST_COOLDOWN', 3600))
+
+# Метрики, по которым отбираются «горячие» операторы
+HOT_METRICS = ('total_time', 'mean_time', 'io_blocks')
+
+# EXPLAIN (GENERIC_PLAN) появился в PostgreSQL 16
+GENERIC_PLAN_MIN_VERSION = 160000
+
+
+def diff_samples(previous: Dict[int, Dict[str, Any]], current: Dict[int, Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Приращения счётчиков между двумя снимками pg_stat_statements. Оператор,
+    которого не было в предыдущем снимке или чьи счётчики уменьшились
+    (pg_stat_statements_reset), считается с нуля.
+    """
+    deltas = []
+    for queryid, row in current.items():
+        old = previous.get(queryid)
+        if old is not None and row['calls'] < old['calls']:
+            old = None
+        base = old or {'calls': 0, 'total_time': 0.0, 'rows': 0, 'io_blocks': 0}
+        calls = row['calls'] - base['calls']
+        if calls <= 0:
+            continue
+        total_time = row['total_time'] - base['total_time']
+        deltas.append({
+            'queryid': queryid,
+            'query': row['query'],
+            'calls': calls,
+            'total_time': total_time,
+            'mean_time': total_time / calls,
+            'rows': row['rows'] - base['rows'],
+            'io_blocks': row['io_blocks'] - base['io_blocks'],
+            'new': queryid not in previous,
+        })
+    return deltas
+
+
+def rank_hot(deltas: List[Dict[str, Any]], top_n: int = HARVEST_TOP_N) -> List[Dict[str, Any]]:
+    """
+    Объединение top-N по каждой из HOT_METRICS; reasons — по каким метрикам оператор попал в выборку.
+    """
+    selected: Dict[int, Dict[str, Any]] = {}
+    for metric in HOT_METRICS:
+        for d in sorted(deltas, key=lambda d: d[metric], reverse=True)[:top_n]:
+            if d[metric] <= 0:
+                break
+            selected.setdefault(d['queryid'], {**d, 'reasons': []})['reasons'].append(metric)
+    return sorted(selected.values(), key=lambda d: d['total_time'], reverse=True)
+
+
+class RateLimiter:
+    """
+    Token bucket: не больше per_minute анализов в минуту, с запасом на всплеск в ту же величину.
+    """
+
+    def __init__(self, per_minute: float = HARVEST_MAX_PER_MINUTE):
+        self.rate = per_minute / 60.0
+        self.capacity = max(1.0, per_minute)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def try_acquire(self) -> bool:
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+class Harvester:
+    """
+    Периодически снимает pg_stat_statements цели, находит операторы, ставшие
+    горячими за интервал (по суммарному и среднему времени и вводу-выводу),
+    и прогоняет их через get_explain_plan -> advise_query с ограничением
+    частоты. Результаты пишутся в историю с source='harvester'.
+
+    Оператор повторно анализируется не чаще раза в cooldown секунд, так что
+    долго остающиеся горячими запросы перепроверяются на регрессии.
+    """
+
+    def __init__(
+        self,
+        params,
+        interval: float = HARVEST_INTERVAL,
+        top_n: int = HARVEST_TOP_N,
+        max_per_minute: float = HARVEST_MAX_PER_MINUTE,
+        cooldown: float = HARVEST_COOLDOWN,
+        store: Optional[HistoryStore] = None,
+    ):
+        self.params = params
+        self.target = describe_key(pool_key(params))
+        self.interval = interval
+        self.top_n = top_n
+        self.cooldown = cooldown
+        self.limiter = RateLimiter(max_per_minute)
+        self.store = store or get_history_store()
+        self._previous: Dict[int, Dict[str, Any]] = {}
+        self._previous_hot: set = set()
+        self._analyzed_at: Dict[int, float] = {}
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._status: Dict[str, Any] = {
+            'cycles': 0,
+            'analyzed': 0,
+            'last_cycle': None,
+            'last_error': None,
+        }
+
+    def run_once(self) -> Dict[str, Any]:
+        """
+        Один цикл: снимок, разница с предыдущим, анализ новых горячих операторов.
+        Первый цикл сравнивает с нулём, т.е. берёт накопленные с момента сброса счётчики.
+        """
+        started = time.perf_counter()
+        with pooled_connection(self.params) as conn:
+            if not has_pg_stat_statements(conn):
+                raise RuntimeError("Расширение pg_stat_statements не установлено в целевой БД")
+            server_version = get_server_capabilities(conn)['server_version']
+            current = collect_statement_stats(conn)
+            stats_epoch = get_stats_epoch(conn)
+
+            hot = rank_hot(diff_samples(self._previous, current), self.top_n)
+            records, skipped = [], []
+            now = time.monotonic()
+            for entry in hot:
+                entry['entered_top'] = entry['queryid'] not in self._previous_hot
+                analyzed_at = self._analyzed_at.get(entry['queryid'])
+                if analyzed_at is not None and now - analyzed_at < self.cooldown:
+                    continue
+                reason = self._skip_reason(entry['query'], server_version)
+                if reason is None and not self.limiter.try_acquire():
+                    reason = 'rate_limited'
+                if reason is not None:
+                    skipped.append({'queryid': entry['queryid'], 'reason': reason})
+                    continue
+                try:
+                    records.append(self._analyze(conn, entry, stats_epoch))
+                except Exception as e:
+                    conn.rollback()
+                    skipped.append({'queryid': entry['queryid'], 'reason': 'error', 'error': str(e)})
+                self._analyzed_at[entry['queryid']] = now
+
+        self._previous = current
+        self._previous_hot = {entry['queryid'] for entry in hot}
+        ids = self.store.append_many(records) if records else []
+        summary = {
+            'target': self.target,
+            'date': datetime.utcnow().isoformat(),
+            'statements': len(current),
+            'hot': len(hot),
+            'analyzed': len(records),
+            'history_ids': ids,
+            'skipped': skipped,
+            'duration': time.perf_counter() - started,
+        }
+        self._status['cycles'] += 1
+        self._status['analyzed'] += len(records)
+        self._status['last_cycle'] = summary
+        return summary
+
+    @staticmethod
+    def _skip_reason(query: str, server_version: int) -> Optional[str]:
+        if not is_explainable(query):
+            return 'not_explainable'
+        if has_parameters(query) and server_version < GENERIC_PLAN_MIN_VERSION:
+            return 'parameters_require_pg16'
+        return None
+
+    def _analyze(self, conn, entry: Dict[str, Any], stats_epoch: str) -> Dict[str, Any]:
+        query = entry['query']
+
+        def run_pipeline():
+            plan = get_explain_plan(conn, query, generic_plan=has_parameters(query))['Plan']
+            return {"plan": plan, "advice": advise_query(plan)['advice']}
+
+        cache_key = make_cache_key(self.target, query, stats_epoch, variant='generic')
+        analysis, cache_status = cached_analysis(cache_key, run_pipeline)
+        plan = analysis['plan']
+        normalized = fingerprint_text(query)
+        return {
+            "date": datetime.utcnow().isoformat(),
+            "query": query,
+            "fingerprint": text_digest(normalized),
+            "normalized_query": normalized,
+            "tables": plan_relations(plan),
+            "advice": analysis['advice'],
+            "metrics": plan_metrics(plan),
+            "source": "harvester",
+            "harvest": {k: entry[k] for k in (
+                'queryid', 'calls', 'total_time', 'mean_time', 'rows', 'io_blocks',
+                'reasons', 'new', 'entered_top')},
+            "plan_cache": cache_status,
+        }
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+                self._status['last_error'] = None
+            except Exception as e:
+                self._status['last_error'] = str(e)
+            self._stop.wait(self.interval)
+
+    def start(self):
+        if self.running:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name=f'harvester {self.target}', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            'target': self.target,
+            'running': self.running,
+            'interval': self.interval,
+            'top_n': self.top_n,
+            'max_per_minute': self.limiter.capacity,
+            'cooldown': self.cooldown,
+            **self._status,
+        }
+
+
+_harvesters: Dict[PoolKey, Harvester] = {}
+_harvesters_lock = threading.Lock()
+
+
+def start_harvester(params, **options) -> Harvester:
+    """
+    Запустить фоновый сборщик для цели (если уже запущен — вернуть существующий).
+    """
+    key = pool_key(params)
+    with _harvesters_lock:
+        harvester = _harvesters.get(key)
+        if harvester is None or not harvester.running:
+            harvester = _harvesters[key] = Harvester(params, **options)
+            harvester.start()
+    return harvester
+
+
+def stop_harvester(params) -> bool:
+    with _harvesters_lock:
+        harvester = _harvesters.pop(pool_key(params), None)
+    if harvester is None:
+        return False
+    harvester.stop()
+    return True
+
+
+def harvester_status() -> List[Dict[str, Any]]:
+    return [h.status() for h in list(_harvesters.values())]
+
+
+def stop_all_harvesters():
+    with _harvesters_lock:
+        harvesters = list(_harvesters.values())
+        _harvesters.clear()
+    for harvester in harvesters:
+        harvester.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сбор горячих запросов из pg_stat_statements")
+    parser.add_argument('--host', default=os.getenv('PGHOST', 'localhost'))
+    parser.add_argument('--port', type=int, default=int(os.getenv('PGPORT', 5432)))
+    parser.add_argument('--user', default=os.getenv('PGUSER', 'postgres'))
+    parser.add_argument('--password', default=os.getenv('PGPASSWORD', ''))
+    parser.add_argument('--dbname', default=os.getenv('PGDATABASE', 'postgres'))
+    parser.add_argument('--interval', type=float, default=HARVEST_INTERVAL)
+    parser.add_argument('--top', type=int, default=HARVEST_TOP_N)
+    parser.add_argument('--max-per-minute', type=float, default=HARVEST_MAX_PER_MINUTE)
+    parser.add_argument('--cooldown', type=float, default=HARVEST_COOLDOWN)
+    parser.add_argument('--once', action='store_true', help='Один цикл и выход')
+    args = parser.parse_args()
+
+    harvester = Harvester(args, interval=args.interval, top_n=args.top,
+                          max_per_minute=args.max_per_minute, cooldown=args.cooldown)
+    while True:
+        summary = harvester.run_once()
+        print(dumps(summary))
+        if args.once:
+            break
+        time.sleep(args.interval)
+
+
+if __name__ == "__main__":
+    main()
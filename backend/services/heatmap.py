@@ -0,0 +1,104 @@
+import argparse
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional, Tuple
+
+# Окна, для которых /heatmap отвечает из предагрегированных счётчиков
+HEATMAP_WINDOWS = {
+    '1h': timedelta(hours=1),
+    '24h': timedelta(hours=24),
+    '7d': timedelta(days=7),
+}
+
+# Часовые счётчики читают только окна короче двух суток; старше самого
+# длинного окна они не нужны никому и удаляются
+HOUR_ROLLUP_RETENTION = max(HEATMAP_WINDOWS.values())
+
+# Гранулярность счётчиков: 'all' — за всё время, 'hour' — YYYY-MM-DDTHH, 'day' — YYYY-MM-DD
+ROLLUP_GRAINS = ('all', 'hour', 'day')
+ROLLUP_DIMENSIONS = {
+    'issue': 'issues',
+    'table': 'by_table',
+    'hour': 'by_hour',
+}
+
+RollupKey = Tuple[str, str, str, str]  # (grain, bucket, dimension, key)
+
+
+def advice_node_relation(advice: Dict[str, Any]) -> Optional[str]:
+    """
+    Отношение узла плана, на котором сработала рекомендация (advice['node']).
+    В старых записях истории его нет — тогда смотрим в metrics.
+    """
+    return (advice.get('node') or {}).get('relation') or (advice.get('metrics') or {}).get('relation')
+
+
+def advice_relation(advice: Dict[str, Any]) -> str:
+    return advice_node_relation(advice) or 'unknown'
+
+
+def rollup_increments(record: Dict[str, Any]) -> Counter:
+    """
+    Приращения счётчиков тепловой карты для одной записи истории.
+    """
+    increments = Counter()
+    dt = record.get('date') or ''
+    hour = dt[11:13] if len(dt) >= 13 else None
+    buckets = [('all', '')]
+    if hour:
+        buckets.append(('hour', dt[:13]))
+        buckets.append(('day', dt[:10]))
+    for a in record.get('advice') or ():
+        keys = [('issue', a.get('issue') or 'unknown'), ('table', advice_relation(a))]
+        if hour:
+            keys.append(('hour', hour))
+        for grain, bucket in buckets:
+            for dim, key in keys:
+                increments[(grain, bucket, dim, key)] += 1
+    return increments
+
+
+def window_range(window: str, now: Optional[datetime] = None) -> Tuple[str, str]:
+    """
+    Гранулярность и нижняя граница бакета для окна (1h/24h/7d).
+    Окна длиннее двух суток считаются по дневным бакетам.
+
+    Окна приблизительные: граница выравнивается по началу бакета, и первый
+    неполный бакет входит целиком — 1h покрывает от одного до двух часов,
+    24h — от 24 до 25 часов, 7d — от семи до восьми суток.
+    """
+    if window not in HEATMAP_WINDOWS:
+        raise ValueError(f"Неизвестное окно: {window}. Допустимо: {', '.join(HEATMAP_WINDOWS)}")
+    span = HEATMAP_WINDOWS[window]
+    since = (now or datetime.utcnow()) - span
+    if span > timedelta(days=2):
+        return 'day', since.isoformat()[:10]
+    return 'hour', since.isoformat()[:13]
+
+
+def hour_rollup_cutoff(now: Optional[datetime] = None) -> str:
+    """
+    Часовые бакеты раньше этой границы (YYYY-MM-DDTHH) не читает ни одно окно.
+    """
+    return ((now or datetime.utcnow()) - HOUR_ROLLUP_RETENTION).isoformat()[:13]
+
+
+def empty_heatmap() -> Dict[str, Dict[str, int]]:
+    return {name: {} for name in ROLLUP_DIMENSIONS.values()}
+
+
+def main():
+    from services.history import get_history_store
+
+    parser = argparse.ArgumentParser(description="Счётчики тепловой карты")
+    sub = parser.add_subparsers(dest='command', required=True)
+    sub.add_parser('rebuild', help='Пересчитать счётчики по всей истории')
+    args = parser.parse_args()
+
+    if args.command == 'rebuild':
+        count = get_history_store().rebuild_rollups()
+        print(f"Пересчитано записей: {count}")
+
+
+if __name__ == "__main__":
+    main()
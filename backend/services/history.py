@@ -0,0 +1,590 @@
+import argparse
+from abc import ABC, abstractmethod
+import os
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from services.heatmap import (
+    ROLLUP_DIMENSIONS,
+    advice_node_relation,
+    empty_heatmap,
+    hour_rollup_cutoff,
+    rollup_increments,
+    window_range,
+)
+from services.serialization import dumpb, dumps, json_default, loads
+from services.sqltext import fingerprint_text, text_digest
+
+HISTORY_BACKEND = os.getenv('HISTORY_BACKEND', 'sqlite')
+HISTORY_DB = os.getenv('HISTORY_DB', 'optimization_history.sqlite')
+LEGACY_HISTORY_FILE = 'optimization_history.json'
+
+Record = Dict[str, Any]
+
+
+def dump_record(record: Record) -> str:
+    return dumps(record)
+
+
+def record_line(record_id: int, raw: str) -> bytes:
+    """
+    Строка NDJSON из сохранённого JSON записи: id дописывается в текст без
+    разбора и повторного кодирования.
+    """
+    raw = raw.strip()
+    return f'{{"id":{record_id}{"," if raw != "{}" else ""}{raw[1:]}\n'.encode('utf-8')
+
+
+def record_tables(record: Record) -> List[str]:
+    """
+    Таблицы, к которым относится запись: из поля tables или из метрик рекомендаций.
+    """
+    tables = list(record.get('tables') or ())
+    for a in record.get('advice') or ():
+        rel = advice_node_relation(a)
+        if rel and rel not in tables:
+            tables.append(rel)
+    return tables
+
+
+def record_issues(record: Record) -> List[str]:
+    issues = []
+    for a in record.get('advice') or ():
+        issue = a.get('issue')
+        if issue and issue not in issues:
+            issues.append(issue)
+    return issues
+
+
+def record_fingerprint(record: Record) -> Optional[Tuple[str, str]]:
+    """
+    (отпечаток, нормализованный текст) запроса записи; для старых записей
+    без отпечатка вычисляется по полю query.
+    """
+    if record.get('fingerprint'):
+        return record['fingerprint'], record.get('normalized_query') or ''
+    query = record.get('query')
+    if not query:
+        return None
+    normalized = fingerprint_text(query)
+    return text_digest(normalized), normalized
+
+
+def record_cost(record: Record) -> Optional[float]:
+    cost = (record.get('metrics') or {}).get('cost')
+    try:
+        return float(cost) if cost is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def date_upper_bound(date_to: str) -> Tuple[str, str]:
+    """
+    Условие на верхнюю границу даты. Даты записей хранятся в ISO с временем,
+    поэтому граница-день (YYYY-MM-DD) включает весь этот день: date < следующий день.
+    """
+    try:
+        day = datetime.strptime(date_to, '%Y-%m-%d')
+    except ValueError:
+        return '<=', date_to
+    return '<', (day + timedelta(days=1)).strftime('%Y-%m-%d')
+
+
+# Сортировки для статистики по отпечаткам
+FINGERPRINT_SORTS = ('count', 'worst_cost', 'last_seen')
+
+
+class HistoryStore(ABC):
+    """
+    Интерфейс хранилища истории анализов. Записи возвращаются от новых к старым.
+    """
+
+    def append(self, record: Record) -> int:
+        return self.append_many([record])[-1]
+
+    @abstractmethod
+    def append_many(self, records: Iterable[Record]) -> List[int]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def page(
+        self,
+        cursor: Optional[int] = None,
+        limit: Optional[int] = None,
+        date_from: Optional[str] = None,
+        date_to: Optional[str] = None,
+        table: Optional[str] = None,
+        issue: Optional[str] = None,
+        fingerprint: Optional[str] = None,
+    ) -> Tuple[List[Record], Optional[int]]:
+        """
+        Страница записей старше cursor (id) и курсор следующей страницы.
+        """
+        raise NotImplementedError
+
+    def iter_records(self, batch_size: int = 500, **filters) -> Iterator[Record]:
+        cursor = None
+        while True:
+            records, cursor = self.page(cursor=cursor, limit=batch_size, **filters)
+            yield from records
+            if cursor is None:
+                return
+
+    def iter_lines(
+        self,
+        cursor: Optional[int] = None,
+        limit: Optional[int] = None,
+        batch_size: int = 500,
+        **filters,
+    ) -> Iterator[bytes]:
+        """
+        Записи старше cursor (не больше limit) строками NDJSON, пачками по
+        batch_size. Хранилища с записями в JSON отдают их без перекодирования.
+        """
+        while limit is None or limit > 0:
+            size = batch_size if limit is None else min(batch_size, limit)
+            records, cursor = self.page(cursor=cursor, limit=size, **filters)
+            for record in records:
+                yield dumpb(record) + b'\n'
+            if limit is not None:
+                limit -= len(records)
+            if cursor is None:
+                return
+
+    @abstractmethod
+    def append_once(self, marker: str, records: Iterable[Record]) -> int:
+        """
+        Атомарно добавить записи, если метка marker ещё не выставлена (для миграций).
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def count(self) -> int:
+        raise NotImplementedError
+
+    @abstractmethod
+    def heatmap(self, window: Optional[str] = None) -> Dict[str, Dict[str, int]]:
+        """
+        Тепловая карта проблем из предагрегированных счётчиков (за всё время или за окно).
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def rebuild_rollups(self) -> int:
+        """
+        Пересчитать счётчики тепловой карты по всей истории.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def fingerprints(self, limit: Optional[int] = None, sort: str = 'count') -> List[Dict[str, Any]]:
+        """
+        Статистика по отпечаткам запросов: число анализов, худшая стоимость
+        (и id записи с ней), первое и последнее появление.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def rebuild_fingerprints(self) -> int:
+        """
+        Пересчитать отпечатки и статистику по ним по всей истории.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_meta(self, key: str) -> Optional[str]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def set_meta(self, key: str, value: str):
+        raise NotImplementedError
+
+
+class SQLiteHistoryStore(HistoryStore):
+    """
+    История в SQLite (WAL): добавление — одна вставка, чтение — по индексу,
+    несколько процессов uvicorn могут писать одновременно.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            date TEXT NOT NULL,
+            record TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS history_date ON history (date);
+        CREATE TABLE IF NOT EXISTS history_tables (
+            record_id INTEGER NOT NULL,
+            name TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS history_tables_name ON history_tables (name, record_id);
+        CREATE TABLE IF NOT EXISTS history_issues (
+            record_id INTEGER NOT NULL,
+            issue TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS history_issues_issue ON history_issues (issue, record_id);
+        CREATE TABLE IF NOT EXISTS heatmap_rollup (
+            grain TEXT NOT NULL,
+            bucket TEXT NOT NULL,
+            dim TEXT NOT NULL,
+            key TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (grain, bucket, dim, key)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS history_fingerprints (
+            record_id INTEGER NOT NULL,
+            fingerprint TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS history_fingerprints_fp ON history_fingerprints (fingerprint, record_id);
+        CREATE TABLE IF NOT EXISTS fingerprint_stats (
+            fingerprint TEXT PRIMARY KEY,
+            normalized_query TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            worst_cost REAL,
+            worst_record_id INTEGER,
+            first_seen TEXT,
+            last_seen TEXT
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS history_meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+    """
+
+    def __init__(self, path: str = HISTORY_DB):
+        self.path = path
+        self._local = threading.local()
+        self._hour_rollups_cutoff = None
+        self._connect().executescript(self.SCHEMA)
+        if self.get_meta('heatmap_rollups') is None:
+            self.rebuild_rollups()
+        if self.get_meta('fingerprints') is None:
+            self.rebuild_fingerprints()
+
+    def _connect(self) -> sqlite3.Connection:
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute("PRAGMA busy_timeout=30000")
+            self._local.db = db
+        return db
+
+    def _insert_locked(self, db: sqlite3.Connection, record: Record) -> int:
+        date = record.get('date') or datetime.utcnow().isoformat()
+        cur = db.execute(
+            "INSERT INTO history (date, record) VALUES (?, ?)",
+            (date, dump_record(record)),
+        )
+        record_id = cur.lastrowid
+        db.executemany(
+            "INSERT INTO history_tables (record_id, name) VALUES (?, ?)",
+            [(record_id, t) for t in record_tables(record)],
+        )
+        db.executemany(
+            "INSERT INTO history_issues (record_id, issue) VALUES (?, ?)",
+            [(record_id, i) for i in record_issues(record)],
+        )
+        self._bump_rollups_locked(db, rollup_increments(record))
+        self._add_fingerprint_locked(db, record_id, date, record)
+        return record_id
+
+    @staticmethod
+    def _add_fingerprint_locked(db: sqlite3.Connection, record_id: int, date: str, record: Record):
+        fp = record_fingerprint(record)
+        if fp is None:
+            return
+        fingerprint, normalized = fp
+        cost = record_cost(record)
+        db.execute(
+            "INSERT INTO history_fingerprints (record_id, fingerprint) VALUES (?, ?)",
+            (record_id, fingerprint),
+        )
+        db.execute(
+            "INSERT INTO fingerprint_stats "
+            "(fingerprint, normalized_query, count, worst_cost, worst_record_id, first_seen, last_seen) "
+            "VALUES (?, ?, 1, ?, ?, ?, ?) "
+            "ON CONFLICT (fingerprint) DO UPDATE SET "
+            "count = count + 1, "
+            "worst_record_id = CASE WHEN excluded.worst_cost > coalesce(worst_cost, -1) "
+            "THEN excluded.worst_record_id ELSE worst_record_id END, "
+            "worst_cost = max(coalesce(worst_cost, excluded.worst_cost), coalesce(excluded.worst_cost, worst_cost)), "
+            "first_seen = min(first_seen, excluded.first_seen), "
+            "last_seen = max(last_seen, excluded.last_seen)",
+            (fingerprint, normalized, cost, record_id if cost is not None else None, date, date),
+        )
+
+    @staticmethod
+    def _bump_rollups_locked(db: sqlite3.Connection, increments):
+        db.executemany(
+            "INSERT INTO heatmap_rollup (grain, bucket, dim, key, count) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT (grain, bucket, dim, key) DO UPDATE SET count = count + excluded.count",
+            [(*k, n) for k, n in increments.items()],
+        )
+
+    def _prune_hour_rollups_locked(self, db: sqlite3.Connection, force: bool = False):
+        """
+        Удалить часовые счётчики старше самого длинного окна. Граница сдвигается
+        раз в час, поэтому удаление выполняется не чаще раза в час на процесс.
+        """
+        cutoff = hour_rollup_cutoff()
+        if not force and cutoff == self._hour_rollups_cutoff:
+            return
+        db.execute("DELETE FROM heatmap_rollup WHERE grain = 'hour' AND bucket < ?", (cutoff,))
+        self._hour_rollups_cutoff = cutoff
+
+    def append_many(self, records: Iterable[Record]) -> List[int]:
+        db = self._connect()
+        ids = []
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            for record in records:
+                ids.append(self._insert_locked(db, record))
+            self._prune_hour_rollups_locked(db)
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        return ids
+
+    def append_once(self, marker: str, records: Iterable[Record]) -> int:
+        db = self._connect()
+        count = 0
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            if db.execute("SELECT 1 FROM history_meta WHERE key = ?", (marker,)).fetchone() is None:
+                for record in records:
+                    self._insert_locked(db, record)
+                    count += 1
+                self._prune_hour_rollups_locked(db, force=True)
+                db.execute(
+                    "INSERT INTO history_meta (key, value) VALUES (?, ?)",
+                    (marker, datetime.utcnow().isoformat()),
+                )
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        return count
+
+    def _page_rows(
+        self,
+        cursor: Optional[int] = None,
+        limit: Optional[int] = None,
+        date_from: Optional[str] = None,
+        date_to: Optional[str] = None,
+        table: Optional[str] = None,
+        issue: Optional[str] = None,
+        fingerprint: Optional[str] = None,
+    ) -> Tuple[List[Tuple[int, str]], Optional[int]]:
+        """
+        Страница строк (id, JSON записи) и курсор следующей страницы.
+        """
+        where, args = [], []
+        if cursor is not None:
+            where.append("id < ?")
+            args.append(cursor)
+        if date_from:
+            where.append("date >= ?")
+            args.append(date_from)
+        if date_to:
+            op, bound = date_upper_bound(date_to)
+            where.append(f"date {op} ?")
+            args.append(bound)
+        if table:
+            where.append("id IN (SELECT record_id FROM history_tables WHERE name = ?)")
+            args.append(table)
+        if issue:
+            where.append("id IN (SELECT record_id FROM history_issues WHERE issue = ?)")
+            args.append(issue)
+        if fingerprint:
+            where.append("id IN (SELECT record_id FROM history_fingerprints WHERE fingerprint = ?)")
+            args.append(fingerprint)
+        sql = "SELECT id, record FROM history"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY id DESC"
+        if limit is not None:
+            sql += " LIMIT ?"
+            args.append(limit + 1)
+        rows = self._connect().execute(sql, args).fetchall()
+        next_cursor = None
+        if limit is not None and len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = rows[-1][0]
+        return rows, next_cursor
+
+    def page(self, cursor: Optional[int] = None, limit: Optional[int] = None, **filters) -> Tuple[List[Record], Optional[int]]:
+        rows, next_cursor = self._page_rows(cursor, limit, **filters)
+        records = []
+        for record_id, raw in rows:
+            record = loads(raw)
+            record['id'] = record_id
+            records.append(record)
+        return records, next_cursor
+
+    def iter_lines(
+        self,
+        cursor: Optional[int] = None,
+        limit: Optional[int] = None,
+        batch_size: int = 500,
+        **filters,
+    ) -> Iterator[bytes]:
+        while limit is None or limit > 0:
+            size = batch_size if limit is None else min(batch_size, limit)
+            rows, cursor = self._page_rows(cursor, size, **filters)
+            for record_id, raw in rows:
+                yield record_line(record_id, raw)
+            if limit is not None:
+                limit -= len(rows)
+            if cursor is None:
+                return
+
+    def count(self) -> int:
+        return self._connect().execute("SELECT count(*) FROM history").fetchone()[0]
+
+    def heatmap(self, window: Optional[str] = None) -> Dict[str, Dict[str, int]]:
+        if window:
+            grain, since = window_range(window)
+            rows = self._connect().execute(
+                "SELECT dim, key, sum(count) FROM heatmap_rollup "
+                "WHERE grain = ? AND bucket >= ? GROUP BY dim, key",
+                (grain, since),
+            ).fetchall()
+        else:
+            rows = self._connect().execute(
+                "SELECT dim, key, count FROM heatmap_rollup WHERE grain = 'all'"
+            ).fetchall()
+        result = empty_heatmap()
+        for dim, key, count in rows:
+            result[ROLLUP_DIMENSIONS[dim]][key] = count
+        return result
+
+    def rebuild_rollups(self) -> int:
+        db = self._connect()
+        count = 0
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.execute("DELETE FROM heatmap_rollup")
+            for (raw,) in db.execute("SELECT record FROM history ORDER BY id"):
+                self._bump_rollups_locked(db, rollup_increments(loads(raw)))
+                count += 1
+            self._prune_hour_rollups_locked(db, force=True)
+            db.execute(
+                "INSERT INTO history_meta (key, value) VALUES ('heatmap_rollups', ?) "
+                "ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+                (datetime.utcnow().isoformat(),),
+            )
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        return count
+
+    def fingerprints(self, limit: Optional[int] = None, sort: str = 'count') -> List[Dict[str, Any]]:
+        if sort not in FINGERPRINT_SORTS:
+            raise ValueError(f"Неизвестная сортировка: {sort}. Допустимо: {', '.join(FINGERPRINT_SORTS)}")
+        sql = (
+            "SELECT fingerprint, normalized_query, count, worst_cost, worst_record_id, first_seen, last_seen "
+            f"FROM fingerprint_stats ORDER BY {sort} DESC NULLS LAST, fingerprint"
+        )
+        args = []
+        if limit is not None:
+            sql += " LIMIT ?"
+            args.append(limit)
+        columns = ('fingerprint', 'normalized_query', 'count', 'worst_cost', 'worst_record_id',
+                   'first_seen', 'last_seen')
+        return [dict(zip(columns, row)) for row in self._connect().execute(sql, args)]
+
+    def rebuild_fingerprints(self) -> int:
+        db = self._connect()
+        count = 0
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.execute("DELETE FROM history_fingerprints")
+            db.execute("DELETE FROM fingerprint_stats")
+            for record_id, date, raw in db.execute("SELECT id, date, record FROM history ORDER BY id"):
+                self._add_fingerprint_locked(db, record_id, date, loads(raw))
+                count += 1
+            db.execute(
+                "INSERT INTO history_meta (key, value) VALUES ('fingerprints', ?) "
+                "ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+                (datetime.utcnow().isoformat(),),
+            )
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        return count
+
+    def get_meta(self, key: str) -> Optional[str]:
+        row = self._connect().execute("SELECT value FROM history_meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key: str, value: str):
+        self._connect().execute(
+            "INSERT INTO history_meta (key, value) VALUES (?, ?) "
+            "ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+            (key, value),
+        )
+
+
+HISTORY_BACKENDS = {
+    'sqlite': SQLiteHistoryStore,
+}
+
+_store: Optional[HistoryStore] = None
+_store_lock = threading.Lock()
+
+
+def get_history_store() -> HistoryStore:
+    """
+    Хранилище истории, выбранное через HISTORY_BACKEND (по умолчанию SQLite).
+    """
+    global _store
+    with _store_lock:
+        if _store is None:
+            try:
+                backend = HISTORY_BACKENDS[HISTORY_BACKEND]
+            except KeyError:
+                raise ValueError(f"Неизвестный HISTORY_BACKEND: {HISTORY_BACKEND}")
+            _store = backend()
+        return _store
+
+
+def migrate_json_history(json_path: str, store: HistoryStore, force: bool = False) -> int:
+    """
+    Однократный перенос optimization_history.json в хранилище.
+    Файл хранит записи от новых к старым, поэтому вставляем в обратном порядке.
+    """
+    if not os.path.exists(json_path):
+        return 0
+    marker = 'migrated_from:' + os.path.abspath(json_path)
+    if force:
+        marker += ':' + datetime.utcnow().isoformat()
+    elif store.get_meta(marker):
+        return 0
+    with open(json_path, 'r', encoding='utf-8') as f:
+        content = f.read().strip()
+    history = loads(content) if content else []
+    return store.append_once(marker, reversed(history))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="История анализов")
+    sub = parser.add_subparsers(dest='command', required=True)
+    migrate = sub.add_parser('migrate', help='Перенести optimization_history.json в хранилище')
+    migrate.add_argument('--json', default=LEGACY_HISTORY_FILE)
+    migrate.add_argument('--force', action='store_true', help='Импортировать повторно')
+    args = parser.parse_args()
+
+    if args.command == 'migrate':
+        count = migrate_json_history(args.json, get_history_store(), force=args.force)
+        print(f"Перенесено записей: {count}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,373 @@
+import os
+import re
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
+
+from adapters.indexes import collect_existing_indexes, COVERING_INDEX_MIN_VERSION
+from adapters.planner import get_explain_plan
+from adapters.statements import collect_statement_stats, has_pg_stat_statements
+from adapters.stats import get_server_capabilities
+from services.harvester import GENERIC_PLAN_MIN_VERSION
+from services.history import HistoryStore, get_history_store
+from services.plan_table import PlanTable, as_plan_table
+from services.predicates import ColumnRef, expression_columns, parse_condition, parse_sort_key
+from services.sqltext import has_parameters, is_explainable
+
+Plan = Dict[str, Any]
+Candidate = Dict[str, Any]
+
+# Сколько операторов нагрузки (отпечатков истории или строк pg_stat_statements) разбирать
+INDEX_ADVISOR_WORKLOAD = int(os.getenv('INDEX_ADVISOR_WORKLOAD', 50))
+# Сколько индексов рекомендовать
+INDEX_ADVISOR_TOP = int(os.getenv('INDEX_ADVISOR_TOP', 20))
+INDEX_MAX_KEY_COLUMNS = int(os.getenv('INDEX_MAX_KEY_COLUMNS', 3))
+# Покрывающий индекс предлагается, только если недостающих колонок не больше этого
+INDEX_MAX_INCLUDE_COLUMNS = int(os.getenv('INDEX_MAX_INCLUDE_COLUMNS', 3))
+# Стоимость выборки строки из кучи, которую экономит Index Only Scan (в единицах
+# стоимости плана; по умолчанию — random_page_cost)
+INDEX_HEAP_FETCH_COST = float(os.getenv('INDEX_HEAP_FETCH_COST', 4.0))
+WORKLOAD_SOURCES = ('history', 'statements')
+# Длина имени объекта PostgreSQL (NAMEDATALEN - 1)
+_MAX_NAME_LENGTH = 63
+_PLAIN_IDENT_RE = re.compile(r'^[a-z_][a-z0-9_$]*$')
+
+
+def _access_of(table: PlanTable, accesses: Dict[int, Dict[str, Any]], by_alias: Dict[str, int],
+               i: int, ref: ColumnRef) -> Optional[int]:
+    """
+    Узел сканирования, к отношению которого относится колонка ref из условия узла i.
+    """
+    qualifier = ref[0]
+    if i in accesses and (qualifier is None or qualifier in (table.alias[i], table.relation[i])):
+        return i
+    if qualifier is None:
+        # неквалифицированная колонка над единственным сканированием (план без VERBOSE)
+        below = [k for k in _subtree(table, i) if k in accesses]
+        return below[0] if len(below) == 1 else None
+    return by_alias.get(qualifier)
+
+
+def _subtree(table: PlanTable, i: int) -> List[int]:
+    nodes, stack = [], [i]
+    while stack:
+        k = stack.pop()
+        nodes.append(k)
+        stack.extend(table.children(k))
+    return nodes
+
+
+def collect_accesses(plan: Union[Plan, PlanTable]) -> List[Dict[str, Any]]:
+    """
+    Обращения к таблицам в плане: для каждого узла сканирования — колонки,
+    по которым его строки отбираются на равенство (eq) и по диапазону
+    (range), колонки соединений (join), порядок Sort над ним (sort) и все
+    нужные запросу колонки (needed; из Output, если план снят с VERBOSE,
+    иначе None). Условия соединений и сортировок относятся к сканированию
+    по алиасу колонки. Колонки соединения берутся только у внутренней
+    стороны Nested Loop (Join Filter или параметризованное условие самого
+    сканирования): Hash и Merge Join индекс по ключу соединения не ускорит.
+    """
+    table = as_plan_table(plan)
+    accesses: Dict[int, Dict[str, Any]] = {}
+    by_alias: Dict[str, int] = {}
+    for i, relation in enumerate(table.relation):
+        if relation:
+            accesses[i] = {
+                'relation': relation, 'node': i, 'node_type': table.node_type[i],
+                'cost': table.total_cost[i], 'rows': table.plan_rows[i], 'eq': {}, 'range': {}, 'join': {}, 'sort': [],
+                'referenced': {}, 'needed': None,
+            }
+            by_alias.setdefault(table.alias[i] or relation, i)
+
+    for i in range(len(table)):
+        inner: Optional[set] = None
+        if table.node_type[i] == 'Nested Loop' and len(table.children(i)) == 2:
+            inner = set(_subtree(table, table.children(i)[1]))
+        for key, text in table.conditions[i]:
+            if key == 'Sort Key':
+                continue
+            for ref in expression_columns((text,)):
+                target = _access_of(table, accesses, by_alias, i, ref)
+                if target is not None:
+                    accesses[target]['referenced'].setdefault(ref[1], None)
+            for predicate in parse_condition(text):
+                if predicate.kind == 'join':
+                    if key in ('Hash Cond', 'Merge Cond'):
+                        continue
+                    for ref in (predicate.column, predicate.other):
+                        target = _access_of(table, accesses, by_alias, i, ref)
+                        if target is None or (target != i and (inner is None or target not in inner)):
+                            continue
+                        accesses[target]['join'].setdefault(ref[1], None)
+                elif predicate.kind in ('eq', 'range'):
+                    target = _access_of(table, accesses, by_alias, i, predicate.column)
+                    if target is not None:
+                        accesses[target][predicate.kind].setdefault(predicate.column[1], None)
+
+        sort_key = table.nodes[i].get('Sort Key')
+        if table.node_type[i] in ('Sort', 'Incremental Sort') and isinstance(sort_key, list):
+            keys = parse_sort_key(sort_key)
+            targets = {_access_of(table, accesses, by_alias, i, ref) for ref, _ in keys}
+            directions = {descending for _, descending in keys}
+            if keys and len(keys) == len(sort_key) and len(targets) == 1 and None not in targets and len(directions) == 1:
+                accesses[targets.pop()]['sort'] = [ref[1] for ref, _ in keys]
+
+        output = table.nodes[i].get('Output')
+        if i in accesses and isinstance(output, list):
+            access = accesses[i]
+            access['needed'] = {
+                ref[1]: None for ref in expression_columns(output)
+                if _access_of(table, accesses, by_alias, i, ref) == i
+            }
+
+    result = []
+    for access in accesses.values():
+        if access['needed'] is not None:
+            access['needed'].update(access['referenced'])
+            access['needed'].update(dict.fromkeys(access['sort']))
+        result.append({
+            **access,
+            'eq': list(access['eq']),
+            'range': [c for c in access['range'] if c not in access['eq']],
+            'join': [c for c in access['join'] if c not in access['eq']],
+            'referenced': list(access['referenced']),
+            'needed': list(access['needed']) if access['needed'] is not None else None,
+        })
+    return result
+
+
+def access_candidates(access: Dict[str, Any], covering: bool = True,
+                      max_columns: int = INDEX_MAX_KEY_COLUMNS,
+                      max_include: int = INDEX_MAX_INCLUDE_COLUMNS) -> List[Candidate]:
+    """
+    Индексы, которые обслужили бы одно обращение к таблице:
+    - filter: колонки равенства, затем одна колонка диапазона (после неё
+      btree уже не сужает поиск) или, если диапазона нет, колонки Sort —
+      тогда индекс отдаёт строки в нужном порядке;
+    - sort: только колонки Sort, если отбора нет;
+    - join: колонки соединения и равенства — для Nested Loop с параметризованным
+      сканированием.
+    equality — сколько первых колонок сравниваются на равенство (их порядок
+    в индексе не важен). Для каждой формы есть кандидат только с ключом;
+    при covering и известном Output к нему добавляется покрывающий вариант
+    (covering) с недостающими запросу колонками в INCLUDE, если их не больше
+    max_include, — необязательное улучшение ради Index Only Scan.
+    """
+    eq, ranges, join, sort = access['eq'], access['range'], access['join'], access['sort']
+    shapes: List[Tuple[str, List[str], int]] = []
+    if eq or ranges:
+        columns = eq[:max_columns]
+        if ranges and len(columns) < max_columns:
+            columns.append(ranges[0])
+        elif sort:
+            columns += [c for c in sort if c not in columns][:max_columns - len(columns)]
+        shapes.append(('filter', columns, min(len(eq), max_columns)))
+    elif sort:
+        shapes.append(('sort', sort[:max_columns], 0))
+    if join:
+        columns = (join + eq)[:max_columns]
+        shapes.append(('join', columns, len(columns)))
+
+    candidates = []
+    for kind, columns, equality in shapes:
+        base = {'relation': access['relation'], 'columns': columns, 'equality': equality, 'kind': kind}
+        candidates.append({**base, 'include': [], 'covering': False})
+        if covering and access['needed'] is not None:
+            missing = [c for c in access['needed'] if c not in columns]
+            if missing and len(missing) <= max_include:
+                candidates.append({**base, 'include': sorted(missing), 'covering': True})
+    return candidates
+
+
+def _serves(columns: List[Optional[str]], include: List[Optional[str]], candidate: Candidate) -> bool:
+    """
+    Обслуживает ли btree-индекс (columns, include) кандидата: ключ кандидата —
+    префикс ключа индекса с точностью до порядка колонок равенства, а
+    INCLUDE кандидата есть среди колонок индекса.
+    """
+    key, equality = candidate['columns'], candidate['equality']
+    if len(columns) < len(key):
+        return False
+    if set(columns[:equality]) != set(key[:equality]) or list(columns[equality:len(key)]) != key[equality:]:
+        return False
+    return set(candidate['include']) <= set(columns) | set(include)
+
+
+def aggregate_workload(workload: Iterable[Tuple[Union[Plan, PlanTable], float, str]],
+                       covering: bool = True) -> List[Candidate]:
+    """
+    Кандидаты по всей нагрузке: workload — тройки (план, частота, метка
+    оператора). Одинаковые индексы из разных операторов складываются; вес
+    ключевого кандидата — сумма частота × стоимость сканирования, которое
+    индекс заменил бы, покрывающего — частота × экономия на выборке строк
+    из кучи (не больше стоимости сканирования); statements — частота по
+    меткам операторов.
+    """
+    merged: Dict[Tuple[str, Tuple[str, ...], Tuple[str, ...]], Candidate] = {}
+    for plan, frequency, label in workload:
+        for access in collect_accesses(plan):
+            for candidate in access_candidates(access, covering=covering):
+                key = (candidate['relation'], tuple(candidate['columns']), tuple(candidate['include']))
+                entry = merged.get(key)
+                if entry is None:
+                    entry = merged[key] = {**candidate, 'kinds': [], 'weight': 0.0, 'statements': {}}
+                    del entry['kind']
+                entry['equality'] = min(entry['equality'], candidate['equality'])
+                if candidate['kind'] not in entry['kinds']:
+                    entry['kinds'].append(candidate['kind'])
+                if candidate['covering']:
+                    entry['weight'] += frequency * min(access['cost'], (access['rows'] or 0) * INDEX_HEAP_FETCH_COST)
+                else:
+                    entry['weight'] += frequency * access['cost']
+                entry['statements'][label] = frequency
+    return list(merged.values())
+
+
+def quote_ident(name: str) -> str:
+    if _PLAIN_IDENT_RE.match(name):
+        return name
+    return '"' + name.replace('"', '""') + '"'
+
+
+def index_ddl(candidate: Candidate) -> str:
+    relation = candidate['relation']
+    name = '_'.join(['idx', relation] + candidate['columns'])
+    if candidate['include']:
+        name += '_cov'
+    name = re.sub(r'[^a-z0-9_]+', '_', name.lower())[:_MAX_NAME_LENGTH]
+    ddl = (f"CREATE INDEX IF NOT EXISTS {name} ON {quote_ident(relation)} "
+           f"({', '.join(quote_ident(c) for c in candidate['columns'])})")
+    if candidate['include']:
+        ddl += f" INCLUDE ({', '.join(quote_ident(c) for c in candidate['include'])})"
+    return ddl + ';'
+
+
+def select_indexes(candidates: List[Candidate], existing: Dict[str, List[Dict[str, Any]]],
+                   top: int = INDEX_ADVISOR_TOP) -> Dict[str, Any]:
+    """
+    Отбрасывает кандидатов, которых уже обслуживает существующий btree-индекс
+    без условия (pg_index): для ключевого кандидата достаточно совпадения
+    ключа. Затем сливает ключевых кандидатов, которых обслужит другой, более
+    широкий кандидат той же таблицы (его вес растёт на их вес), и возвращает
+    top по весу. Покрывающие кандидаты отдаются отдельно (covering_upgrades)
+    как необязательное улучшение существующего индекса (upgrade_of) или
+    рекомендованного ключевого.
+    """
+    served = []
+    remaining = []
+    upgrades = []
+    for candidate in candidates:
+        index = next((ix for ix in existing.get(candidate['relation'], ())
+                      if ix['method'] == 'btree' and not ix['partial']
+                      and _serves(ix['columns'], ix['include'], candidate)), None)
+        if index is not None:
+            served.append({
+                'relation': candidate['relation'],
+                'columns': candidate['columns'],
+                'include': candidate['include'],
+                'covering': candidate['covering'],
+                'index': index['name'],
+                'weight': candidate['weight'],
+            })
+        elif candidate['covering']:
+            key_index = next((ix['name'] for ix in existing.get(candidate['relation'], ())
+                              if ix['method'] == 'btree' and not ix['partial']
+                              and _serves(ix['columns'], [], {**candidate, 'include': []})), None)
+            upgrades.append({**candidate, 'upgrade_of': key_index})
+        else:
+            remaining.append(candidate)
+
+    kept: List[Candidate] = []
+    for candidate in sorted(remaining, key=lambda c: (-(len(c['columns']) + len(c['include'])), -c['weight'])):
+        wider = next((k for k in kept if k['relation'] == candidate['relation']
+                      and _serves(k['columns'], k['include'], candidate)), None)
+        if wider is None:
+            kept.append({**candidate, 'serves': []})
+            continue
+        wider['weight'] += candidate['weight']
+        wider['serves'].append(candidate['columns'])
+        for kind in candidate['kinds']:
+            if kind not in wider['kinds']:
+                wider['kinds'].append(kind)
+        for label, frequency in candidate['statements'].items():
+            wider['statements'].setdefault(label, frequency)
+
+    def finish(selected: List[Candidate]) -> List[Candidate]:
+        result = []
+        for candidate in sorted(selected, key=lambda c: c['weight'], reverse=True)[:top]:
+            statements = candidate['statements']
+            candidate = {k: v for k, v in candidate.items() if k not in ('equality', 'covering')}
+            candidate.update(frequency=sum(statements.values()), statements=list(statements))
+            candidate['ddl'] = index_ddl(candidate)
+            result.append(candidate)
+        return result
+
+    served.sort(key=lambda s: s['weight'], reverse=True)
+    return {'indexes': finish(kept), 'already_served': served, 'covering_upgrades': finish(upgrades)}
+
+
+def history_workload(store: HistoryStore, limit: int = INDEX_ADVISOR_WORKLOAD) -> List[Dict[str, Any]]:
+    """
+    Самые частые отпечатки истории: последний текст оператора и число анализов.
+    """
+    entries = []
+    for fp in store.fingerprints(limit=limit, sort='count'):
+        records, _ = store.page(limit=1, fingerprint=fp['fingerprint'])
+        if records:
+            entries.append({'label': fp['fingerprint'], 'query': records[0]['query'], 'frequency': fp['count']})
+    return entries
+
+
+def statements_workload(conn, limit: int = INDEX_ADVISOR_WORKLOAD) -> List[Dict[str, Any]]:
+    """
+    Самые дорогие по суммарному времени операторы pg_stat_statements и число их вызовов.
+    """
+    if not has_pg_stat_statements(conn):
+        raise RuntimeError("Расширение pg_stat_statements не установлено в целевой БД")
+    stats = sorted(collect_statement_stats(conn).values(), key=lambda s: s['total_time'], reverse=True)
+    return [{'label': str(s['queryid']), 'query': s['query'], 'frequency': s['calls']} for s in stats[:limit]]
+
+
+def index_advice_report(conn, source: str = 'history', limit: int = INDEX_ADVISOR_WORKLOAD,
+                        top: int = INDEX_ADVISOR_TOP, store: Optional[HistoryStore] = None) -> Dict[str, Any]:
+    """
+    Рекомендации индексов по нагрузке цели: операторы из истории или
+    pg_stat_statements заново планируются с EXPLAIN (VERBOSE) — с
+    параметрами $n через GENERIC_PLAN на PostgreSQL 16+, — кандидаты
+    складываются по всей нагрузке и сверяются с существующими индексами.
+    """
+    if source not in WORKLOAD_SOURCES:
+        raise ValueError(f"Неизвестный источник нагрузки: {source}. Допустимо: {', '.join(WORKLOAD_SOURCES)}")
+    server_version = get_server_capabilities(conn)['server_version']
+    if source == 'history':
+        entries = history_workload(store or get_history_store(), limit)
+    else:
+        entries = statements_workload(conn, limit)
+
+    workload, skipped = [], []
+    for entry in entries:
+        query = entry['query']
+        if not is_explainable(query):
+            skipped.append({'label': entry['label'], 'reason': 'not_explainable'})
+            continue
+        parameters = has_parameters(query)
+        if parameters and server_version < GENERIC_PLAN_MIN_VERSION:
+            skipped.append({'label': entry['label'], 'reason': 'parameters_require_pg16'})
+            continue
+        try:
+            plan = get_explain_plan(conn, query, generic_plan=parameters, verbose=True)['Plan']
+        except Exception as e:
+            conn.rollback()
+            skipped.append({'label': entry['label'], 'reason': 'error', 'error': str(e)})
+            continue
+        workload.append((PlanTable.from_plan(plan), entry['frequency'], entry['label']))
+
+    candidates = aggregate_workload(workload, covering=server_version >= COVERING_INDEX_MIN_VERSION)
+    existing = collect_existing_indexes(conn, {c['relation'] for c in candidates})
+    return {
+        'source': source,
+        'statements': len(entries),
+        'analyzed': len(workload),
+        'skipped': skipped,
+        'candidates': len(candidates),
+        **select_indexes(candidates, existing, top),
+    }
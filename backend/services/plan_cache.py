@@ -0,0 +1,160 @@
+import copy
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from services.sqltext import normalize_query_text, text_digest
+
+CacheKey = Tuple[str, str, str, str]
+
+PLAN_CACHE_MAX_ENTRIES = int(os.getenv('PLAN_CACHE_MAX_ENTRIES', 1024))
+PLAN_CACHE_MAX_BYTES = int(os.getenv('PLAN_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+PLAN_CACHE_TTL = float(os.getenv('PLAN_CACHE_TTL', 600))
+
+
+def make_cache_key(target: str, query: str, stats_epoch: str, variant: str = '') -> CacheKey:
+    """
+    Ключ кэша: цель (БД), отпечаток нормализованного текста запроса, эпоха статистики
+    и вариант анализа (опции, влияющие на результат, например режим what-if).
+    """
+    return (target, text_digest(normalize_query_text(query)), stats_epoch, variant)
+
+
+class PlanCache:
+    """
+    LRU-кэш планов и рекомендаций с TTL и ограничением по памяти.
+
+    Размер записи оценивается один раз при добавлении (длина JSON-представления).
+    Значения отдаются глубокой копией, чтобы вызывающий код мог их дополнять.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = PLAN_CACHE_MAX_ENTRIES,
+        max_bytes: int = PLAN_CACHE_MAX_BYTES,
+        ttl: float = PLAN_CACHE_TTL,
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries: 'OrderedDict[CacheKey, Tuple[float, int, Any]]' = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'bypasses': 0,
+            'evictions': 0,
+            'expirations': 0,
+        }
+
+    def get(self, key: CacheKey) -> Optional[Any]:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._stats['misses'] += 1
+                return None
+            stored_at, size, value = entry
+            if now - stored_at > self.ttl:
+                self._drop_locked(key, size)
+                self._stats['expirations'] += 1
+                self._stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats['hits'] += 1
+        return copy.deepcopy(value)
+
+    def put(self, key: CacheKey, value: Any):
+        size = len(json.dumps(value, default=str))
+        if size > self.max_bytes:
+            return
+        value = copy.deepcopy(value)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[key] = (time.monotonic(), size, value)
+            self._bytes += size
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                old_key, (_, old_size, _) = next(iter(self._entries.items()))
+                self._drop_locked(old_key, old_size)
+                self._stats['evictions'] += 1
+
+    def _drop_locked(self, key: CacheKey, size: int):
+        del self._entries[key]
+        self._bytes -= size
+
+    def note_bypass(self):
+        with self._lock:
+            self._stats['bypasses'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self._stats['hits'] + self._stats['misses']
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'ttl': self.ttl,
+                'hit_ratio': self._stats['hits'] / lookups if lookups else None,
+                **self._stats,
+            }
+
+
+plan_cache = PlanCache()
+
+
+def cached_analysis(
+    key: CacheKey,
+    compute: Callable[[], Dict[str, Any]],
+    bypass: bool = False,
+    cache: Optional[PlanCache] = None,
+) -> Tuple[Dict[str, Any], str]:
+    """
+    Вернуть результат анализа из кэша или вычислить его через compute().
+    При bypass кэш не читается, но свежий результат в него записывается.
+    Возвращает (значение, статус: hit/miss/bypass).
+    """
+    cache = cache or plan_cache
+    value, status = _lookup(cache, key, bypass)
+    if value is not None:
+        return value, status
+    value = compute()
+    cache.put(key, value)
+    return value, status
+
+
+async def cached_analysis_async(
+    key: CacheKey,
+    compute: Callable[[], Awaitable[Dict[str, Any]]],
+    bypass: bool = False,
+    cache: Optional[PlanCache] = None,
+) -> Tuple[Dict[str, Any], str]:
+    """
+    То же, что cached_analysis, для асинхронной функции compute.
+    """
+    cache = cache or plan_cache
+    value, status = _lookup(cache, key, bypass)
+    if value is not None:
+        return value, status
+    value = await compute()
+    cache.put(key, value)
+    return value, status
+
+
+def _lookup(cache: PlanCache, key: CacheKey, bypass: bool) -> Tuple[Optional[Any], str]:
+    if bypass:
+        cache.note_bypass()
+        return None, 'bypass'
+    value = cache.get(key)
+    return value, ('hit' if value is not None else 'miss')
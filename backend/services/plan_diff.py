@@ -0,0 +1,196 @@
+from collections import defaultdict, deque
+from typing import Any, Dict, List, Optional, Set, Tuple, Union
+
+from services.plan_table import PlanTable, as_plan_table
+
+Plan = Dict[str, Any]
+
+# Числовые поля узла, изменения которых показываются в diff
+DIFF_FIELDS = {
+    'cost': 'Total Cost',
+    'startup_cost': 'Startup Cost',
+    'rows': 'Plan Rows',
+    'actual_time': 'Actual Total Time',
+    'actual_rows': 'Actual Rows',
+    'actual_loops': 'Actual Loops',
+    'shared_hit': 'Shared Hit Blocks',
+    'shared_read': 'Shared Read Blocks',
+}
+
+# Сколько самых заметных изменений отдавать в сводке
+DIFF_TOP = 10
+
+
+def _subtree_relations(table: PlanTable) -> List[str]:
+    """
+    Для каждого узла таблицы — отсортированный список отношений поддерева,
+    склеенный в строку. Дети в таблице идут после родителя, поэтому хватает
+    одного прохода с конца.
+    """
+    sets: List[Set[str]] = [set() for _ in range(len(table))]
+    for i in range(len(table) - 1, -1, -1):
+        own = table.object_name[i]
+        if own:
+            sets[i].add(own)
+        parent = table.parent[i]
+        if parent >= 0:
+            sets[parent] |= sets[i]
+    return [','.join(sorted(rels)) for rels in sets]
+
+
+def _match_children(
+    table_b: PlanTable, table_a: PlanTable, before: List[int], after: List[int],
+    sub_b: List[str], sub_a: List[str],
+) -> List[Tuple[Optional[int], Optional[int]]]:
+    """
+    Сопоставление детей двух узлов (номера узлов в таблицах). Сначала по
+    (тип узла, отношение или набор отношений поддерева), затем сканирования
+    со сканированиями того же объекта (смена Seq Scan -> Index Scan), затем
+    только по отношениям поддерева (Hash Join -> Nested Loop), затем по
+    оставшимся позициям. Всё за линейное время — для
+    Append с тысячами секций это важно.
+    """
+    pairs: List[Tuple[Optional[int], Optional[int]]] = []
+    left_b = list(before)
+    left_a = list(after)
+
+    def rel_key(table, sub, i):
+        return table.object_name[i] or sub[i]
+
+    for key_fn in (
+        lambda table, sub, i: (table.node_type[i], rel_key(table, sub, i)),
+        lambda table, sub, i: table.object_name[i],
+        lambda table, sub, i: rel_key(table, sub, i) or None,
+    ):
+        index: Dict[Any, deque] = defaultdict(deque)
+        for i in left_b:
+            key = key_fn(table_b, sub_b, i)
+            if key is not None:
+                index[key].append(i)
+        matched: Set[int] = set()
+        still_a = []
+        for j in left_a:
+            candidates = index.get(key_fn(table_a, sub_a, j))
+            if candidates:
+                i = candidates.popleft()
+                matched.add(i)
+                pairs.append((i, j))
+            else:
+                still_a.append(j)
+        left_b = [i for i in left_b if i not in matched]
+        left_a = still_a
+
+    for i, j in zip(left_b, left_a):
+        pairs.append((i, j))
+    for i in left_b[len(left_a):]:
+        pairs.append((i, None))
+    for j in left_a[len(left_b):]:
+        pairs.append((None, j))
+    return pairs
+
+
+def _numbers(node: Plan) -> Dict[str, Any]:
+    return {k: node.get(field) for k, field in DIFF_FIELDS.items()}
+
+
+def _change(before: Optional[Any], after: Optional[Any]) -> Optional[Dict[str, Any]]:
+    if before == after:
+        return None
+    change = {'before': before, 'after': after}
+    if isinstance(before, (int, float)) and isinstance(after, (int, float)):
+        change['delta'] = after - before
+        change['ratio'] = (after / before) if before else None
+    return change
+
+
+def diff_plans(before: Union[Plan, PlanTable], after: Union[Plan, PlanTable], include_unchanged: bool = False) -> Dict[str, Any]:
+    """
+    Структурное сравнение двух планов (корневых узлов 'Plan' или их таблиц
+    узлов). Деревья выравниваются сверху вниз, для каждой пары узлов
+    сообщаются смена типа узла и изменения стоимости, оценки и фактического
+    числа строк, времени и буферов. Узлы без пары — added/removed (их
+    поддеревья тоже).
+    """
+    table_b, table_a = as_plan_table(before), as_plan_table(after)
+    sub_b = _subtree_relations(table_b)
+    sub_a = _subtree_relations(table_a)
+    nodes: List[Dict[str, Any]] = []
+    counts = {'same': 0, 'changed': 0, 'added': 0, 'removed': 0}
+    type_changes = []
+
+    stack: List[Tuple[Optional[int], Optional[int]]] = [(0, 0)]
+    while stack:
+        b, a = stack.pop()
+        if b is None or a is None:
+            table, i = (table_a, a) if b is None else (table_b, b)
+            status = 'added' if b is None else 'removed'
+            counts[status] += 1
+            nodes.append({
+                'status': status,
+                'depth': table.depth[i],
+                'path_before': table.path(i) if b is not None else None,
+                'path_after': table.path(i) if a is not None else None,
+                'node': table.label(i),
+                ('before' if b is not None else 'after'): _numbers(table.nodes[i]),
+            })
+            for child in reversed(table.children(i)):
+                stack.append((None, child) if b is None else (child, None))
+            continue
+
+        node_b, node_a = table_b.nodes[b], table_a.nodes[a]
+        changes = {}
+        type_change = _change(table_b.node_type[b], table_a.node_type[a])
+        if type_change:
+            changes['node_type'] = type_change
+        for key, field in DIFF_FIELDS.items():
+            c = _change(node_b.get(field), node_a.get(field))
+            if c:
+                changes[key] = c
+        status = 'changed' if changes else 'same'
+        counts[status] += 1
+        entry = {
+            'status': status,
+            'depth': table_a.depth[a],
+            'path_before': table_b.path(b),
+            'path_after': table_a.path(a),
+            'node': table_a.label(a),
+            'changes': changes,
+        }
+        if type_change:
+            entry['node_before'] = table_b.label(b)
+            type_changes.append(entry)
+        if status == 'changed' or include_unchanged:
+            nodes.append(entry)
+
+        pairs = _match_children(table_b, table_a, table_b.children(b), table_a.children(a), sub_b, sub_a)
+        stack.extend(reversed(pairs))
+
+    def magnitude(entry, key):
+        change = entry.get('changes', {}).get(key)
+        return abs(change.get('delta') or 0) if change else 0
+
+    return {
+        'counts': counts,
+        'node_type_changes': [
+            {'node_before': e['node_before'], 'node_after': e['node'], 'path_after': e['path_after']}
+            for e in type_changes
+        ],
+        'top_cost_changes': [
+            {'node': e['node'], 'path_after': e['path_after'], **e['changes']['cost']}
+            for e in sorted(nodes, key=lambda e: magnitude(e, 'cost'), reverse=True)[:DIFF_TOP]
+            if magnitude(e, 'cost')
+        ],
+        'top_time_changes': [
+            {'node': e['node'], 'path_after': e['path_after'], **e['changes']['actual_time']}
+            for e in sorted(nodes, key=lambda e: magnitude(e, 'actual_time'), reverse=True)[:DIFF_TOP]
+            if magnitude(e, 'actual_time')
+        ],
+        'nodes': nodes,
+    }
+
+
+def diff_summary(diff: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Сводка diff без списка всех узлов (для истории и what-if).
+    """
+    return {k: v for k, v in diff.items() if k != 'nodes'}
@@ -0,0 +1,249 @@
+import math
+import sys
+from array import array
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+from metrics import make_metrics_dict
+from services.predicates import ColumnRef, expression_columns, parse_condition, parse_sort_key
+
+Plan = Dict[str, Any]
+
+# Условия узла, которые сохраняются в таблице (в порядке приоритета для
+# подстановки колонки в fix_ddl)
+CONDITION_KEYS = ('Index Cond', 'Filter', 'Hash Cond', 'Sort Key', 'Merge Cond', 'Join Filter', 'Recheck Cond')
+PLACEHOLDER_CONDITION_KEYS = ('Index Cond', 'Filter', 'Hash Cond', 'Sort Key')
+
+_NAN = float('nan')
+
+
+def _num(value) -> float:
+    return _NAN if value is None else float(value)
+
+
+def _out(value: float) -> Optional[float]:
+    return None if math.isnan(value) else value
+
+
+def _intern(value: Optional[str]) -> Optional[str]:
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+class PlanTable:
+    """
+    План EXPLAIN, развёрнутый один раз в плоскую таблицу узлов в порядке
+    обхода в глубину (родитель раньше детей, дети слева направо). Числовые
+    поля хранятся в array, строковые — в списках с интернированными
+    значениями; отсутствующие фактические значения — NaN.
+    Исходные словари узлов доступны через nodes[i] (для пользовательских
+    правил и сборщиков рекомендаций).
+    """
+    __slots__ = (
+        'nodes', 'parent', 'depth', 'position',
+        'node_type', 'relation', 'object_name', 'alias', 'conditions',
+        'startup_cost', 'total_cost', 'plan_rows', 'plan_width',
+        'actual_time', 'actual_rows', 'actual_loops',
+        '_children', '_columns', '_aliases',
+    )
+
+    def __init__(self):
+        self.nodes: List[Plan] = []
+        self.parent = array('i')
+        self.depth = array('i')
+        self.position = array('i')  # номер среди детей родителя
+        self.node_type: List[Optional[str]] = []
+        self.relation: List[Optional[str]] = []     # Relation Name
+        self.object_name: List[Optional[str]] = []  # отношение, индекс, CTE, функция или подплан
+        self.alias: List[Optional[str]] = []
+        self.conditions: List[Tuple[Tuple[str, str], ...]] = []
+        self.startup_cost = array('d')
+        self.total_cost = array('d')
+        self.plan_rows = array('q')
+        self.plan_width = array('q')
+        self.actual_time = array('d')
+        self.actual_rows = array('d')
+        self.actual_loops = array('d')
+        self._children: Optional[List[List[int]]] = None
+        self._columns: Dict[int, Tuple[Optional[str], Optional[str]]] = {}
+        self._aliases: Optional[Dict[str, str]] = None
+
+    @classmethod
+    def from_plan(cls, plan: Plan) -> 'PlanTable':
+        table = cls()
+        stack: List[Tuple[Plan, int, int, int]] = [(plan, -1, 0, 0)]
+        while stack:
+            node, parent, depth, position = stack.pop()
+            i = len(table.nodes)
+            table.nodes.append(node)
+            table.parent.append(parent)
+            table.depth.append(depth)
+            table.position.append(position)
+            table.node_type.append(_intern(node.get('Node Type')))
+            table.relation.append(_intern(node.get('Relation Name')))
+            table.object_name.append(_intern(
+                node.get('Relation Name') or node.get('Index Name') or node.get('CTE Name')
+                or node.get('Function Name') or node.get('Subplan Name')))
+            table.alias.append(_intern(node.get('Alias')))
+            table.conditions.append(tuple((k, str(node[k])) for k in CONDITION_KEYS if node.get(k)))
+            table.startup_cost.append(node.get('Startup Cost') or 0.0)
+            table.total_cost.append(node.get('Total Cost') or 0.0)
+            table.plan_rows.append(int(node.get('Plan Rows') or 0))
+            table.plan_width.append(int(node.get('Plan Width') or 0))
+            table.actual_time.append(_num(node.get('Actual Total Time')))
+            table.actual_rows.append(_num(node.get('Actual Rows')))
+            table.actual_loops.append(_num(node.get('Actual Loops')))
+            children = node.get('Plans', ())
+            for k in range(len(children) - 1, -1, -1):
+                stack.append((children[k], i, depth + 1, k))
+        return table
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+    def children(self, i: int) -> List[int]:
+        if self._children is None:
+            children: List[List[int]] = [[] for _ in self.nodes]
+            for k, p in enumerate(self.parent):
+                if p >= 0:
+                    children[p].append(k)
+            self._children = children
+        return self._children[i]
+
+    def path(self, i: int) -> List[int]:
+        """
+        Путь от корня (номера детей), как в diff и профиле.
+        """
+        path = []
+        while i > 0:
+            path.append(self.position[i])
+            i = self.parent[i]
+        return path[::-1]
+
+    def condition(self, i: int, key: str) -> Optional[str]:
+        for k, text in self.conditions[i]:
+            if k == key:
+                return text
+        return None
+
+    def alias_relation(self, alias: str) -> Optional[str]:
+        if self._aliases is None:
+            aliases: Dict[str, str] = {}
+            for k, rel in enumerate(self.relation):
+                if rel:
+                    aliases.setdefault(self.alias[k] or rel, rel)
+            self._aliases = aliases
+        return self._aliases.get(alias)
+
+    def column_ref(self, i: int) -> Tuple[Optional[str], Optional[str]]:
+        """
+        (отношение, колонка) по первой колонке, с которой сравнивается
+        условие узла (Index Cond, Filter, Hash Cond, Sort Key); функции,
+        приведения типов и литералы разбираются services.predicates.
+        Квалификатор-алиас разрешается в отношение по узлам сканирования
+        плана — так у соединений находится таблица, к которой относится
+        колонка. Считается один раз на узел.
+        """
+        if i not in self._columns:
+            ref: Tuple[Optional[str], Optional[str]] = (self.relation[i], None)
+            for key in PLACEHOLDER_CONDITION_KEYS:
+                found = self._first_column(i, key)
+                if found is not None:
+                    ref = (self.resolve(i, found), found[1])
+                    break
+            self._columns[i] = ref
+        return self._columns[i]
+
+    def _first_column(self, i: int, key: str) -> Optional[ColumnRef]:
+        if key == 'Sort Key':
+            items = self.nodes[i].get(key)
+            keys = parse_sort_key(items) if isinstance(items, list) else []
+            return keys[0][0] if keys else None
+        text = self.condition(i, key)
+        predicates = parse_condition(text) if text else []
+        return predicates[0].column if predicates else None
+
+    def resolve(self, i: int, ref: ColumnRef) -> Optional[str]:
+        """
+        Отношение колонки ref, упомянутой в условии узла i: по алиасу, а без
+        квалификатора — отношение самого узла.
+        """
+        qualifier = ref[0]
+        if qualifier is None:
+            return self.relation[i]
+        return self.alias_relation(qualifier) or self.relation[i]
+
+    def column(self, i: int) -> Optional[str]:
+        return self.column_ref(i)[1]
+
+    def column_refs(self, i: int, keys: Tuple[str, ...] = CONDITION_KEYS) -> List[Tuple[Optional[str], str]]:
+        """
+        Все ссылки на колонки в условиях узла: (отношение или None, колонка),
+        без повторов. Имена функций, типов после :: и служебные слова
+        пропускаются; неквалифицированные колонки относятся к отношению узла.
+        """
+        refs: Dict[Tuple[Optional[str], str], None] = {}
+        for key, text in self.conditions[i]:
+            if key not in keys:
+                continue
+            items = self.nodes[i][key] if key == 'Sort Key' and isinstance(self.nodes[i][key], list) else (text,)
+            for qualifier, column in expression_columns(items):
+                relation = self.alias_relation(qualifier) if qualifier else self.relation[i]
+                refs.setdefault((relation, column), None)
+        return list(refs)
+
+    def row_estimate_error(self, i: int) -> Optional[float]:
+        """
+        Ошибка оценки числа строк (q-error): во сколько раз оценка Plan Rows
+        разошлась с фактическим Actual Rows на один цикл, не меньше 1.
+        None — план без ANALYZE или узел не выполнялся.
+        """
+        actual, loops = self.actual_rows[i], self.actual_loops[i]
+        if math.isnan(actual) or not loops > 0:
+            return None
+        estimated = max(float(self.plan_rows[i]), 1.0)
+        actual = max(actual, 1.0)
+        return max(estimated / actual, actual / estimated)
+
+    def label(self, i: int) -> str:
+        label = self.node_type[i] or '?'
+        name = self.object_name[i]
+        if name:
+            label += f" on {name}"
+            alias = self.alias[i]
+            if alias and alias != name:
+                label += f" {alias}"
+        return label
+
+    def metrics(self, i: int) -> Dict[str, Any]:
+        return make_metrics_dict(
+            cost=self.total_cost[i],
+            rows=self.plan_rows[i],
+            width=self.plan_width[i],
+            startup_cost=self.startup_cost[i],
+            actual_time=_out(self.actual_time[i]),
+            actual_rows=_out(self.actual_rows[i]),
+        )
+
+    def node_info(self, i: int) -> Dict[str, Any]:
+        return {
+            'index': i,
+            'parent': self.parent[i] if self.parent[i] >= 0 else None,
+            'depth': self.depth[i],
+            'path': self.path(i),
+            'node_type': self.node_type[i],
+            'relation': self.relation[i],
+            'alias': self.alias[i],
+            'conditions': dict(self.conditions[i]),
+        }
+
+    def relations(self) -> List[str]:
+        seen = {}
+        for rel in self.relation:
+            if rel and rel not in seen:
+                seen[rel] = None
+        return list(seen)
+
+
+def as_plan_table(plan: Union[Plan, PlanTable]) -> PlanTable:
+    if isinstance(plan, PlanTable):
+        return plan
+    return PlanTable.from_plan(plan)
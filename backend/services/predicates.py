@@ -0,0 +1,243 @@
+from dataclasses import dataclass
+from typing import Iterable, List, Optional, Tuple
+
+from services.sqltext import tokenize
+
+Token = Tuple[str, str]
+ColumnRef = Tuple[Optional[str], str]  # (квалификатор-алиас или None, колонка)
+
+# Операторы сравнения в условиях EXPLAIN, по которым btree-индекс может искать
+EQUALITY_OPS = frozenset({'='})
+RANGE_OPS = frozenset({'<', '>', '<=', '>='})
+# Символы, из которых лексер по одному собирает операторы (~~, !~~, <> ...);
+# + и - не склеиваются, чтобы = -1 осталось сравнением с отрицательным числом
+_OP_CHARS = frozenset('<>=!~*/%^&|#@?')
+_COMPARISON_OPS = EQUALITY_OPS | RANGE_OPS | frozenset({'<>', '!=', '~~', '!~~', '~~*', '!~~*', '~', '!~', '~*', '!~*'})
+# Слова, которые не являются колонками
+_KEYWORDS = frozenset({
+    'and', 'or', 'not', 'is', 'null', 'true', 'false', 'any', 'all', 'array', 'like', 'ilike',
+    'in', 'between', 'case', 'when', 'then', 'else', 'end', 'desc', 'asc', 'nulls', 'first',
+    'last', 'collate', 'distinct', 'from', 'subplan', 'initplan', 'hashed', 'returns', 'using',
+    'row', 'some', 'similar', 'to', 'escape', 'interval', 'current_date', 'current_timestamp',
+    'localtimestamp', 'current_user', 'session_user',
+})
+
+
+@dataclass(slots=True)
+class Predicate:
+    """
+    Одно условие из конъюнкции: kind — 'eq' (=, = ANY, IS NULL, булева
+    колонка), 'range' (<, >, <=, >=), 'join' (равенство двух колонок) или
+    'other' (прочие сравнения по колонке). other — вторая колонка соединения.
+    """
+    kind: str
+    column: ColumnRef
+    op: str
+    other: Optional[ColumnRef] = None
+
+
+def _tokens(text: str) -> List[Token]:
+    """
+    Токены условия без пробелов; односимвольные операторы склеиваются.
+    """
+    tokens: List[Token] = []
+    for kind, value in tokenize(text):
+        if kind in ('ws', 'comment'):
+            continue
+        if (kind == 'op' and value in _OP_CHARS and tokens and tokens[-1][0] == 'op'
+                and tokens[-1][1][-1] in _OP_CHARS and tokens[-1][1] != '::'):
+            tokens[-1] = ('op', tokens[-1][1] + value)
+            continue
+        tokens.append((kind, value))
+    return tokens
+
+
+def _closing(tokens: List[Token], start: int) -> int:
+    depth = 0
+    for k in range(start, len(tokens)):
+        value = tokens[k][1]
+        if value in ('(', '['):
+            depth += 1
+        elif value in (')', ']'):
+            depth -= 1
+            if depth == 0:
+                return k
+    return len(tokens) - 1
+
+
+def _strip_parens(tokens: List[Token]) -> List[Token]:
+    while len(tokens) >= 2 and tokens[0][1] == '(' and _closing(tokens, 0) == len(tokens) - 1:
+        tokens = tokens[1:-1]
+    return tokens
+
+
+def _top_level(tokens: List[Token]) -> Iterable[Tuple[int, Token]]:
+    """
+    Токены вне скобок с их позициями.
+    """
+    depth = 0
+    for k, token in enumerate(tokens):
+        value = token[1]
+        if value in ('(', '['):
+            depth += 1
+        elif value in (')', ']'):
+            depth -= 1
+        elif depth == 0:
+            yield k, token
+
+
+def _split_top(tokens: List[Token], word: str) -> List[List[Token]]:
+    parts, start = [], 0
+    for k, (kind, value) in _top_level(tokens):
+        if kind == 'word' and value.lower() == word:
+            parts.append(tokens[start:k])
+            start = k + 1
+    parts.append(tokens[start:])
+    return [p for p in parts if p]
+
+
+def _name(token: Token) -> Optional[str]:
+    kind, value = token
+    if kind == 'ident':
+        return value[1:-1].replace('""', '"')
+    if kind == 'word' and value.lower() not in _KEYWORDS:
+        return value
+    return None
+
+
+def column_of(tokens: List[Token]) -> Optional[ColumnRef]:
+    """
+    Ссылка на колонку, если выражение — колонка (возможно, в скобках и с
+    приведением типа ::type), иначе None. Из schema.table.column берутся
+    последние две части.
+    """
+    tokens = _strip_parens(tokens)
+    for k, (_, value) in _top_level(tokens):
+        if value == '::':
+            tokens = _strip_parens(tokens[:k])
+            break
+    if len(tokens) == 1:
+        name = _name(tokens[0])
+        return (None, name) if name else None
+    if len(tokens) in (3, 5) and all(t[1] == '.' for t in tokens[1::2]):
+        names = [_name(t) for t in tokens[::2]]
+        if all(names):
+            return names[-2], names[-1]
+    return None
+
+
+def column_refs_of(tokens: List[Token]) -> List[ColumnRef]:
+    """
+    Все ссылки на колонки в выражении: без имён функций, типов после :: и
+    служебных слов, без повторов.
+    """
+    refs = {}
+    k = 0
+    while k < len(tokens):
+        kind, value = tokens[k]
+        if value == '::':
+            # тип может состоять из нескольких слов: timestamp without time zone
+            k += 1
+            while k < len(tokens) and tokens[k][0] in ('word', 'ident'):
+                k += 1
+            continue
+        name = _name(tokens[k])
+        if name is None or (k + 1 < len(tokens) and tokens[k + 1][1] == '('):
+            k += 1
+            continue
+        if k + 2 < len(tokens) and tokens[k + 1][1] == '.' and _name(tokens[k + 2]):
+            # schema.table.column или table.column
+            parts = [name]
+            while k + 2 < len(tokens) and tokens[k + 1][1] == '.' and _name(tokens[k + 2]):
+                parts.append(_name(tokens[k + 2]))
+                k += 2
+            refs.setdefault((parts[-2], parts[-1]), None)
+        else:
+            refs.setdefault((None, name), None)
+        k += 1
+    return list(refs)
+
+
+def _flip(op: str) -> str:
+    return {'<': '>', '>': '<', '<=': '>=', '>=': '<='}.get(op, op)
+
+
+def _conjunct(tokens: List[Token]) -> Optional[Predicate]:
+    tokens = _strip_parens(tokens)
+    if not tokens or len(_split_top(tokens, 'or')) > 1:
+        return None
+    if tokens[0][0] == 'word' and tokens[0][1].lower() == 'not':
+        column = column_of(tokens[1:])
+        return Predicate('eq', column, 'not') if column else None
+    for k, (kind, value) in _top_level(tokens):
+        if kind == 'word' and value.lower() == 'is':
+            column = column_of(tokens[:k])
+            if column is None:
+                return None
+            rest = [v.lower() for _, v in tokens[k + 1:]]
+            return Predicate('eq' if rest == ['null'] else 'other', column, 'is ' + ' '.join(rest))
+        if kind == 'op' and value in _COMPARISON_OPS:
+            left, right = tokens[:k], tokens[k + 1:]
+            left_col, right_col = column_of(left), column_of(right)
+            if left_col and right_col:
+                kind = 'join' if value in EQUALITY_OPS and left_col != right_col else 'other'
+                return Predicate(kind, left_col, value, right_col)
+            if left_col is None and right_col is not None:
+                left, right, left_col, value = right, left, right_col, _flip(value)
+            if left_col is None:
+                return None
+            if column_refs_of(right):
+                # колонка сравнивается с выражением от других колонок
+                return Predicate('other', left_col, value)
+            if value in EQUALITY_OPS:
+                return Predicate('eq', left_col, value)
+            if value in RANGE_OPS:
+                return Predicate('range', left_col, value)
+            return Predicate('other', left_col, value)
+    column = column_of(tokens)
+    return Predicate('eq', column, '') if column else None
+
+
+def parse_condition(text: str) -> List[Predicate]:
+    """
+    Условие узла EXPLAIN (Index Cond, Filter, Hash Cond...) как список
+    предикатов конъюнкции. Дизъюнкции и условия над выражениями от колонок
+    (lower(email) = ...) пропускаются: простым индексом их не обслужить.
+    """
+    predicates = []
+    for part in _split_top(_strip_parens(_tokens(text)), 'and'):
+        predicate = _conjunct(part)
+        if predicate is not None and predicate.column is not None:
+            predicates.append(predicate)
+    return predicates
+
+
+def parse_sort_key(items: Iterable[str]) -> List[Tuple[ColumnRef, bool]]:
+    """
+    Sort Key узла как список (колонка, по убыванию). Если среди ключей есть
+    выражение, список обрывается на нём: дальше порядок индексом не обеспечить.
+    """
+    keys = []
+    for item in items:
+        tokens = _tokens(str(item))
+        descending = False
+        while tokens and tokens[-1][0] == 'word' and tokens[-1][1].lower() in ('asc', 'desc', 'first', 'last', 'nulls'):
+            descending = descending or tokens[-1][1].lower() == 'desc'
+            tokens = tokens[:-1]
+        column = column_of(tokens)
+        if column is None:
+            break
+        keys.append((column, descending))
+    return keys
+
+
+def expression_columns(items: Iterable[str]) -> List[ColumnRef]:
+    """
+    Колонки, упомянутые в выражениях items (условия, Sort Key, Output в
+    EXPLAIN VERBOSE), без повторов.
+    """
+    refs = {}
+    for item in items:
+        for ref in column_refs_of(_tokens(str(item))):
+            refs.setdefault(ref, None)
+    return list(refs)
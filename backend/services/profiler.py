@@ -0,0 +1,179 @@
+import os
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from adapters.planner import get_explain_plan
+from services.cardinality import cardinality_report
+from services.sqltext import is_explainable, leading_keyword, tokenize
+
+PROFILE_RUNS = int(os.getenv('PROFILE_RUNS', 5))
+PROFILE_WARMUP = int(os.getenv('PROFILE_WARMUP', 1))
+PROFILE_MAX_RUNS = 50
+PROFILE_STATEMENT_TIMEOUT = os.getenv('PROFILE_STATEMENT_TIMEOUT', '30s')
+
+_DML_KEYWORDS = frozenset({'insert', 'update', 'delete', 'merge'})
+
+NodePath = Tuple[int, ...]
+
+
+def modifies_data(sql: str) -> bool:
+    """
+    Изменяет ли оператор данные (в том числе через WITH ... INSERT/UPDATE/DELETE).
+    """
+    keyword = leading_keyword(sql)
+    if keyword == 'with':
+        return any(kind == 'word' and text.lower() in _DML_KEYWORDS for kind, text in tokenize(sql))
+    return keyword in _DML_KEYWORDS
+
+
+def percentile(values: Sequence[float], p: float) -> Optional[float]:
+    """
+    Перцентиль с линейной интерполяцией между соседними значениями.
+    """
+    values = sorted(v for v in values if v is not None)
+    if not values:
+        return None
+    k = (len(values) - 1) * p / 100.0
+    lo = int(k)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+def _summary(values: Sequence[float]) -> Dict[str, Optional[float]]:
+    present = [v for v in values if v is not None]
+    return {
+        'p50': percentile(present, 50),
+        'p95': percentile(present, 95),
+        'min': min(present) if present else None,
+        'max': max(present) if present else None,
+    }
+
+
+def _node_label(node: Dict[str, Any]) -> str:
+    label = node.get('Node Type', '?')
+    rel = node.get('Relation Name') or node.get('Index Name') or node.get('CTE Name')
+    return f"{label} on {rel}" if rel else label
+
+
+def flatten_measured(plan: Dict[str, Any]) -> Dict[NodePath, Dict[str, Any]]:
+    """
+    Измерения по узлам плана EXPLAIN ANALYZE, ключ — путь от корня (индексы детей).
+    Время узла — включительное (Actual Total Time × Actual Loops), self_time — без детей.
+    """
+    nodes = {}
+    stack: List[Tuple[NodePath, Dict[str, Any]]] = [((), plan)]
+    while stack:
+        path, node = stack.pop()
+        loops = node.get('Actual Loops') or 0
+        total = (node.get('Actual Total Time') or 0) * loops
+        children = node.get('Plans', ())
+        child_total = sum((c.get('Actual Total Time') or 0) * (c.get('Actual Loops') or 0) for c in children)
+        nodes[path] = {
+            'label': _node_label(node),
+            'time': total,
+            'self_time': max(0.0, total - child_total),
+            'rows': (node.get('Actual Rows') or 0) * loops,
+            'shared_hit': node.get('Shared Hit Blocks', 0),
+            'shared_read': node.get('Shared Read Blocks', 0),
+        }
+        for i, child in enumerate(children):
+            stack.append((path + (i,), child))
+    return nodes
+
+
+def _run_totals(explain: Dict[str, Any]) -> Dict[str, Any]:
+    root = explain['Plan']
+    return {
+        'execution_time': explain.get('Execution Time'),
+        'planning_time': explain.get('Planning Time'),
+        'shared_hit': root.get('Shared Hit Blocks', 0),
+        'shared_read': root.get('Shared Read Blocks', 0),
+        'rows': root.get('Actual Rows'),
+    }
+
+
+def profile_query(
+    conn,
+    query: str,
+    runs: int = PROFILE_RUNS,
+    warmup: int = PROFILE_WARMUP,
+    statement_timeout: str = PROFILE_STATEMENT_TIMEOUT,
+) -> Dict[str, Any]:
+    """
+    Измерить запрос: warmup + runs прогонов EXPLAIN (ANALYZE, BUFFERS), каждый
+    в отдельной транзакции с statement_timeout, которая затем откатывается
+    (поэтому DML безопасен). Прогрев в статистику не входит, но первый прогон
+    показывается отдельно как «холодный» для сравнения с прогретым кэшем.
+    По последнему прогону ищутся ошибки оценки числа строк (cardinality).
+    """
+    if not is_explainable(query):
+        raise ValueError("Профилирование недоступно: EXPLAIN не поддерживается для этого оператора")
+    runs = max(1, min(runs, PROFILE_MAX_RUNS))
+    warmup = max(0, min(warmup, PROFILE_MAX_RUNS))
+    explains = []
+    for _ in range(warmup + runs):
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SET LOCAL statement_timeout = %s", (statement_timeout,))
+            explains.append(get_explain_plan(conn, query, analyze=True, buffers=True))
+        finally:
+            conn.rollback()
+
+    measured = explains[warmup:]
+    try:
+        cardinality = cardinality_report(conn, measured[-1]['Plan'])
+    except Exception as e:
+        conn.rollback()
+        cardinality = {'error': str(e)}
+    totals = [_run_totals(e) for e in measured]
+    cold = _run_totals(explains[0])
+
+    per_node: Dict[NodePath, Dict[str, List[float]]] = {}
+    labels: Dict[NodePath, str] = {}
+    for e in measured:
+        for path, m in flatten_measured(e['Plan']).items():
+            # план мог поменяться между прогонами — сравниваем только совпадающие узлы
+            if labels.setdefault(path, m['label']) != m['label']:
+                continue
+            acc = per_node.setdefault(path, {k: [] for k in ('time', 'self_time', 'rows', 'shared_hit', 'shared_read')})
+            for k in acc:
+                acc[k].append(m[k])
+
+    nodes = []
+    for path in sorted(per_node):
+        acc = per_node[path]
+        nodes.append({
+            'path': list(path),
+            'depth': len(path),
+            'node': labels[path],
+            'time_p50': percentile(acc['time'], 50),
+            'time_p95': percentile(acc['time'], 95),
+            'self_time_p50': percentile(acc['self_time'], 50),
+            'rows_p50': percentile(acc['rows'], 50),
+            'shared_hit_p50': percentile(acc['shared_hit'], 50),
+            'shared_read_p50': percentile(acc['shared_read'], 50),
+            'samples': len(acc['time']),
+        })
+
+    warm = {
+        'execution_time': percentile([t['execution_time'] for t in totals], 50),
+        'shared_hit': percentile([t['shared_hit'] for t in totals], 50),
+        'shared_read': percentile([t['shared_read'] for t in totals], 50),
+    }
+    return {
+        'runs': runs,
+        'warmup': warmup,
+        'statement_timeout': statement_timeout,
+        'modifies_data': modifies_data(query),
+        'execution_time': _summary([t['execution_time'] for t in totals]),
+        'planning_time': _summary([t['planning_time'] for t in totals]),
+        'cold': cold,
+        'warm': warm,
+        'cold_vs_warm': {
+            'execution_time_ratio': (cold['execution_time'] / warm['execution_time']
+                                     if cold['execution_time'] and warm['execution_time'] else None),
+            'extra_shared_read': (cold['shared_read'] or 0) - (warm['shared_read'] or 0),
+        },
+        'nodes': nodes,
+        'cardinality': cardinality,
+        'plan': measured[-1]['Plan'],
+    }
@@ -0,0 +1,278 @@
+import math
+import os
+import threading
+import time
+from array import array
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from adapters.pool import pooled_connection, pool_key, describe_key, PoolKey
+from adapters.stats import fetch_snapshot_row
+
+SAMPLER_INTERVAL = float(os.getenv('SAMPLER_INTERVAL', 5))
+# Ёмкость кольцевого буфера на цель: по умолчанию час при интервале 5 с
+SAMPLER_CAPACITY = int(os.getenv('SAMPLER_CAPACITY', 720))
+TIMESERIES_MAX_POINTS = 2000
+
+# Метрики-«уровни»: отдаются как есть
+GAUGE_METRICS = (
+    'cache_hit_ratio', 'index_usage', 'wait_time', 'database_size',
+    'active_connections', 'lock_contention', 'replication_lag',
+)
+# Накопительные счётчики: отдаются как скорость в секунду между соседними сэмплами
+COUNTER_METRICS = ('disk_io_read', 'disk_io_write', 'blks_hit', 'deadlock_count')
+# Производные метрики, которые считаются по приращениям счётчиков
+DERIVED_METRICS = ('interval_cache_hit_ratio',)
+
+SAMPLED_FIELDS = GAUGE_METRICS + COUNTER_METRICS
+TIMESERIES_METRICS = GAUGE_METRICS + COUNTER_METRICS + DERIVED_METRICS
+AGGREGATES = ('avg', 'max', 'min', 'last')
+
+_NAN = float('nan')
+
+
+def _num(value) -> float:
+    return _NAN if value is None else float(value)
+
+
+def _out(value: float) -> Optional[float]:
+    return None if math.isnan(value) else value
+
+
+class RingBuffer:
+    """
+    Кольцевой буфер сэмплов фиксированного размера: отдельный array('d') на
+    отметки времени и на каждое поле, отсутствующие значения — NaN.
+    Память выделяется один раз при создании.
+    """
+
+    def __init__(self, fields: Sequence[str], capacity: int = SAMPLER_CAPACITY):
+        self.fields = tuple(fields)
+        self.capacity = capacity
+        self._ts = array('d', [_NAN]) * capacity
+        self._values = {f: array('d', [_NAN]) * capacity for f in self.fields}
+        self._next = 0
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return self._size
+
+    def append(self, ts: float, values: Dict[str, Any]):
+        with self._lock:
+            i = self._next
+            self._ts[i] = ts
+            for f in self.fields:
+                self._values[f][i] = _num(values.get(f))
+            self._next = (i + 1) % self.capacity
+            self._size = min(self._size + 1, self.capacity)
+
+    def _indexes(self) -> Iterator[int]:
+        start = (self._next - self._size) % self.capacity
+        for k in range(self._size):
+            yield (start + k) % self.capacity
+
+    def snapshot(self, since: Optional[float] = None, fields: Optional[Sequence[str]] = None) -> Tuple[List[float], Dict[str, List[float]]]:
+        """
+        Копия сэмплов (от старых к новым) не старше since.
+        """
+        fields = tuple(fields or self.fields)
+        with self._lock:
+            idx = [i for i in self._indexes() if since is None or self._ts[i] >= since]
+            ts = [self._ts[i] for i in idx]
+            values = {f: [self._values[f][i] for i in idx] for f in fields}
+        return ts, values
+
+    def bytes(self) -> int:
+        return self._ts.itemsize * self.capacity * (1 + len(self.fields))
+
+
+def derive_series(ts: List[float], values: Dict[str, List[float]]) -> Tuple[List[float], Dict[str, List[float]]]:
+    """
+    Ряды для отдачи: уровни как есть, счётчики — скорость в секунду между
+    соседними сэмплами, interval_cache_hit_ratio — доля попаданий в кэш за
+    интервал. Первый сэмпл и сэмплы после сброса счётчиков (отрицательное
+    приращение) дают NaN.
+    """
+    series = {m: [] for m in TIMESERIES_METRICS}
+    for k in range(len(ts)):
+        for m in GAUGE_METRICS:
+            series[m].append(values[m][k])
+        dt = ts[k] - ts[k - 1] if k else 0.0
+        deltas = {}
+        for m in COUNTER_METRICS:
+            d = values[m][k] - values[m][k - 1] if k else _NAN
+            if d < 0 or dt <= 0:
+                d = _NAN
+            deltas[m] = d
+            series[m].append(d / dt if not math.isnan(d) else _NAN)
+        touched = deltas['blks_hit'] + deltas['disk_io_read']
+        series['interval_cache_hit_ratio'].append(deltas['blks_hit'] / touched if touched > 0 else _NAN)
+    return ts, series
+
+
+def _aggregate(values: List[float], agg: str) -> float:
+    values = [v for v in values if not math.isnan(v)]
+    if not values:
+        return _NAN
+    if agg == 'max':
+        return max(values)
+    if agg == 'min':
+        return min(values)
+    if agg == 'last':
+        return values[-1]
+    return sum(values) / len(values)
+
+
+def downsample(ts: List[float], series: Dict[str, List[float]], points: int, agg: str = 'avg') -> Tuple[List[float], Dict[str, List[float]]]:
+    """
+    Свести ряды к не более чем points точкам: интервал времени делится на
+    равные корзины, значения в корзине агрегируются (avg/max/min/last),
+    отметкой времени корзины служит время последнего сэмпла в ней.
+    """
+    if agg not in AGGREGATES:
+        raise ValueError(f"Неизвестная агрегация: {agg}. Допустимо: {', '.join(AGGREGATES)}")
+    if len(ts) <= points:
+        return ts, series
+    start, span = ts[0], (ts[-1] - ts[0]) or 1.0
+    buckets: List[List[int]] = [[] for _ in range(points)]
+    for k, t in enumerate(ts):
+        buckets[min(points - 1, int((t - start) / span * points))].append(k)
+    buckets = [b for b in buckets if b]
+    out_ts = [ts[b[-1]] for b in buckets]
+    out = {m: [_aggregate([values[k] for k in b], agg) for b in buckets] for m, values in series.items()}
+    return out_ts, out
+
+
+class MetricsSampler:
+    """
+    Фоновый опрос метрик кластера цели с интервалом interval в кольцевой буфер.
+    """
+
+    def __init__(self, params, interval: float = SAMPLER_INTERVAL, capacity: int = SAMPLER_CAPACITY):
+        self.params = params
+        self.target = describe_key(pool_key(params))
+        self.dbname = pool_key(params)[4]
+        self.interval = interval
+        self.buffer = RingBuffer(SAMPLED_FIELDS, capacity)
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._last_error: Optional[str] = None
+
+    def sample_once(self):
+        with pooled_connection(self.params) as conn:
+            row = fetch_snapshot_row(conn, self.dbname)
+        self.buffer.append(time.time(), row)
+
+    def _loop(self):
+        while not self._stop.is_set():
+            started = time.monotonic()
+            try:
+                self.sample_once()
+                self._last_error = None
+            except Exception as e:
+                self._last_error = str(e)
+            self._stop.wait(max(0.0, self.interval - (time.monotonic() - started)))
+
+    def start(self):
+        if self.running:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name=f'sampler {self.target}', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def timeseries(
+        self,
+        metrics: Optional[Sequence[str]] = None,
+        window: Optional[float] = None,
+        points: Optional[int] = None,
+        agg: str = 'avg',
+    ) -> Dict[str, Any]:
+        """
+        Ряды метрик за последние window секунд, сведённые к points точкам.
+        """
+        metrics = list(metrics or TIMESERIES_METRICS)
+        unknown = [m for m in metrics if m not in TIMESERIES_METRICS]
+        if unknown:
+            raise ValueError(f"Неизвестные метрики: {', '.join(unknown)}")
+        since = time.time() - window if window else None
+        # берём один сэмпл до окна, чтобы у первой точки окна была скорость
+        ts, series = derive_series(*self.buffer.snapshot(None if since is None else since - 2 * self.interval))
+        cut = 0 if since is None else next((k for k, t in enumerate(ts) if t >= since), len(ts))
+        series = {m: series[m][cut:] for m in metrics}
+        points = min(points or TIMESERIES_MAX_POINTS, TIMESERIES_MAX_POINTS)
+        ts, series = downsample(ts[cut:], series, points, agg)
+        return {
+            'target': self.target,
+            'interval': self.interval,
+            'timestamps': ts,
+            'series': {m: [_out(v) for v in values] for m, values in series.items()},
+            'units': {m: ('per_second' if m in COUNTER_METRICS else 'value') for m in metrics},
+        }
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            'target': self.target,
+            'running': self.running,
+            'interval': self.interval,
+            'capacity': self.buffer.capacity,
+            'samples': len(self.buffer),
+            'buffer_bytes': self.buffer.bytes(),
+            'last_error': self._last_error,
+        }
+
+
+_samplers: Dict[PoolKey, MetricsSampler] = {}
+_samplers_lock = threading.Lock()
+
+
+def get_sampler(params, start: bool = True, **options) -> MetricsSampler:
+    """
+    Сэмплер цели; создаётся и запускается при первом обращении.
+    """
+    key = pool_key(params)
+    with _samplers_lock:
+        sampler = _samplers.get(key)
+        if sampler is None:
+            sampler = _samplers[key] = MetricsSampler(params, **options)
+        if start:
+            sampler.start()
+    return sampler
+
+
+def find_sampler(params) -> Optional[MetricsSampler]:
+    """
+    Сэмплер цели, если он запущен; новый не создаётся.
+    """
+    with _samplers_lock:
+        return _samplers.get(pool_key(params))
+
+
+def stop_sampler(params) -> bool:
+    with _samplers_lock:
+        sampler = _samplers.pop(pool_key(params), None)
+    if sampler is None:
+        return False
+    sampler.stop()
+    return True
+
+
+def sampler_status() -> List[Dict[str, Any]]:
+    return [s.status() for s in list(_samplers.values())]
+
+
+def stop_all_samplers():
+    with _samplers_lock:
+        samplers = list(_samplers.values())
+        _samplers.clear()
+    for sampler in samplers:
+        sampler.stop()
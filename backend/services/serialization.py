@@ -0,0 +1,60 @@
+import json
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from typing import Any, Iterable, Iterator
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+NDJSON_MEDIA_TYPE = 'application/x-ndjson'
+
+
+def json_default(obj):
+    """
+    Типы, которых нет в JSON: Decimal из psycopg, даты, интервалы. Вызывается
+    кодировщиком только для таких значений — отдельного прохода с копией нет.
+    """
+    if isinstance(obj, Decimal):
+        return float(obj)
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    if isinstance(obj, timedelta):
+        return obj.total_seconds()
+    return str(obj)
+
+
+if orjson is not None:
+    # datetime/date orjson кодирует сам; ключи-не-строки (int в счётчиках) допускаются
+    _ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS
+
+    def dumpb(obj: Any) -> bytes:
+        """
+        Компактный JSON в UTF-8.
+        """
+        return orjson.dumps(obj, default=json_default, option=_ORJSON_OPTIONS)
+else:
+    _encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'), default=json_default)
+
+    def dumpb(obj: Any) -> bytes:
+        """
+        Компактный JSON в UTF-8.
+        """
+        return _encoder.encode(obj).encode('utf-8')
+
+
+def dumps(obj: Any) -> str:
+    return dumpb(obj).decode('utf-8')
+
+
+def loads(data):
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+
+def ndjson_lines(items: Iterable[Any]) -> Iterator[bytes]:
+    """
+    NDJSON: по строке на элемент; элементы кодируются по мере чтения.
+    """
+    for item in items:
+        yield dumpb(item) + b'\n'
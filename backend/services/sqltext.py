@@ -0,0 +1,225 @@
+import hashlib
+import re
+from typing import Iterator, List, Optional, Tuple
+
+Token = Tuple[str, str]
+
+# Лексер SQL: достаточно точный, чтобы не трогать содержимое строк,
+# идентификаторов в кавычках, dollar-quoted тел и комментариев.
+_TOKEN_RE = re.compile(r"""
+      (?P<ws>\s+)
+    | (?P<comment>--[^\n]*|/\*.*?(?:\*/|\Z))
+    | (?P<string>(?:[EeBbXxNn]|[Uu]&)?'(?:[^']|'')*(?:'|\Z))
+    | (?P<dollar>\$(?P<tag>(?:[A-Za-z_][A-Za-z0-9_]*)?)\$.*?(?:\$(?P=tag)\$|\Z))
+    | (?P<ident>"(?:[^"]|"")*(?:"|\Z))
+    | (?P<param>\$\d+)
+    | (?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)
+    | (?P<word>[A-Za-z_\u0080-\uffff][A-Za-z0-9_$\u0080-\uffff]*)
+    | (?P<op>::|<=|>=|<>|!=|\|\||[^\s])
+""", re.S | re.X)
+
+
+def tokenize(sql: str) -> Iterator[Token]:
+    """
+    Разбивает SQL на токены (kind, text). kind: ws, comment, string, dollar,
+    ident, param, number, word, op.
+    """
+    for m in _TOKEN_RE.finditer(sql):
+        yield m.lastgroup, m.group()
+
+
+def normalize_query_text(sql: str) -> str:
+    """
+    Нормализует текст запроса без изменения смысла: убирает комментарии,
+    схлопывает пробелы, приводит ключевые слова и идентификаторы без кавычек
+    к нижнему регистру, отбрасывает завершающую точку с запятой.
+    Литералы сохраняются, поэтому результат годится как ключ кэша планов.
+    """
+    parts = []
+    pending_space = False
+    for kind, text in tokenize(sql):
+        if kind in ('ws', 'comment'):
+            pending_space = True
+            continue
+        if pending_space and parts:
+            parts.append(' ')
+        pending_space = False
+        parts.append(text.lower() if kind == 'word' else text)
+    while parts and parts[-1] in (';', ' '):
+        parts.pop()
+    return ''.join(parts)
+
+
+def text_digest(text: str) -> str:
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()[:16]
+
+
+def has_parameters(sql: str) -> bool:
+    """
+    Есть ли в тексте позиционные параметры ($1, $2...), как в pg_stat_statements.
+    """
+    return any(kind == 'param' for kind, _ in tokenize(sql))
+
+
+def split_statements(sql: str) -> List[str]:
+    """
+    Делит текст на отдельные операторы по ';' вне строк, комментариев и
+    dollar-quoted тел. Пустые операторы (только пробелы/комментарии) отбрасываются.
+    """
+    statements = []
+    current = []
+    meaningful = False
+    for kind, text in tokenize(sql):
+        if kind == 'op' and text == ';':
+            if meaningful:
+                statements.append(''.join(current).strip())
+            current, meaningful = [], False
+            continue
+        current.append(text)
+        if kind not in ('ws', 'comment'):
+            meaningful = True
+    if meaningful:
+        statements.append(''.join(current).strip())
+    return statements
+
+
+# Операторы, для которых PostgreSQL умеет строить EXPLAIN
+EXPLAINABLE_KEYWORDS = frozenset({
+    'select', 'insert', 'update', 'delete', 'merge', 'values', 'with',
+    'table', 'execute', 'declare', 'create',
+})
+
+
+def leading_keyword(sql: str) -> Optional[str]:
+    for kind, text in tokenize(sql):
+        if kind in ('ws', 'comment') or (kind == 'op' and text == '('):
+            continue
+        return text.lower() if kind == 'word' else None
+    return None
+
+
+def is_explainable(sql: str) -> bool:
+    """
+    Можно ли построить план для оператора. CREATE допускается только в виде
+    CREATE TABLE ... AS / CREATE MATERIALIZED VIEW ... AS.
+    """
+    keyword = leading_keyword(sql)
+    if keyword != 'create':
+        return keyword in EXPLAINABLE_KEYWORDS
+    words = [text.lower() for kind, text in tokenize(sql) if kind == 'word']
+    return 'as' in words and (words[1:2] == ['table'] or words[1:3] == ['materialized', 'view'])
+
+
+# Токены, вместо которых в отпечатке ставится '?'
+_LITERAL_KINDS = frozenset({'string', 'dollar', 'number', 'param'})
+# После этих токенов '-' перед числом — знак литерала, а не вычитание
+_SIGN_CONTEXT = frozenset({'(', ',', '=', '<', '>', '<=', '>=', '<>', '!=', '+', '-', '*', '/', '['})
+_NO_SPACE_AFTER = frozenset({'(', '[', '.', '::'})
+_NO_SPACE_BEFORE = frozenset({')', ']', ',', '.', '::', '(', '['})
+# Ключевые слова, после которых скобка отделяется пробелом (в отличие от вызова функции)
+_SPACED_BEFORE_PAREN = frozenset({
+    'in', 'on', 'values', 'as', 'and', 'or', 'not', 'exists', 'using', 'from', 'join',
+    'where', 'select', 'by', 'when', 'then', 'else', 'over', 'filter', 'union', 'all',
+    'intersect', 'except', 'lateral', 'set', 'returning', 'having', 'group', 'partition',
+})
+
+
+def fingerprint_tokens(sql: str) -> List[str]:
+    """
+    Значимые токены «формы» запроса: без комментариев и пробелов, слова
+    в нижнем регистре, литералы и параметры заменены на '?', списки
+    IN (...) и ARRAY[...] из одних литералов свёрнуты до одного элемента,
+    повторяющиеся строки VALUES — до одной строки.
+    """
+    tokens: List[str] = []
+    for kind, text in tokenize(sql):
+        if kind in ('ws', 'comment'):
+            continue
+        if kind in _LITERAL_KINDS:
+            if tokens and tokens[-1] == '-' and (len(tokens) == 1 or tokens[-2] in _SIGN_CONTEXT):
+                tokens.pop()
+            tokens.append('?')
+        elif kind == 'word':
+            tokens.append(text.lower())
+        else:
+            tokens.append(text)
+    while tokens and tokens[-1] == ';':
+        tokens.pop()
+    return _collapse_values(_collapse_lists(tokens))
+
+
+def _collapse_lists(tokens: List[str]) -> List[str]:
+    out: List[str] = []
+    i = 0
+    while i < len(tokens):
+        tok = tokens[i]
+        close = {'(': ')', '[': ']'}.get(tok)
+        if close and out and out[-1] in ('in', 'array'):
+            j = i + 1
+            while j + 1 < len(tokens) and tokens[j] == '?' and tokens[j + 1] == ',':
+                j += 2
+            if j + 1 < len(tokens) and j > i + 1 and tokens[j] == '?' and tokens[j + 1] == close:
+                out.extend((tok, '?', close))
+                i = j + 2
+                continue
+        out.append(tok)
+        i += 1
+    return out
+
+
+def _row_end(tokens: List[str], start: int) -> Optional[int]:
+    # индекс закрывающей скобки для '(' в позиции start
+    depth = 0
+    for i in range(start, len(tokens)):
+        if tokens[i] == '(':
+            depth += 1
+        elif tokens[i] == ')':
+            depth -= 1
+            if depth == 0:
+                return i
+    return None
+
+
+def _collapse_values(tokens: List[str]) -> List[str]:
+    out: List[str] = []
+    i = 0
+    while i < len(tokens):
+        out.append(tokens[i])
+        if tokens[i] == 'values' and i + 1 < len(tokens) and tokens[i + 1] == '(':
+            end = _row_end(tokens, i + 1)
+            if end is None:
+                i += 1
+                continue
+            row = tokens[i + 1:end + 1]
+            out.extend(row)
+            i = end + 1
+            while i < len(tokens) and tokens[i] == ',' and tokens[i + 1:i + 1 + len(row)] == row:
+                i += 1 + len(row)
+            continue
+        i += 1
+    return out
+
+
+def fingerprint_text(sql: str) -> str:
+    """
+    Нормализованная «форма» запроса без литералов (см. fingerprint_tokens).
+    Не зависит от пробелов, регистра и комментариев исходного текста.
+    """
+    parts: List[str] = []
+    prev = None
+    for tok in fingerprint_tokens(sql):
+        if prev is not None and prev not in _NO_SPACE_AFTER and tok not in _NO_SPACE_BEFORE:
+            parts.append(' ')
+        elif tok == '(' and (prev in _SPACED_BEFORE_PAREN or prev in (',', '=', '?', ')')):
+            parts.append(' ')
+        parts.append(tok)
+        prev = tok
+    return ''.join(parts)
+
+
+def query_fingerprint(sql: str) -> str:
+    """
+    Отпечаток запроса: одинаков для запросов, отличающихся только литералами,
+    пробелами, регистром ключевых слов, комментариями и длиной IN-списков.
+    """
+    return text_digest(fingerprint_text(sql))
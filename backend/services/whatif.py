@@ -0,0 +1,172 @@
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+from adapters.planner import get_explain_plan
+from adapters.pool import pooled_connection, pool_key
+from services.advisor import compare_plans, extract_plan_metrics
+from services.sqltext import normalize_query_text
+
+WHATIF_MODES = ('auto', 'hypothetical', 'real', 'off')
+WHATIF_WORKERS = int(os.getenv('WHATIF_WORKERS', 4))
+WHATIF_STATEMENT_TIMEOUT = os.getenv('WHATIF_STATEMENT_TIMEOUT', '30s')
+WHATIF_LOCK_TIMEOUT = os.getenv('WHATIF_LOCK_TIMEOUT', '2s')
+# Сколько секунд доверять проверке hypopg: после CREATE EXTENSION hypopg режим
+# auto начнёт оценивать индексы без перезапуска сервера
+HYPOPG_CHECK_TTL = float(os.getenv('HYPOPG_CHECK_TTL', 60))
+
+_CREATE_INDEX_RE = re.compile(
+    r'^\s*CREATE\s+(?P<unique>UNIQUE\s+)?INDEX\s+(?:CONCURRENTLY\s+)?'
+    r'(?:IF\s+NOT\s+EXISTS\s+)?(?:(?!ON\b)[^\s(]+\s+)?ON\s+(?P<rest>.*?)\s*;?\s*$',
+    re.I | re.S,
+)
+
+# Обслуживающие команды перестраивают или блокируют таблицы и не меняют план —
+# what-if их не выполняет ни в каком режиме
+_MAINTENANCE_RE = re.compile(r'^\s*(REINDEX|VACUUM|CLUSTER)\b', re.I)
+
+_executor = ThreadPoolExecutor(max_workers=WHATIF_WORKERS, thread_name_prefix='whatif')
+_hypopg_available: Dict[Any, Tuple[bool, float]] = {}  # цель -> (есть ли hypopg, когда проверено)
+_hypopg_lock = threading.Lock()
+
+
+def has_hypopg(conn, params) -> bool:
+    """
+    Установлено ли расширение hypopg в целевой БД. Результат кешируется на
+    цель на HYPOPG_CHECK_TTL секунд. conn может быть None — тогда соединение
+    берётся из пула.
+    """
+    key = pool_key(params)
+    with _hypopg_lock:
+        cached = _hypopg_available.get(key)
+    if cached is not None and time.monotonic() - cached[1] < HYPOPG_CHECK_TTL:
+        return cached[0]
+    if conn is None:
+        with pooled_connection(params) as conn:
+            return has_hypopg(conn, params)
+    with conn.cursor() as cur:
+        cur.execute("SELECT EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'hypopg')")
+        available = cur.fetchone()[0]
+    with _hypopg_lock:
+        _hypopg_available[key] = (available, time.monotonic())
+    return available
+
+
+def hypothetical_index_ddl(ddl: str) -> Optional[str]:
+    """
+    CREATE INDEX в виде, который принимает hypopg_create_index (без имени,
+    IF NOT EXISTS и CONCURRENTLY). Для остальных команд — None.
+    """
+    m = _CREATE_INDEX_RE.match(ddl)
+    if not m:
+        return None
+    return f"CREATE {m.group('unique') or ''}INDEX ON {m.group('rest')}"
+
+
+def _real_ddl(ddl: str) -> str:
+    # CONCURRENTLY нельзя выполнить внутри транзакции, а мы всё равно откатываемся
+    return re.sub(r'\bINDEX\s+CONCURRENTLY\b', 'INDEX', ddl, count=1, flags=re.I)
+
+
+def evaluate_candidate(params, query: str, ddl: str, base_plan: Dict[str, Any], mode: str) -> Dict[str, Any]:
+    """
+    Оценить один кандидат fix_ddl на отдельном соединении из пула.
+    Всё выполняется в транзакции, которая затем откатывается.
+    """
+    result = {'ddl': ddl, 'mode': mode}
+    try:
+        with pooled_connection(params) as conn:
+            try:
+                with conn.cursor() as cur:
+                    cur.execute("SET LOCAL statement_timeout = %s", (WHATIF_STATEMENT_TIMEOUT,))
+                    cur.execute("SET LOCAL lock_timeout = %s", (WHATIF_LOCK_TIMEOUT,))
+                    if mode == 'hypothetical':
+                        cur.execute("SELECT indexrelid FROM hypopg_create_index(%s)", (hypothetical_index_ddl(ddl),))
+                    else:
+                        cur.execute(_real_ddl(ddl))
+                alt_plan = get_explain_plan(conn, query)['Plan']
+            finally:
+                conn.rollback()
+                if mode == 'hypothetical':
+                    with conn.cursor() as cur:
+                        cur.execute("SELECT hypopg_reset()")
+    except Exception as e:
+        result.update(metrics_after=None, improvement=None, error=str(e))
+        return result
+    comparison = compare_plans(base_plan, alt_plan)
+    result.update(
+        metrics_after=extract_plan_metrics(alt_plan),
+        improvement=comparison['improvement'],
+        plan_diff=comparison['diff'],
+    )
+    return result
+
+
+def evaluate_whatif(
+    params,
+    conn,
+    query: str,
+    base_plan: Dict[str, Any],
+    advice_list: List[Dict[str, Any]],
+    mode: str = 'auto',
+) -> Dict[str, Any]:
+    """
+    What-if оценка рекомендаций с fix_ddl: одинаковые DDL оцениваются один раз,
+    разные — параллельно на отдельных сессиях с statement_timeout/lock_timeout.
+    В режимах auto и hypothetical CREATE INDEX проверяется гипотетически через
+    hypopg, остальные кандидаты пропускаются с причиной (skipped): DDL на
+    целевой БД выполняется только при явном mode='real', а REINDEX, VACUUM
+    и CLUSTER не выполняются никогда.
+    Результаты записываются в элементы advice_list.
+    """
+    if mode not in WHATIF_MODES:
+        raise ValueError(f"Неизвестный режим what-if: {mode}")
+    candidates: Dict[str, Dict[str, Any]] = {}
+    for a in advice_list:
+        ddl = a.get('fix_ddl')
+        if not ddl or mode == 'off':
+            continue
+        key = normalize_query_text(ddl)
+        candidate = candidates.setdefault(key, {'ddl': ddl, 'advice': []})
+        candidate['advice'].append(a)
+
+    hypopg = mode in ('auto', 'hypothetical') and candidates and has_hypopg(conn, params)
+    futures = []
+    for candidate in candidates.values():
+        ddl = candidate['ddl']
+        if _MAINTENANCE_RE.match(ddl):
+            futures.append((candidate, 'Обслуживающие команды (REINDEX, VACUUM, CLUSTER) what-if не выполняет'))
+        elif mode == 'real':
+            futures.append((candidate, _executor.submit(
+                evaluate_candidate, params, query, ddl, base_plan, 'real')))
+        elif not hypothetical_index_ddl(ddl):
+            futures.append((candidate, 'Гипотетически оценивается только CREATE INDEX; '
+                                       "реальное выполнение с откатом — только при whatif='real'"))
+        elif not hypopg:
+            futures.append((candidate, "Расширение hypopg не установлено; "
+                                       "реальное выполнение с откатом — только при whatif='real'"))
+        else:
+            futures.append((candidate, _executor.submit(
+                evaluate_candidate, params, query, ddl, base_plan, 'hypothetical')))
+
+    results = []
+    for candidate, future in futures:
+        if isinstance(future, str):
+            result = {'ddl': candidate['ddl'], 'mode': None, 'metrics_after': None, 'improvement': None,
+                      'skipped': future}
+        else:
+            result = future.result()
+        for a in candidate['advice']:
+            a['metrics_before'] = a['metrics']
+            a['metrics_after'] = result['metrics_after']
+            a['improvement'] = result['improvement']
+            a['whatif_mode'] = result['mode']
+            if 'error' in result:
+                a['error'] = result['error']
+            if 'skipped' in result:
+                a['whatif_skipped'] = result['skipped']
+        results.append({**result, 'advice_count': len(candidate['advice'])})
+    return {'mode': mode, 'hypopg': bool(hypopg), 'candidates': results}
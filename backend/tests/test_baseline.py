@@ -0,0 +1,45 @@
+from services.baseline import compact_plan, compare_with_baseline, plan_shape
+
+
+def scan(node_type, relation, **extra):
+    return {'Node Type': node_type, 'Relation Name': relation, 'Alias': relation,
+            'Total Cost': 10.0, 'Plan Rows': 100, **extra}
+
+
+def baseline_for(plan):
+    return {'plan': compact_plan(plan), 'shape': plan_shape(plan), 'accepted_at': None}
+
+
+def test_nested_loop_to_hash_join_reports_seq_scan_downgrade():
+    before = {
+        'Node Type': 'Nested Loop', 'Join Type': 'Inner', 'Total Cost': 100.0, 'Plan Rows': 100,
+        'Plans': [
+            scan('Seq Scan', 'orders'),
+            scan('Index Scan', 'customers', **{'Index Name': 'customers_pkey'}),
+        ],
+    }
+    after = {
+        'Node Type': 'Hash Join', 'Join Type': 'Inner', 'Total Cost': 110.0, 'Plan Rows': 100,
+        'Plans': [
+            scan('Seq Scan', 'orders'),
+            {'Node Type': 'Hash', 'Total Cost': 20.0, 'Plan Rows': 100, 'Plans': [scan('Seq Scan', 'customers')]},
+        ],
+    }
+    result = compare_with_baseline(baseline_for(before), after)
+    assert result['status'] == 'regressed'
+    assert result['seq_scan_downgrades'] == ['customers']
+    assert result['reasons']
+
+
+def test_unchanged_seq_scan_is_not_a_downgrade():
+    before = {
+        'Node Type': 'Hash Join', 'Join Type': 'Inner', 'Total Cost': 100.0, 'Plan Rows': 100,
+        'Plans': [
+            scan('Seq Scan', 'orders'),
+            {'Node Type': 'Hash', 'Total Cost': 20.0, 'Plan Rows': 100, 'Plans': [scan('Seq Scan', 'customers')]},
+        ],
+    }
+    after = dict(before, **{'Node Type': 'Merge Join'})
+    result = compare_with_baseline(baseline_for(before), after)
+    assert result['status'] == 'changed'
+    assert result['seq_scan_downgrades'] == []
@@ -9,6 +9,7 @@ document.addEventListener('DOMContentLoaded', () => {
         <li><a href="history.html">История</a></li>
         <li><a href="info_BD.html">Информация о базе данных</a></li>
          <li><a href="heatmap.html">Аналитика</a></li>
+        <li><a href="metrics.html">Метрики</a></li>
       </ul>
     </nav>
   `;